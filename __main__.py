@@ -1,14 +1,27 @@
+import argparse
+import sqlite3
 import threading
 from abc import ABCMeta
-from time import sleep
+from collections import Counter
+from time import monotonic, sleep
 
 
 import newsbot  # you must import your bot file here, even if you don't use it
 import eventbot
 import ticketbot
 import config
+import cache
+import praw
+from configparser import Error as ConfigParserError
 from config import praw_config, bot_config
-from bots import InvalidBotClassName, BotSignature, RedditBot
+from config.bot_config import InvalidBotConfig, get_interval, get_sharding_config, get_supervisor_config
+from config.bot_config import get_watchdog_config
+from config.watcher import ConfigWatcher
+from bots import InvalidBotClassName, BotSignature, RedditBot, get_backoff_delay, is_restartable_error
+from bots import set_thread_stack_size
+from sharding import LeaseStore, ShardCoordinator
+from memdiag import MemoryMonitor, install_signal_handler
+from stream import CommentStream
 
 
 # If you declare your own RedditBot subclass in its own file,
@@ -31,17 +44,45 @@ class Dispatch(threading.Thread, metaclass=ABCMeta):
         """
         super(Dispatch, self).__init__()
         self.stop = stop_event or threading.Event()
-        self.bots = {}
+        self.bots = {}  # username -> list of bots using that account
+        self.signatures = {}  # username -> the BotSignature its bots were created from
+        self.retired = []  # bots that were told to stop because their account was removed or changed
+        self._bots_lock = threading.RLock()  # held while self.bots or self.retired change, and while join() reads them
+        self.config_watcher = ConfigWatcher(bot_config.bot_config_path, praw_config.PRAW_FILE_PATH)
+        self.comment_stream = CommentStream()
+        self.memory_monitor = MemoryMonitor()
+        self.unfinished = []  # names of the bots that did not stop before the shutdown deadline
+        self.overruns = Counter()  # bot name -> number of times the watchdog found it stuck
+        self._stuck_deadlines = {}  # bot name -> the Deadline the watchdog last acted on
+        self.restarts = Counter()  # bot name -> number of times the supervisor restarted it since it was last healthy
+        self._healthy_since = {}  # bot name -> monotonic time since when a restarted bot has not failed
+        self._restart_times = {}  # bot name -> monotonic time when a failed bot may be restarted
 
         for signature in bot_signatures:
-            if type(signature.classname) is str:
-                self.bots[signature.classname] = [BOT_CLASSES[name](user_name=signature.username)
-                                                  for name in signature.classname.split(",")]
-            elif type(signature.classname) is list and all(type(name) is str for name in signature.classname):
-                self.bots[signature.classname] = [BOT_CLASSES[name](user_name=signature.username)
-                                                  for name in signature.classname]
-            else:
-                raise InvalidBotClassName
+            self.bots[signature.username] = self.create_bots(signature)
+            self.signatures[signature.username] = signature
+
+    def create_bots(self, signature):
+        """
+        Bots with a COMMENT_PATTERN are subscribed to the shared comment stream.
+        :param signature: A BotSignature whose classname is a comma-separated string or a list of class names.
+        :raises InvalidBotClassName if the class names are not valid
+        :return: A list of new bots, one for each class name, all using the signature's account.
+        """
+        if type(signature.classname) is str:
+            names = signature.classname.split(",")
+        elif type(signature.classname) is list and all(type(name) is str for name in signature.classname):
+            names = signature.classname
+        else:
+            raise InvalidBotClassName
+        try:
+            bots = [BOT_CLASSES[name.strip()](user_name=signature.username) for name in names]
+        except KeyError as e:
+            raise InvalidBotClassName("Unknown bot class: {}".format(e))
+        for bot in bots:
+            if bot.COMMENT_PATTERN is not None:
+                bot.comments = self.comment_stream.subscribe(bot.name, bot.COMMENT_PATTERN, bot.USER_NAME)
+        return bots
 
     def __enter__(self):
         """
@@ -59,31 +100,222 @@ class Dispatch(threading.Thread, metaclass=ABCMeta):
         e.g. with Dispatch():
                  # do something
         """
-        self.join()
+        self.join(get_interval('shutdown_timeout_seconds'))
 
     def run(self):
         """
         Override of Thread.run().
-        Starts the bots, and waits for a stop event.
+        Starts the bots, the comment stream, and the memory monitor, and runs the watchdog, the supervisor, and the
+        config watcher until a stop event.
         :return:
         """
         for bot_list in self.bots.values():
             for bot in bot_list:
                 bot.start()
-        self.stop.wait()
+        self.comment_stream.start()
+        self.memory_monitor.start()
+        while not self.stop.wait(get_watchdog_config()['check_interval_seconds']):
+            self.check_bots()
+            self.supervise_bots()
+            self.watch_config()
+
+    def watch_config(self):
+        """
+        Reloads bot_config.yaml and the bot accounts if their files changed since the last check.
+        """
+        changed = self.config_watcher.poll()
+        if bot_config.bot_config_path in changed:
+            self.reload_bot_config()
+        if praw_config.PRAW_FILE_PATH in changed:
+            self.reload_accounts()
+
+    def reload_bot_config(self):
+        """
+        Loads bot_config.yaml again and applies it to the caches and running bots without restarting them.
+        If the new file is not valid, the error is logged and the current configuration is kept.
+        """
+        try:
+            bot_config.reload_config()
+        except InvalidBotConfig:
+            logger.exception("Invalid bot_config.yaml, keeping the current configuration")
+            return
+        cache.configure_caches()
+        for bot_list in self.bots.values():
+            for bot in bot_list:
+                bot.apply_config()
+        logger.info("Reloaded bot_config.yaml")
+
+    def reload_accounts(self):
+        """
+        Called when praw.ini changes. A Dispatch created from a fixed list of BotSignatures has nothing to reload.
+        """
+        pass
+
+    def update_bots(self, bot_signatures):
+        """
+        Makes the running bots match a new list of BotSignatures. Bots for new accounts are started, bots for removed
+        accounts are told to stop, and bots whose signature changed are replaced. Other bots are left alone.
+        :param bot_signatures: A list of BotSignatures
+        :raises InvalidBotClassName if a new signature has invalid class names. No bots are changed in that case.
+        Once the Dispatch is stopping, nothing is changed, so join() stops every bot that was ever started.
+        """
+        signatures = {signature.username: signature for signature in bot_signatures}
+        changed = {name: signature for name, signature in signatures.items() if self.signatures.get(name) != signature}
+        new_bots = {name: self.create_bots(signature) for name, signature in changed.items()}
+        removed = [name for name in self.signatures if name not in signatures]
+        with self._bots_lock:
+            if self.stop.is_set():
+                return
+            retired = []
+            for name in removed + list(changed):
+                retired += self.bots.pop(name, [])
+                self.signatures.pop(name, None)
+            self.retire_bots(retired)
+            # a replaced bot keeps its comment stream subscription, so only the bots that are gone are unsubscribed
+            new_names = {bot.name for bot_list in new_bots.values() for bot in bot_list}
+            for bot in retired:
+                if bot.name not in new_names:
+                    self.comment_stream.unsubscribe(bot.name)
+            for name, bot_list in new_bots.items():
+                self.bots[name] = bot_list
+                self.signatures[name] = changed[name]
+                for bot in bot_list:
+                    bot.start()
+        if changed or removed:
+            logger.info("Updated bot accounts: started=[{}], stopped=[{}]".format(
+                ", ".join(sorted(changed)), ", ".join(sorted(removed))))
+
+    def retire_bots(self, bot_list):
+        """
+        Tells bots to stop after their current work cycle, without waiting for them, so the run loop is not blocked.
+        They are joined when the Dispatch is joined.
+        """
+        for bot in bot_list:
+            bot.drain()
+            self._restart_times.pop(bot.name, None)
+        with self._bots_lock:
+            self.retired = [bot for bot in self.retired if bot.is_alive()] + bot_list
+
+    def check_bots(self):
+        """
+        The watchdog. Finds bots whose work cycle has run past its deadline (plus a grace period), records the
+        overrun, and either replaces the bot or makes its cycle give up, depending on the configured action.
+        """
+        settings = get_watchdog_config()
+        for bot_list in self.bots.values():
+            for index, bot in enumerate(bot_list):
+                deadline = bot.deadline
+                if not bot.is_alive() or not bot.is_overrun(settings['grace_seconds']) or \
+                        self._stuck_deadlines.get(bot.name) is deadline:
+                    continue
+                self._stuck_deadlines[bot.name] = deadline
+                self.overruns[bot.name] += 1
+                logger.error("Bot is stuck past its deadline: bot=[{}], overruns=[{}], action=[{}]".format(
+                    bot.name, self.overruns[bot.name], settings['action']))
+                if settings['action'] == 'restart':
+                    bot_list[index] = self.replace_bot(bot)
+                else:
+                    deadline.expire()
+
+    def supervise_bots(self):
+        """
+        The supervisor. Finds bots that were stopped by an error, and restarts them after an exponential backoff
+        with jitter. A restarted bot keeps the failed bot's Reddit session if it is still valid.
+        Bots are given up on if they fail with an error a restart cannot fix, or have been restarted too many times.
+        A restarted bot that runs for healthy_seconds without a failed work cycle has its restart count reset,
+        so failures that are far apart never add up to max_restarts.
+        """
+        settings = get_supervisor_config()
+        now = monotonic()
+        for bot_list in self.bots.values():
+            for index, bot in enumerate(bot_list):
+                if bot.is_alive() and self.restarts[bot.name]:
+                    self._check_health(bot, now, settings['healthy_seconds'])
+                if bot.is_alive() or bot.failure is None or not is_restartable_error(bot.failure) or \
+                        self.restarts[bot.name] >= settings['max_restarts']:
+                    continue
+                if bot.name not in self._restart_times:
+                    delay = get_backoff_delay(self.restarts[bot.name] + 1, settings['backoff_base_seconds'],
+                                              settings['backoff_max_seconds'])
+                    self._restart_times[bot.name] = now + delay
+                    logger.warning("Bot failed, restarting later: bot=[{}], error=[{!r}], restarts=[{}], "
+                                   "delay=[{:.1f}s]".format(bot.name, bot.failure, self.restarts[bot.name], delay))
+                elif now >= self._restart_times[bot.name]:
+                    del self._restart_times[bot.name]
+                    self.restarts[bot.name] += 1
+                    bot_list[index] = self.replace_bot(bot, reuse_session=True)
+                    self._healthy_since[bot.name] = now
+                    if self.restarts[bot.name] >= settings['max_restarts']:
+                        logger.error("Bot restarted too many times, it will not be restarted again: bot=[{}]".format(
+                            bot.name))
+
+    def _check_health(self, bot, now, healthy_seconds):
+        """
+        Resets a restarted bot's restart count once it has gone healthy_seconds without a failed work cycle.
+        """
+        if bot.consecutive_failures:
+            self._healthy_since[bot.name] = now
+        elif now - self._healthy_since.setdefault(bot.name, now) >= healthy_seconds:
+            logger.info("Bot is healthy again, resetting its restarts: bot=[{}], restarts=[{}]".format(
+                bot.name, self.restarts[bot.name]))
+            del self.restarts[bot.name]
+            del self._healthy_since[bot.name]
+
+    def replace_bot(self, bot, reuse_session=False):
+        """
+        Tells a bot to stop, and starts a new bot for the same account in its place.
+        The old thread cannot be killed, so it is left to finish (or stay blocked) on its own. Until it does, it is
+        kept with the retired bots, so it is joined when the Dispatch is joined.
+        :param reuse_session: If True, the new bot uses the old bot's Reddit session if it is still valid.
+        :return: The new bot
+        """
+        bot.stop_event.set()
+        with self._bots_lock:
+            if bot.is_alive():
+                logger.warning("Replaced bot is still running, it will be joined at shutdown: bot=[{}]".format(
+                    bot.name))
+                self.retired = [retired for retired in self.retired if retired.is_alive()] + [bot]
+            new_bot = bot.clone(reuse_session=reuse_session)
+            if not self.stop.is_set():
+                new_bot.start()
+        logger.info("Replaced bot: bot=[{}], reusedSession=[{}]".format(bot.name, new_bot.r is not None))
+        return new_bot
 
     def join(self, timeout=None):
         """
         Override of Thread.join().
-        Stops all the bots, sets the stop event, and stops itself.
+        Waits for the run loop to finish what it is doing, so it cannot start bots after they were collected.
+        Then tells every bot to stop at the same time, and waits for them all against one shared deadline,
+        so shutdown takes at most timeout seconds no matter how many bots there are.
+        Bots in the middle of a work cycle have their cycle deadline moved up to the shutdown deadline,
+        so they can finish or give up in time. Bots that miss the deadline are logged and saved in self.unfinished.
         :param timeout: Time to wait before forcefully stopping itself (wait forever if None).
         :return: Original return value of Thread.join()
         """
-        for bot_list in self.bots.values():
-            for bot in bot_list:
-                bot.join(timeout)
         self.stop.set()
-        return super(Dispatch, self).join(timeout)
+        self.comment_stream.stop_event.set()
+        self.memory_monitor.stop()
+        end = None if timeout is None else monotonic() + timeout
+        result = super(Dispatch, self).join(timeout)
+        bots = self.get_all_bots()
+        for bot in bots:
+            bot.drain(end)
+        for bot in bots:
+            if bot.ident is not None:  # bots that were never started cannot be joined
+                bot.join(None if end is None else max(0, end - monotonic()))
+        self.unfinished = [bot.name for bot in bots if bot.is_alive()]
+        if self.unfinished:
+            logger.warning("Bots did not stop before the shutdown deadline: bots=[{}]".format(
+                ", ".join(self.unfinished)))
+        cache.log_cache_stats()
+        return result
+
+    def get_all_bots(self):
+        """
+        :return: A list of the current bots and the retired bots, taken while the run loop cannot change them
+        """
+        with self._bots_lock:
+            return [bot for bot_list in self.bots.values() for bot in bot_list] + self.retired
 
 
 class GlobalDispatch(Dispatch):
@@ -96,17 +328,125 @@ class GlobalDispatch(Dispatch):
         Creates BotSignatures for every account in praw.ini, and initializes a Dispatch.
         :param stop_event: A threading.Event used to stop the Dispatch.
         """
-        signatures = [BotSignature(classname=praw_config.get_bot_class_name(name),
-                                   username=name,
-                                   permissions=praw_config.get_reddit_oauth_scope(name))
-                      for name in praw_config.get_all_site_names()]
-        super(GlobalDispatch, self).__init__(signatures, stop_event)
+        super(GlobalDispatch, self).__init__(self.get_signatures(), stop_event)
+
+    @staticmethod
+    def get_signatures():
+        """
+        :return: A BotSignature for every account in praw.ini
+        """
+        return [BotSignature(classname=praw_config.get_bot_class_name(name),
+                             username=name,
+                             permissions=praw_config.get_reddit_oauth_scope(name))
+                for name in praw_config.get_all_site_names()]
+
+    def reload_accounts(self):
+        """
+        Reads praw.ini again, and starts, stops, or replaces bots for the accounts that were added, removed, or changed.
+        If the new file is not valid, the error is logged and the running bots are left alone.
+        """
+        try:
+            signatures = self.get_signatures()
+        except (ConfigParserError, ValueError):
+            logger.exception("Invalid praw.ini, keeping the current bots")
+            return
+        praw.settings.CONFIG.read(praw_config.PRAW_FILE_PATH)  # praw only reads praw.ini when it is imported
+        try:
+            self.update_bots(signatures)
+        except InvalidBotClassName:
+            logger.exception("Invalid bot class in praw.ini, keeping the current bots")
+
+
+class ShardedDispatch(GlobalDispatch):
+    """
+    A GlobalDispatch that only runs its share of the accounts in praw.ini, so the bots can be spread over
+    several processes, on one host or on several hosts that share the lease file.
+    Accounts are assigned with consistent hashing, and a process only runs an account while it holds the
+    account's lease, so no account is run twice. If a process dies, its leases expire and the other processes
+    take over its accounts.
+    """
+    def __init__(self, coordinator=None, stop_event=None):
+        """
+        :param coordinator: A ShardCoordinator. If None, one is created from the sharding settings in bot_config.yaml.
+        :param stop_event: A threading.Event used to stop the Dispatch.
+        """
+        settings = get_sharding_config()
+        self.coordinator = coordinator or ShardCoordinator(LeaseStore.shared(settings['lease_file']),
+                                                           lease_seconds=settings['lease_seconds'],
+                                                           replicas=settings['replicas'])
+        Dispatch.__init__(self, [], stop_event)
+        # each subreddit is read by the process holding its lease, and routed to the bots of every process
+        self.comment_stream = CommentStream(leases=self.coordinator.store, worker_id=self.coordinator.worker_id)
+        for signature in self.get_signatures():
+            self.bots[signature.username] = self.create_bots(signature)
+            self.signatures[signature.username] = signature
+        logger.info("Joined the shard ring: worker=[{}], accounts=[{}]".format(self.coordinator.worker_id,
+                                                                               ", ".join(sorted(self.bots))))
+
+    def get_signatures(self):
+        """
+        Renews this process's leases and takes the leases of the accounts it now owns.
+        :return: A BotSignature for every account in praw.ini that this process should run
+        """
+        signatures = GlobalDispatch.get_signatures()
+        running = set(self.bots) | {bot.USER_NAME for bot in self.retired if bot.is_alive()}
+        owned = self.coordinator.update([signature.username for signature in signatures], running)
+        return [signature for signature in signatures if signature.username in owned]
+
+    def watch_config(self):
+        """
+        Override of Dispatch.watch_config().
+        Accounts move between processes when processes start or die, so the accounts are updated on every check,
+        not only when praw.ini changes. This also renews the leases.
+        """
+        if bot_config.bot_config_path in self.config_watcher.poll():
+            self.reload_bot_config()
+        self.reload_accounts()
+
+    def reload_accounts(self):
+        """
+        Override of GlobalDispatch.reload_accounts().
+        If the lease file cannot be used, the current bots are kept until it can.
+        """
+        try:
+            super(ShardedDispatch, self).reload_accounts()
+        except sqlite3.Error:
+            logger.exception("Could not update leases: worker=[{}]".format(self.coordinator.worker_id))
+
+    def join(self, timeout=None):
+        """
+        Override of Dispatch.join().
+        After the bots stop, this process leaves the ring and gives up its leases, so the other processes
+        take over its accounts right away. Leases of bots that did not stop are left to expire.
+        """
+        result = super(ShardedDispatch, self).join(timeout)
+        still_running = {bot.USER_NAME for bot in self.get_all_bots() if bot.is_alive()}
+        try:
+            self.coordinator.leave(keep=still_running)
+        except sqlite3.Error:
+            logger.exception("Could not give up leases: worker=[{}]".format(self.coordinator.worker_id))
+        return result
 # endregion
 
 
 def main(args=None):
+    ap = argparse.ArgumentParser(description="Run the bots for the accounts in praw.ini.")
+    ap.add_argument("--shard", action="store_true",
+                    help="Only run this process's share of the accounts. Start several processes with --shard "
+                         "to spread the accounts between them.")
+    ap.add_argument("--worker-id", help="Name of this process in the shard ring. Defaults to hostname:pid.")
+    args = ap.parse_args(args)
+
     logger.info("Starting bots")
-    with GlobalDispatch():
+    set_thread_stack_size()
+    if args.shard:
+        settings = get_sharding_config()
+        dispatch = ShardedDispatch(ShardCoordinator(LeaseStore.shared(settings['lease_file']), args.worker_id,
+                                                    settings['lease_seconds'], settings['replicas']))
+    else:
+        dispatch = GlobalDispatch()
+    install_signal_handler(dispatch.memory_monitor)
+    with dispatch:
         try:
             while True:
                 sleep(1)
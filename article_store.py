@@ -0,0 +1,245 @@
+import random
+import re
+import sqlite3
+from collections import namedtuple
+
+from store import SqliteStore
+
+DATE_IN_URL_PATTERN = re.compile(r"/(\d{4})/(\d{2})/(\d{2})/")
+StoredArticle = namedtuple('StoredArticle', 'url title year month day')
+
+
+def get_date_from_url(url):
+    """
+    upressonline.com permalinks contain the publishing date, e.g. /2016/05/12/article-title/
+    :return: A (year, month, day) tuple, or (None, None, None) if the URL has no date.
+    """
+    match = DATE_IN_URL_PATTERN.search(url)
+    return tuple(int(part) for part in match.groups()) if match else (None, None, None)
+
+
+def get_category_paths(category_name, category_subname=None):
+    """
+    An article in category/reviews/books is also in category/reviews, so it is stored under both.
+    :return: A list of category paths, e.g. ['reviews', 'reviews/books']
+    """
+    paths = [category_name]
+    if category_subname:
+        paths.append("{}/{}".format(category_name, category_subname))
+    return paths
+
+
+class ArticleStore(SqliteStore):
+    """
+    A local index of articles discovered on upressonline.com, filled by the backfill crawler and by NewsBot.
+    Every article has a random key, and random articles are picked by seeking to a random key in an index on the date
+    or category and the key, so a pick reads a few index entries however many articles match.
+    Titles are indexed for full-text search, and submissions are recorded so articles that were already shared can
+    be skipped.
+    It also keeps crawl checkpoints so an interrupted backfill can resume where it stopped.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS articles (
+            url TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            year INTEGER,
+            month INTEGER,
+            day INTEGER,
+            rand_key REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS articles_date ON articles (year, month, day, rand_key);
+        CREATE INDEX IF NOT EXISTS articles_month_key ON articles (year, month, rand_key);
+        CREATE INDEX IF NOT EXISTS articles_year_key ON articles (year, rand_key);
+        CREATE TABLE IF NOT EXISTS article_categories (
+            category TEXT NOT NULL,
+            url TEXT NOT NULL,
+            rand_key REAL NOT NULL,  -- a copy of the article's rand_key, so it can be indexed with the category
+            PRIMARY KEY (category, url)
+        );
+        CREATE INDEX IF NOT EXISTS article_categories_key ON article_categories (category, rand_key);
+        CREATE TABLE IF NOT EXISTS submissions (
+            url TEXT NOT NULL,
+            subreddit TEXT NOT NULL,
+            submitted_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (url, subreddit)
+        );
+        CREATE TABLE IF NOT EXISTS crawl_checkpoints (
+            archive_url TEXT PRIMARY KEY,
+            next_page INTEGER NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0
+        );
+    """
+
+    FULL_TEXT_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING fts5(title, content='articles', content_rowid='rowid');
+        CREATE TRIGGER IF NOT EXISTS articles_fts_insert AFTER INSERT ON articles BEGIN
+            INSERT INTO articles_fts (rowid, title) VALUES (new.rowid, new.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS articles_fts_delete AFTER DELETE ON articles BEGIN
+            INSERT INTO articles_fts (articles_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+        END;
+    """
+
+    def __init__(self, file_name):
+        super(ArticleStore, self).__init__(file_name)
+        self.has_full_text = self._create_full_text_index()
+
+    def _create_full_text_index(self):
+        """
+        Creates the FTS5 title index if this SQLite build supports it.
+        :return: False if FTS5 is unavailable, in which case search() falls back to LIKE.
+        """
+        with self._lock:
+            is_new = not self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'articles_fts'").fetchone()
+            try:
+                self._conn.executescript(self.FULL_TEXT_SCHEMA)
+            except sqlite3.OperationalError:
+                return False
+            if is_new:
+                self._conn.execute("INSERT INTO articles_fts (articles_fts) VALUES ('rebuild')")
+        return True
+
+    def add_articles(self, links, categories=()):
+        """
+        Saves Links to the store. Links that are already stored keep their date, and gain any new categories.
+        :param links: An iterable of Links (namedtuples with url and title)
+        :param categories: Category paths the links were found in, e.g. ['reviews', 'reviews/books']
+        """
+        with self.transaction() as conn:
+            self._insert_articles(conn, links, categories)
+
+    @staticmethod
+    def _insert_articles(conn, links, categories):
+        rows = [(link.url, link.title) + get_date_from_url(link.url) + (random.random(),) for link in links]
+        conn.executemany("INSERT OR IGNORE INTO articles (url, title, year, month, day, rand_key) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        conn.executemany("INSERT OR IGNORE INTO article_categories (category, url, rand_key) "
+                         "SELECT ?, url, rand_key FROM articles WHERE url = ?",
+                         [(category, row[0]) for row in rows for category in categories])
+
+    def add_crawled_page(self, archive_url, next_page, links, categories=(), done=False):
+        """
+        Saves the Links found on one archive page together with the crawl checkpoint, in a single transaction,
+        so a resumed crawl never skips a page whose links were not saved.
+        :param archive_url: URL of the first page of the archive
+        :param next_page: Number of the next page to crawl
+        :param done: True if the last page of the archive has been crawled
+        """
+        with self.transaction() as conn:
+            self._insert_articles(conn, links, categories)
+            conn.execute("INSERT OR REPLACE INTO crawl_checkpoints (archive_url, next_page, done) VALUES (?, ?, ?)",
+                         (archive_url, next_page, int(done)))
+
+    @staticmethod
+    def _get_date_filter(year, month=None, day=None):
+        """
+        :return: A (sql, params) tuple that filters articles by date, matching the date index.
+        """
+        sql = "a.year = ?"
+        params = [year]
+        if month:
+            sql += " AND a.month = ?"
+            params.append(month)
+            if day:
+                sql += " AND a.day = ?"
+                params.append(day)
+        return sql, params
+
+    def get_articles_by_date(self, year, month=None, day=None):
+        """
+        :return: A list of StoredArticles published on a date. Month and day are optional.
+        """
+        sql, params = self._get_date_filter(year, month, day)
+        return [StoredArticle(*row) for row in self.execute(
+            "SELECT a.url, a.title, a.year, a.month, a.day FROM articles a WHERE " + sql, params)]
+
+    def get_articles_by_category(self, category_name, category_subname=None):
+        """
+        :return: A list of StoredArticles in a category, or in a subcategory if category_subname is given.
+        """
+        category = get_category_paths(category_name, category_subname)[-1]
+        return [StoredArticle(*row) for row in self.execute(
+            "SELECT a.url, a.title, a.year, a.month, a.day FROM article_categories c "
+            "JOIN articles a ON a.url = c.url WHERE c.category = ?", (category,))]
+
+    def _get_random(self, from_sql, where_sql, params, key_column, unsubmitted_to):
+        """
+        Picks a random article: the first matching article whose random key is at or after a random number, or the
+        first matching article if there is none after it. The index on the filter and the key finds it without
+        reading the other matches. Submitted articles are skipped with lookups in the submissions primary key.
+        The picked article gets a new random key, so an article that owns a wide gap between keys does not keep
+        being picked more often than the others.
+        :param key_column: The rand_key column that is indexed with the filter, e.g. "c.rand_key"
+        :param unsubmitted_to: A list of subreddits. If given, articles submitted to all of them are skipped.
+        :return: A StoredArticle, or None if no article matches.
+        """
+        sql = "SELECT a.url, a.title, a.year, a.month, a.day FROM {} WHERE {}".format(from_sql, where_sql)
+        params = list(params)
+        if unsubmitted_to:
+            sql += " AND (SELECT COUNT(*) FROM submissions s WHERE s.url = a.url AND s.subreddit IN ({})) < ?".format(
+                ", ".join("?" * len(unsubmitted_to)))
+            params += list(unsubmitted_to) + [len(unsubmitted_to)]
+        order_sql = " ORDER BY {} LIMIT 1".format(key_column)
+        with self.transaction() as conn:
+            row = conn.execute(sql + " AND {} >= ?".format(key_column) + order_sql,
+                               params + [random.random()]).fetchone() or \
+                conn.execute(sql + order_sql, params).fetchone()
+            if row is None:
+                return None
+            new_key = random.random()
+            conn.execute("UPDATE articles SET rand_key = ? WHERE url = ?", (new_key, row['url']))
+            conn.execute("UPDATE article_categories SET rand_key = ? WHERE url = ?", (new_key, row['url']))
+        return StoredArticle(*row)
+
+    def get_random_article_by_date(self, year, month=None, day=None, unsubmitted_to=None):
+        """
+        :param unsubmitted_to: A list of subreddits. If given, articles submitted to all of them are skipped.
+        :return: A random StoredArticle published on a date, or None if there is none. Month and day are optional.
+        """
+        where_sql, params = self._get_date_filter(year, month, day)
+        return self._get_random("articles a", where_sql, params, "a.rand_key", unsubmitted_to)
+
+    def get_random_article_by_category(self, category_name, category_subname=None, unsubmitted_to=None):
+        """
+        :param unsubmitted_to: A list of subreddits. If given, articles submitted to all of them are skipped.
+        :return: A random StoredArticle in a category, or None if there is none.
+        """
+        category = get_category_paths(category_name, category_subname)[-1]
+        return self._get_random("article_categories c JOIN articles a ON a.url = c.url", "c.category = ?",
+                                [category], "c.rand_key", unsubmitted_to)
+
+    def search(self, query, limit=25):
+        """
+        Finds articles whose titles contain all the words in a query.
+        :param query: Words to search for, e.g. 'football homecoming'
+        :param limit: Maximum number of articles returned
+        :return: A list of StoredArticles, best matches first.
+        """
+        words = query.split()
+        if not words:
+            return []
+        if self.has_full_text:
+            match = " ".join('"{}"'.format(word.replace('"', '""')) for word in words)
+            rows = self.execute("SELECT a.url, a.title, a.year, a.month, a.day FROM articles_fts f "
+                                "JOIN articles a ON a.rowid = f.rowid WHERE articles_fts MATCH ? "
+                                "ORDER BY f.rank LIMIT ?", (match, limit))
+        else:
+            rows = self.execute("SELECT a.url, a.title, a.year, a.month, a.day FROM articles a WHERE " +
+                                " AND ".join("a.title LIKE ?" for _ in words) + " LIMIT ?",
+                                ["%{}%".format(word) for word in words] + [limit])
+        return [StoredArticle(*row) for row in rows]
+
+    def mark_submitted(self, url, subreddit):
+        self.execute("INSERT OR IGNORE INTO submissions (url, subreddit) VALUES (?, ?)", (url, subreddit))
+
+    def is_submitted(self, url, subreddit):
+        return bool(self.execute("SELECT 1 FROM submissions WHERE url = ? AND subreddit = ?", (url, subreddit)))
+
+    def get_checkpoint(self, archive_url):
+        """
+        :return: A (next_page, done) tuple for an archive, or (1, False) if it has never been crawled.
+        """
+        rows = self.execute("SELECT next_page, done FROM crawl_checkpoints WHERE archive_url = ?", (archive_url,))
+        return (rows[0]['next_page'], bool(rows[0]['done'])) if rows else (1, False)
@@ -0,0 +1,184 @@
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import monotonic, sleep
+from urllib.parse import urlparse
+
+import requests
+
+from article_store import ArticleStore, get_category_paths
+from config import getLogger
+from config.bot_config import get_backfill_config, get_newsbot_config
+from http_cache import UpstreamError
+from newsbot import NEWS_BASE_URL, parse_link_list
+
+logger = getLogger()
+FIRST_ARCHIVE_YEAR = 1995
+
+
+class HostLimiter(object):
+    """
+    Keeps a crawler polite: at most max_concurrent requests are in flight to one host,
+    and requests to the same host start at least min_delay seconds apart.
+    """
+    def __init__(self, max_concurrent=2, min_delay=1.0):
+        self.max_concurrent = max_concurrent
+        self.min_delay = min_delay
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_start = {}
+
+    def _get_semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_concurrent)
+            return self._semaphores[host]
+
+    def get(self, url, timeout=None):
+        """
+        Makes a GET request once the host's limits allow it.
+        :return: A requests.Response
+        """
+        host = urlparse(url).netloc
+        with self._get_semaphore(host):
+            with self._lock:
+                now = monotonic()
+                start = max(now, self._next_start.get(host, now))
+                self._next_start[host] = start + self.min_delay
+            if start > now:
+                sleep(start - now)
+            return requests.get(url, timeout=timeout)
+
+
+class BackfillCrawler(object):
+    """
+    Walks upressonline.com's date and category archives, including every /page/N of each archive,
+    and saves the articles it finds in the ArticleStore. Archives are crawled concurrently, and progress is
+    checkpointed after every page so an interrupted crawl resumes where it stopped.
+    """
+    def __init__(self, store, base_url=NEWS_BASE_URL, max_workers=4, max_requests_per_host=2, min_delay=1.0,
+                 timeout=30):
+        """
+        :param store: The ArticleStore to save articles in.
+        :param max_workers: Number of archives crawled at the same time.
+        :param max_requests_per_host: Number of requests in flight to one host at the same time.
+        :param min_delay: Minimum number of seconds between the starts of two requests to one host.
+        :param timeout: Seconds to wait for a response.
+        """
+        self.store = store
+        self.base_url = base_url
+        self.max_workers = max_workers
+        self.limiter = HostLimiter(max_requests_per_host, min_delay)
+        self.timeout = timeout
+        self.stop_event = threading.Event()
+
+    def get_date_archives(self, first_year=FIRST_ARCHIVE_YEAR, last_date=None):
+        """
+        :return: A list of monthly archive URLs, newest first, e.g. http://www.upressonline.com/2016/05
+        """
+        last_date = last_date or datetime.date.today()
+        return ["{}/{}/{:02}".format(self.base_url, year, month)
+                for year in range(last_date.year, first_year - 1, -1)
+                for month in range(12, 0, -1)
+                if (year, month) <= (last_date.year, last_date.month)]
+
+    def get_category_archive(self, category_name, category_subname=None):
+        return "{}/category/{}".format(self.base_url, get_category_paths(category_name, category_subname)[-1])
+
+    def crawl(self, archives):
+        """
+        Crawls archives concurrently until they are done or stop_event is set.
+        :param archives: A list of (archive_url, categories, always_refresh) tuples
+        :return: Total number of links found
+        """
+        total = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.crawl_archive, *archive): archive[0] for archive in archives}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        total += future.result()
+                    except (requests.RequestException, UpstreamError):
+                        logger.exception("Archive crawl failed, it will resume from its checkpoint: url=[{}]".format(
+                            futures[future]))
+            except KeyboardInterrupt:
+                self.stop_event.set()
+                for future in futures:
+                    future.cancel()
+                raise
+        return total
+
+    def crawl_archive(self, archive_url, categories=(), always_refresh=False):
+        """
+        Crawls every page of one archive, starting from its checkpoint.
+        :param archive_url: URL of the first page of the archive
+        :param categories: Category paths to save with the links found in the archive
+        :param always_refresh: If True, the archive is never marked done because new articles may still be added
+                               to it, e.g. the current month or a category. It is crawled from page 1 again next time.
+        :raises UpstreamError if the HTTP response is anything but 200 OK or 404 Not Found.
+        :return: Number of links found
+        """
+        page, done = self.store.get_checkpoint(archive_url)
+        if done:
+            return 0
+        found = 0
+        while not self.stop_event.is_set():
+            url = archive_url if page == 1 else "{}/page/{}".format(archive_url, page)
+            r = self.limiter.get(url, timeout=self.timeout)
+            if r.status_code == requests.codes.not_found:
+                links = []
+            elif r.status_code == requests.codes.ok:
+                links = parse_link_list(r.content)
+            else:
+                raise UpstreamError("Error talking to UPress: url=[{}], code=[{}]".format(url, r.status_code))
+            last_page = not links
+            if last_page:
+                next_page = 1 if always_refresh else page
+            else:
+                next_page = page + 1
+            self.store.add_crawled_page(archive_url, next_page, links, categories,
+                                        done=last_page and not always_refresh)
+            found += len(links)
+            if last_page:
+                logger.info("Crawled archive: url=[{}], pages=[{}], links=[{}]".format(archive_url, page - 1, found))
+                break
+            page += 1
+        return found
+
+
+def main():
+    import argparse
+    settings = get_backfill_config()
+    ap = argparse.ArgumentParser(description="Save every article in upressonline.com's archives to the article store.")
+    ap.add_argument("--first-year", type=int, default=FIRST_ARCHIVE_YEAR,
+                    help="Oldest year of date archives to crawl.")
+    ap.add_argument("--categories", nargs="*", default=settings['categories'],
+                    help="Category archives to crawl, e.g. news sports/baseball.")
+    ap.add_argument("--skip-dates", action="store_true", help="Only crawl category archives.")
+    args = ap.parse_args()
+
+    store = ArticleStore.shared(get_newsbot_config()['article_store_file'])
+    crawler = BackfillCrawler(store, max_workers=settings['max_workers'],
+                              max_requests_per_host=settings['max_requests_per_host'],
+                              min_delay=settings['min_delay_seconds'], timeout=settings['request_timeout_seconds'])
+    archives = []
+    if not args.skip_dates:
+        date_archives = crawler.get_date_archives(args.first_year)
+        # the newest month can still get new articles, so it is never marked done
+        archives += [(url, (), url == date_archives[0]) for url in date_archives]
+    for category in args.categories:
+        category_name, _, category_subname = category.partition("/")
+        archives.append((crawler.get_category_archive(category_name, category_subname or None),
+                         get_category_paths(category_name, category_subname or None), True))
+    logger.info("Starting backfill: archives=[{}]".format(len(archives)))
+    try:
+        total = crawler.crawl(archives)
+    except KeyboardInterrupt:
+        crawler.stop_event.set()
+        logger.info("Backfill interrupted, it will resume from the last checkpoint.")
+    else:
+        logger.info("Backfill finished: links=[{}]".format(total))
+
+
+if __name__ == '__main__':
+    main()
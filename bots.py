@@ -1,17 +1,28 @@
+import random
+import sqlite3
 import threading
 import praw
+import requests
+import tracing
+from praw.decorators import restrict_access
+from praw.handlers import DefaultHandler
 from abc import ABCMeta, abstractmethod
 from collections import namedtuple
-from time import sleep
+from time import monotonic, sleep, time
 
 from config import getLogger
-from config.bot_config import CONFIG, get_user_agent
+from config.bot_config import get_flag, get_interval, get_user_agent
+from config.bot_config import get_outbox_config, get_reddit_config, get_supervisor_config
+from deadline import Deadline, DeadlineExceeded, get_timeout, set_deadline
+from http_cache import UpstreamError
+from outbox import EDIT, PRIORITY_EDIT, PRIORITY_REPLY, PRIORITY_SUBMIT, REPLY, SEND_MESSAGE, SUBMIT, Outbox
 
 logger = getLogger()  # you will need this to use logger functions
 BotSignature = namedtuple('BotSignature', 'classname username permissions')
-
-DEFAULT_SLEEP_INTERVAL = CONFIG['intervals']['sleep_interval_seconds']
-RUN_BOTS_ONCE = CONFIG['flags']['run_bots_once']
+_outbox_locks = {}  # username -> Lock, so a bot and the bot replacing it never send the same action twice
+_outbox_locks_lock = threading.Lock()
+_shared_handler = None
+_shared_handler_lock = threading.Lock()
 
 
 # region EXCEPTIONS
@@ -21,9 +32,105 @@ class MissingRefreshTokenError(ValueError):
 
 class InvalidBotClassName(ValueError):
     pass
+
+
+TRANSIENT_ERRORS = (requests.RequestException, UpstreamError, DeadlineExceeded, ConnectionError,
+                    sqlite3.OperationalError, praw.errors.HTTPException, praw.errors.RateLimitExceeded,
+                    praw.errors.OAuthException)
+"""Errors that are expected to go away on their own, e.g. network problems or Reddit/UPress being down.
+An expired access token (OAuthException) goes away by logging in again, which the next work cycle does."""
+
+FATAL_ERRORS = (MissingRefreshTokenError, InvalidBotClassName, praw.errors.OAuthInvalidGrant,
+                praw.errors.OAuthInsufficientScope)
+"""Errors that neither retrying nor restarting can fix, e.g. a revoked refresh token or a scope the account was not
+given. account_register.py must be run for the account again."""
+
+
+def is_transient_error(error):
+    return isinstance(error, TRANSIENT_ERRORS) and not isinstance(error, FATAL_ERRORS)
+
+
+def is_restartable_error(error):
+    """
+    :return: False if restarting a bot that failed with this error cannot help, e.g. because it has no refresh token.
+    """
+    return not isinstance(error, FATAL_ERRORS)
+
+
+def get_backoff_delay(attempt, base_seconds, max_seconds):
+    """
+    Exponential backoff with full jitter: a random delay between 0 and base_seconds * 2^attempt, capped at max_seconds.
+    The jitter stops many bots that failed together from retrying together.
+    :param attempt: Number of failures in a row, starting at 1
+    :return: Number of seconds to wait
+    """
+    return random.uniform(0, min(max_seconds, base_seconds * 2 ** (attempt - 1)))
+
+
+def _get_outbox_lock(username):
+    with _outbox_locks_lock:
+        return _outbox_locks.setdefault(username, threading.Lock())
 # endregion
 
 
+class DeadlineHandler(DefaultHandler):
+    """
+    A praw request handler that shortens each request's timeout so Reddit API calls
+    cannot outlast the deadline of the work cycle that made them.
+    """
+    def request(self, *args, **kwargs):
+        max_timeout = get_interval('http_timeout_seconds')
+        kwargs['timeout'] = get_timeout(min(kwargs.get('timeout') or max_timeout, max_timeout))
+        # praw passes every argument by keyword, the prepared request included
+        with tracing.span("reddit.request", url=getattr(kwargs.get('request'), 'url', None)):
+            return super(DeadlineHandler, self).request(*args, **kwargs)
+
+
+def get_shared_handler():
+    """
+    The DeadlineHandler that every praw.Reddit in the process sends its requests through, so all accounts share one
+    connection pool instead of each account holding its own. The handler keeps no state of its own for an account:
+    each account's praw.Reddit adds its user agent and OAuth token to a request before handing it over, and the
+    handler's deadline is read from the calling thread.
+    """
+    global _shared_handler
+    with _shared_handler_lock:
+        if _shared_handler is None:
+            _shared_handler = DeadlineHandler()
+        return _shared_handler
+
+
+def create_reddit(user_agent, site_name=None):
+    """
+    Creates a praw.Reddit that uses the shared handler. praw's check for a newer version is skipped, because it makes
+    a request and keeps its results for each instance.
+    :param site_name: A section of praw.ini, i.e. an account's username, or None for a logged out session.
+    """
+    return praw.Reddit(user_agent=user_agent, site_name=site_name, handler=get_shared_handler(),
+                       disable_update_check=True)
+
+
+@restrict_access(scope='edit')
+def edit_thing(reddit, fullname, text):
+    """
+    Replaces the text of a comment or self post the way praw's edit() does, but by fullname, so the thing does not
+    have to be read first.
+    :param reddit: The praw.Reddit of the thing's author
+    """
+    response = reddit.request_json(reddit.config['edit'], data={'thing_id': fullname, 'text': text})
+    reddit.evict(reddit.config['user'])
+    return response['data']['things'][0]
+
+
+def set_thread_stack_size():
+    """
+    Sets the stack size of threads started from now on, e.g. bots, to the one in bot_config.yaml.
+    """
+    size_kb = get_reddit_config()['thread_stack_size_kb']
+    threading.stack_size(size_kb * 1024)
+    logger.info("Thread stack size set: sizeKb=[{}]".format(size_kb or "default"))
+
+
 # region BASECLASSES
 class Bot(threading.Thread, metaclass=ABCMeta):
     """
@@ -41,9 +148,14 @@ class Bot(threading.Thread, metaclass=ABCMeta):
         """
         super(Bot, self).__init__(daemon=True)
         self.stop_event = threading.Event()
-        self.sleep_interval = DEFAULT_SLEEP_INTERVAL
+        self.sleep_interval = get_interval('sleep_interval_seconds')
         self._reset_sleep_interval = reset_sleep_interval
-        self._run_once = RUN_BOTS_ONCE or run_once
+        self._run_once = get_flag('run_bots_once') or run_once
+        self.deadline = None  # the Deadline of the current work cycle, or None between cycles
+        self.overruns = 0
+        self.consecutive_failures = 0
+        self.failure = None  # the error that stopped the bot, if any
+        self.stop_by = None  # the time.monotonic() value the bot was told to stop by, if any
 
     @abstractmethod
     def work(self):
@@ -60,15 +172,110 @@ class Bot(threading.Thread, metaclass=ABCMeta):
         This is called automatically when the thread's start()
         method is invoked. This function repeatedly calls self.work()
         until something tells it to stop.
+        Transient errors (see TRANSIENT_ERRORS) are retried with exponential backoff. Any other error stops the bot
+        and is saved in self.failure, so Dispatch can restart it.
         """
-        while not self.stop_event.is_set():
-            if self._reset_sleep_interval:
-                self.sleep_interval = DEFAULT_SLEEP_INTERVAL
-            self.work()
-            if self._run_once:
-                self.stop_event.set()
-            else:
-                self.stop_event.wait(self.sleep_interval)
+        try:
+            while not self.stop_event.is_set():
+                if self._reset_sleep_interval:
+                    self.sleep_interval = get_interval('sleep_interval_seconds')
+                try:
+                    self.run_cycle()
+                except Exception as e:
+                    if not is_transient_error(e):
+                        raise
+                    delay = self._get_retry_delay(e)
+                else:
+                    self.consecutive_failures = 0
+                    delay = self.sleep_interval
+                if self._run_once:  # a run once bot is not retried, even if its cycle failed
+                    self.stop_event.set()
+                else:
+                    self.stop_event.wait(delay)
+        except Exception as e:
+            self.failure = e
+            logger.exception("Bot stopped by an error: bot=[{}]".format(self.name))
+
+    def _get_retry_delay(self, error):
+        """
+        Counts a failed work cycle and works out how long to wait before trying again.
+        If Reddit said how long to wait because of its rate limit, at least that long is waited.
+        :return: Number of seconds
+        """
+        self.consecutive_failures += 1
+        settings = get_supervisor_config()
+        delay = get_backoff_delay(self.consecutive_failures, settings['backoff_base_seconds'],
+                                  settings['backoff_max_seconds'])
+        delay = max(delay, getattr(error, 'sleep_time', 0) or 0)
+        logger.warning("Work cycle failed, retrying: bot=[{}], error=[{!r}], failures=[{}], delay=[{:.1f}s]".format(
+            self.name, error, self.consecutive_failures, delay))
+        return delay
+
+    def run_cycle(self):
+        """
+        Calls self.work() once with a deadline. Blocking calls made by work() use the deadline to limit their
+        timeouts, and work() may call self.check_deadline() between steps to give up once it has passed.
+        Then self.after_work() is called, without the deadline.
+        A sample of cycles are traced (see tracing.py), with the whole cycle as the root span, so the spans of
+        after_work() are part of the trace too.
+        """
+        with tracing.trace("cycle", bot=self.name):
+            self.deadline = Deadline(get_interval('work_deadline_seconds'))
+            set_deadline(self.deadline)
+            try:
+                with tracing.span("work"):
+                    self.work()
+            except DeadlineExceeded:
+                self.overruns += 1
+                logger.warning("Work cycle skipped after its deadline: bot=[{}], overruns=[{}]".format(
+                    self.name, self.overruns))
+            finally:
+                set_deadline(None)
+                self.deadline = None
+            self.after_work()
+
+    def after_work(self):
+        """
+        Called after each work cycle, in the same trace. Does nothing unless overridden.
+        """
+        pass
+
+    def apply_config(self):
+        """
+        Called by Dispatch after bot_config.yaml is reloaded. Bots that copy settings into attributes
+        (e.g. self.subreddits) should override this to copy them again. Settings that are read every cycle,
+        like the sleep interval, need nothing.
+        """
+        pass
+
+    def check_deadline(self):
+        """
+        :raises DeadlineExceeded if the current work cycle has passed its deadline
+        """
+        deadline = self.deadline
+        if deadline:
+            deadline.check()
+
+    def is_overrun(self, grace_seconds=0):
+        """
+        Used by the watchdog to find bots whose work cycle is stuck.
+        :param grace_seconds: How long past the deadline the cycle may run before it is considered stuck.
+        :return: True if the bot is in a work cycle that is more than grace_seconds past its deadline.
+        """
+        deadline = self.deadline
+        return deadline is not None and deadline.remaining() < -grace_seconds
+
+    def drain(self, end=None):
+        """
+        Tells the bot to stop after its current work cycle, without waiting for it.
+        :param end: A time.monotonic() value the current work cycle must finish by, or None to let it run
+                    until its own deadline.
+        """
+        self.stop_event.set()
+        self.stop_by = end
+        deadline = self.deadline
+        if deadline and end is not None:
+            deadline.shorten(end)
 
     def join(self, timeout=None):
         """
@@ -89,6 +296,7 @@ class RedditBot(Bot):
     """
 
     debug_user_agent_template = '/u/{username} prototyping an automated reddit user'
+    COMMENT_PATTERN = None  # a compiled regular expression, if the bot answers commands in subreddit comments
 
     def __init__(self, user_name=None, *args, **kwargs):
         """
@@ -100,6 +308,9 @@ class RedditBot(Bot):
         self.USER_NAME = user_name or 'FAUbot'
         self.USER_AGENT = get_user_agent(self.__class__.__name__)
         self.r = None  # the praw.Reddit instance
+        self.name = "{}/{}".format(self.__class__.__name__, self.USER_NAME)
+        self.outbox = Outbox.shared(get_outbox_config()['file_name'])
+        self.comments = None  # the stream.RoutedComments of the comments matching COMMENT_PATTERN, set by Dispatch
 
     @abstractmethod
     def work(self):
@@ -120,15 +331,204 @@ class RedditBot(Bot):
             yield from subclass.get_subclasses()
             yield subclass
 
+    def clone(self, reuse_session=False):
+        """
+        Creates a new bot of the same class for the same Reddit account, e.g. to replace a stuck or failed bot.
+        :param reuse_session: If True and this bot's Reddit session is still valid, the new bot uses it
+                              instead of logging in again.
+        """
+        new_bot = self.__class__(user_name=self.USER_NAME)
+        new_bot.comments = self.comments
+        if reuse_session and self.has_valid_session():
+            new_bot.r = self.r
+        return new_bot
+
+    def get_routed_comments(self):
+        """
+        :return: A list of the stream.StreamComments routed to the bot that it has not marked handled, oldest first.
+        """
+        return self.comments.get() if self.comments is not None else []
+
+    def mark_comments_handled(self, comments):
+        """
+        Tells the comment stream that routed comments were handled, so they are not returned again. Until then they
+        are kept, and a bot that replaces this one gets them.
+        :param comments: A list of stream.StreamComments
+        """
+        if self.comments is not None and comments:
+            self.comments.remove([comment.fullname for comment in comments])
+
     def run(self):
         """
         An override of Bot.run().
-        This method first logs into Reddit
-        before entering the run loop.
-        :return: value of Bot.run()
+        When the bot stops, the actions still in its outbox are sent, until the time it was told to stop by.
+        Actions that are not sent stay in the outbox for the next bot using the account.
+        """
+        super(RedditBot, self).run()
+        seconds = None if self.stop_by is None else self.stop_by - monotonic()
+        if self.r is None or (seconds is not None and seconds <= 0):
+            return
+        try:
+            self.flush_outbox(seconds)
+        except Exception:
+            logger.exception("Could not send outbox before stopping: bot=[{}]".format(self.name))
+        logger.info("Bot stopped: bot=[{}], unsentActions=[{}]".format(self.name, self.outbox.count(self.USER_NAME)))
+
+    def run_cycle(self):
+        """
+        An override of Bot.run_cycle().
+        This method first logs into Reddit if the bot is not logged in yet, so failed logins are retried like any
+        other failed cycle. If Reddit rejects the access token, the bot logs in again on the next cycle.
+        After work(), the Reddit writes it queued in the outbox are sent, see after_work().
         """
         self.login()
-        return super(RedditBot, self).run()
+        try:
+            super(RedditBot, self).run_cycle()
+        except praw.errors.OAuthException:
+            self.r = None
+            raise
+
+    # region OUTBOX
+    def queue_submit(self, subreddit, title, url=None, text=None, coalesce_key=None):
+        """
+        Queues a link or self post to be sent after the work cycle.
+        :param coalesce_key: If a submission with the same key is still waiting, it is replaced by this one.
+        """
+        self.outbox.add(self.USER_NAME, SUBMIT, subreddit, {'title': title, 'url': url, 'text': text},
+                        PRIORITY_SUBMIT, coalesce_key)
+
+    def queue_edit(self, thing, text):
+        """
+        Queues an edit of a post or comment to be sent after the work cycle.
+        Edits of the same post that are waiting are replaced, so only the last one is sent.
+        :param thing: A praw Submission or Comment, or its fullname
+        """
+        fullname = getattr(thing, 'fullname', thing)
+        self.outbox.add(self.USER_NAME, EDIT, fullname, {'text': text}, PRIORITY_EDIT, "edit:" + fullname)
+
+    def queue_message(self, recipient, subject, message, coalesce_key=None, context=None):
+        """
+        Queues a private message. Messages are sent before submissions and edits.
+        :param recipient: A username or praw Redditor
+        :param context: Anything JSON serializable the bot wants back in on_action_sent(), as action.payload['context']
+        """
+        self.outbox.add(self.USER_NAME, SEND_MESSAGE, str(recipient),
+                        {'subject': subject, 'message': message, 'context': context}, PRIORITY_REPLY, coalesce_key)
+
+    def queue_reply(self, fullname, text, coalesce_key=None, context=None):
+        """
+        Queues a reply to a comment, post, or message. Replies are sent before submissions and edits.
+        :param fullname: Fullname of the thing to reply to, e.g. t1_d2x0k9l
+        :param context: Anything JSON serializable the bot wants back in on_action_sent(), as action.payload['context']
+        """
+        self.outbox.add(self.USER_NAME, REPLY, fullname, {'text': text, 'context': context}, PRIORITY_REPLY,
+                        coalesce_key)
+
+    def after_work(self):
+        """
+        An override of Bot.after_work(). Sends the Reddit writes that work() queued in the outbox.
+        """
+        self.flush_outbox()
+
+    def flush_outbox(self, seconds=None):
+        """
+        Sends the account's queued actions, highest priority first, with a deadline of its own.
+        If Reddit's rate limit is hit, the actions wait as long as Reddit asks. Other transient errors are retried
+        with backoff, up to max_attempts times. Actions that fail with any other error are dropped.
+        :param seconds: How long sending may take. Defaults to the work cycle deadline.
+        """
+        lock = _get_outbox_lock(self.USER_NAME)
+        seconds = get_interval('work_deadline_seconds') if seconds is None else seconds
+        if not lock.acquire(timeout=seconds):
+            return
+        self.deadline = Deadline(seconds)
+        set_deadline(self.deadline)
+        try:
+            self._send_pending_actions()
+        except DeadlineExceeded:
+            logger.warning("Outbox not finished before its deadline: bot=[{}]".format(self.name))
+        finally:
+            set_deadline(None)
+            self.deadline = None
+            lock.release()
+
+    def _send_pending_actions(self):
+        settings = get_outbox_config()
+        sent = set()
+        while True:
+            actions = [action for action in self.outbox.get_pending(self.USER_NAME, settings['batch_size'])
+                       if action.id not in sent]
+            if not actions:
+                return
+            for action in actions:
+                self.check_deadline()
+                try:
+                    self._send_action(action)
+                except praw.errors.RateLimitExceeded as e:
+                    logger.warning("Rate limited, outbox paused: bot=[{}], delay=[{}s]".format(self.name,
+                                                                                           e.sleep_time))
+                    self.outbox.retry(action, time() + e.sleep_time, count_attempt=False)
+                    return
+                except (DeadlineExceeded, praw.errors.OAuthException):
+                    raise  # the action was not sent, and is tried again on the next flush
+                except Exception as e:
+                    if is_transient_error(e) and action.attempts + 1 < settings['max_attempts']:
+                        supervisor = get_supervisor_config()
+                        delay = get_backoff_delay(action.attempts + 1, supervisor['backoff_base_seconds'],
+                                                  supervisor['backoff_max_seconds'])
+                        logger.warning("Outbox action failed, retrying: bot=[{}], kind=[{}], error=[{!r}], "
+                                       "delay=[{:.1f}s]".format(self.name, action.kind, e, delay))
+                        self.outbox.retry(action, time() + delay)
+                    else:
+                        logger.exception("Dropped outbox action: bot=[{}], kind=[{}], target=[{}]".format(
+                            self.name, action.kind, action.target))
+                        self.outbox.complete(action)
+                        self.on_action_dropped(action)
+                    continue
+                self.outbox.complete(action)
+                sent.add(action.id)
+                self.on_action_sent(action)
+
+    def _send_action(self, action):
+        """
+        Makes the praw call of a queued action. Edits and replies are sent by fullname, with no read of their target.
+        """
+        with tracing.span("praw." + action.kind, target=action.target):
+            if action.kind == SUBMIT:
+                self.r.submit(action.target, action.payload['title'], url=action.payload['url'],
+                              text=action.payload['text'])
+            elif action.kind == EDIT:
+                edit_thing(self.r, action.target, action.payload['text'])
+            elif action.kind == REPLY:
+                # what praw's reply() calls, with the scope checks for comments and messages
+                self.r._add_comment(action.target, action.payload['text'])
+            elif action.kind == SEND_MESSAGE:
+                self.r.send_message(action.target, action.payload['subject'], action.payload['message'])
+            else:
+                raise ValueError("Unknown outbox action: kind=[{}]".format(action.kind))
+
+    def on_action_sent(self, action):
+        """
+        Called after a queued action is sent. Bots override this to record what was sent.
+        :param action: An outbox.Action
+        """
+        pass
+
+    def on_action_dropped(self, action):
+        """
+        Called after a queued action is given up on, and removed from the outbox without being sent.
+        Bots override this so whatever waits for the action does not wait forever.
+        :param action: An outbox.Action
+        """
+        pass
+    # endregion
+
+    def has_valid_session(self):
+        """
+        :return: True if the bot's Reddit session can be handed to a replacement bot instead of logging in again.
+        """
+        return self.r is not None and self.r.is_oauth_session() and \
+            not isinstance(self.failure, praw.errors.OAuthException)
 
     def login(self):
         """
@@ -148,7 +548,7 @@ class RedditBot(Bot):
         :return: A Reddit instance with an authenticated user.
         """
         logger.info("Logging into Reddit: username=[{}], useragent=[{}]".format(self.USER_NAME, self.USER_AGENT))
-        r = praw.Reddit(user_agent=self.USER_AGENT, site_name=self.USER_NAME)
+        r = create_reddit(self.USER_AGENT, self.USER_NAME)
         try:
             current_access_info = r.refresh_access_information()
         except praw.errors.HTTPException:
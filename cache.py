@@ -0,0 +1,264 @@
+import threading
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from time import monotonic
+
+from config import getLogger
+from config.bot_config import get_cache_config, get_cache_configs
+
+logger = getLogger()
+CacheStats = namedtuple('CacheStats', 'name size maxsize ttl policy hits misses evictions hit_rate')
+EVICTION_POLICIES = ('lru', 'fifo')
+
+
+class InvalidCachePolicy(ValueError):
+    pass
+
+
+class _Flight(object):
+    """
+    A single in-progress load. Callers that ask for a key while it is being loaded wait on the flight
+    instead of starting their own load.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SharedCache(object):
+    """
+    A thread-safe cache shared by every bot in the process.
+    Entries expire after a TTL, and the least recently used (or, with the 'fifo' policy, the oldest) entry is evicted
+    when the cache is full.
+    Concurrent lookups for the same key are coalesced, so only one caller performs the (usually HTTP) load
+    while the others wait for its result.
+    """
+    def __init__(self, name, maxsize=128, ttl=600, policy='lru'):
+        """
+        :param name: A name used in log messages and statistics.
+        :param maxsize: The maximum number of entries kept in memory.
+        :param ttl: Number of seconds an entry stays valid.
+        :param policy: Which entry is evicted when the cache is full, either 'lru' or 'fifo'.
+        :raises InvalidCachePolicy if the policy is unknown
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.policy = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, value), oldest first
+        self._flights = {}
+        self.configure(maxsize, ttl, policy)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _lookup(self, key, now):
+        """
+        Must be called with the lock held.
+        :return: A (found, value) tuple.
+        """
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            return False, None
+        if expires <= now:
+            del self._entries[key]
+            self.evictions += 1
+            return False, None
+        if self.policy == 'lru':
+            self._entries.move_to_end(key)
+        return True, value
+
+    def _trim(self):
+        """
+        Must be called with the lock held.
+        """
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _store(self, key, value, now):
+        """
+        Must be called with the lock held.
+        """
+        self._entries[key] = (now + self.ttl, value)
+        self._entries.move_to_end(key)
+        self._trim()
+
+    def configure(self, maxsize, ttl, policy='lru'):
+        """
+        Changes the size, TTL, and eviction policy of the cache. Existing entries are kept unless the cache shrinks.
+        New TTLs only apply to entries stored after this call.
+        """
+        if policy not in EVICTION_POLICIES:
+            raise InvalidCachePolicy("Unknown eviction policy: cache=[{}], policy=[{}]".format(self.name, policy))
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self.policy = policy
+            self._trim()
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._lookup(key, monotonic())
+            return value if found else default
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value, monotonic())
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value for a key, or calls loader() to create it.
+        If another thread is already loading the same key, this waits for that thread instead of calling loader().
+        Exceptions raised by loader() are passed on to every waiting caller and nothing is cached.
+        :param key: A hashable cache key.
+        :param loader: A function with no parameters that returns the value to cache.
+        :return: The cached or newly loaded value.
+        """
+        with self._lock:
+            found, value = self._lookup(key, monotonic())
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            flight = self._flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._flights[key] = _Flight()
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            with self._lock:
+                self._store(key, flight.value, monotonic())
+            return flight.value
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def values(self):
+        """
+        :return: A list of the cached values, including expired ones that were not evicted yet.
+        """
+        with self._lock:
+            return [value for expires, value in self._entries.values()]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return CacheStats(name=self.name, size=len(self._entries), maxsize=self.maxsize, ttl=self.ttl,
+                              policy=self.policy, hits=self.hits, misses=self.misses, evictions=self.evictions,
+                              hit_rate=self.hits / lookups if lookups else 0.0)
+
+
+# region REGISTRY
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_cache(name):
+    """
+    Gets a named cache, creating it from the 'caches' section of bot_config.yaml the first time it is requested.
+    Every caller asking for the same name gets the same SharedCache.
+    :param name: Name of the cache, e.g. 'link_lists'
+    :return: A SharedCache
+    """
+    with _registry_lock:
+        if name not in _registry:
+            settings = get_cache_config(name)
+            _registry[name] = SharedCache(name, settings['maxsize'], settings['ttl_seconds'], settings['policy'])
+        return _registry[name]
+
+
+def configure_caches(cache_configs=None):
+    """
+    Applies cache settings to every cache that has already been created.
+    :param cache_configs: A dict of cache name -> settings. If None, the settings are read from bot_config.yaml.
+    """
+    cache_configs = get_cache_configs() if cache_configs is None else cache_configs
+    for c in get_caches():
+        settings = cache_configs.get(c.name)
+        if settings:
+            c.configure(settings['maxsize'], settings['ttl_seconds'], settings['policy'])
+
+
+def invalidate(name, key=None):
+    """
+    Removes one entry from a named cache, or every entry if key is None.
+    """
+    c = get_cache(name)
+    if key is None:
+        c.clear()
+    else:
+        c.invalidate(key)
+
+
+def get_caches():
+    """
+    :return: A list of every SharedCache that has been created.
+    """
+    with _registry_lock:
+        return list(_registry.values())
+
+
+def get_cache_stats():
+    """
+    :return: A list of CacheStats, one for every cache that has been created.
+    """
+    return [c.stats() for c in get_caches()]
+
+
+def log_cache_stats():
+    for stats in get_cache_stats():
+        logger.info("Cache stats: name=[{}], size=[{}/{}], ttl=[{}], policy=[{}], hits=[{}], misses=[{}], "
+                    "evictions=[{}], hitRate=[{:.2%}]".format(*stats))
+# endregion
+
+
+def shared_cache(name, key=None):
+    """
+    Decorator that caches a function's return value in a named SharedCache.
+    Unlike cachetools.ttl_cache, the key does not have to include self, so every bot instance shares the same entries.
+    The decorated function gets two helpers that take the same arguments as the function itself:
+    invalidate(...) drops the cached result, and prime(value, ...) stores a known result.
+    :param name: Name of the cache in bot_config.yaml.
+    :param key: A function that takes the same arguments as the decorated function and returns the cache key.
+                If None, all the arguments are used.
+    """
+    def decorator(func):
+        def cache_key(*args, **kwargs):
+            return func.__qualname__, key(*args, **kwargs) if key else (args, tuple(sorted(kwargs.items())))
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return get_cache(name).get_or_load(cache_key(*args, **kwargs), lambda: func(*args, **kwargs))
+
+        wrapper.invalidate = lambda *args, **kwargs: get_cache(name).invalidate(cache_key(*args, **kwargs))
+        wrapper.prime = lambda value, *args, **kwargs: get_cache(name).set(cache_key(*args, **kwargs), value)
+        return wrapper
+    return decorator
@@ -1,30 +1,16 @@
 from logging import getLogger
 from logging.config import fileConfig
 import os
-import configparser
 
 config_directory = os.path.dirname(__file__)
 root = os.path.dirname(config_directory)
 log_directory = os.path.join(root, 'logs')
 log_file_name = os.path.join(log_directory, "botlog.log")
-
-if not os.path.exists(log_directory):
-    os.mkdir(log_directory)
-
-if not os.path.exists(log_file_name):
-    with open(log_file_name, "a"):
-        pass
-
+memory_log_file_name = os.path.join(log_directory, "memory.log")
+data_directory = os.path.join(root, 'data')
 log_config_file_name = os.path.join(config_directory, "log_config.ini")
-cp = configparser.ConfigParser()
-cp.read(log_config_file_name)
-new_args = "('{}','midnight',-1,7)".format(log_file_name)
-
-if os.path.sep == "\\":
-    new_args = new_args.replace("\\", "\\\\")
-
-cp['handler_file_handler']['args'] = new_args
-with open(log_config_file_name, "w") as config_file:
-    cp.write(config_file)
 
-fileConfig(os.path.join(config_directory, "log_config.ini"))
+# log_config.ini is never written to. The file handlers create log_directory when they first write a record.
+# The log files' paths are passed in as defaults that the handlers' args refer to.
+fileConfig(log_config_file_name, defaults={'log_file_name': log_file_name,
+                                           'memory_log_file_name': memory_log_file_name})
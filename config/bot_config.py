@@ -1,10 +1,228 @@
 import yaml
 import os
+import threading
 from config import config_directory
 
+try:
+    from yaml import CSafeLoader as SafeLoader  # libyaml is much faster, but is not always installed
+except ImportError:
+    from yaml import SafeLoader
+
 bot_config_path = os.path.join(config_directory, "bot_config.yaml")
-with open(bot_config_path, "r") as ifile:
-    CONFIG = yaml.load(ifile)
+REQUIRED_INTERVALS = ('submission_interval_hours', 'sleep_interval_seconds', 'work_deadline_seconds',
+                      'http_timeout_seconds', 'shutdown_timeout_seconds')
+_reload_lock = threading.Lock()
+_reload_listeners = []
+_snapshot_lock = threading.Lock()
+_snapshots = {}  # path -> ((mtime, size), config) of the last file that was loaded and validated
+
+
+class InvalidBotConfig(ValueError):
+    pass
+
+
+# region SCHEMA
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+
+
+def _is_positive_number(value):
+    return _is_number(value) and value > 0
+
+
+def _is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def _is_string_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def _is_one_of(*choices):
+    return lambda value: value in choices
+
+
+def _is_type(value_type):
+    return lambda value: isinstance(value, value_type)
+
+
+# (setting, check, description, required). '*' matches every key of a mapping.
+CONFIG_SCHEMA = tuple(('intervals.' + name, _is_positive_number, "a positive number", True)
+                      for name in REQUIRED_INTERVALS) + (
+    ('subreddits', lambda value: bool(value) and _is_string_list(value), "a list of subreddit names", True),
+    ('user_agents', _is_type(dict), "a mapping", True),
+    ('user_agents.*', _is_type(str), "a string", True),
+    ('flags', _is_type(dict), "a mapping", True),
+    ('flags.run_bots_once', _is_type(bool), "true or false", True),
+    ('watchdog.check_interval_seconds', _is_positive_number, "a positive number", False),
+    ('watchdog.grace_seconds', _is_number, "a number", False),
+    ('watchdog.action', _is_one_of('skip', 'restart'), "skip or restart", False),
+    ('supervisor.backoff_base_seconds', _is_number, "a number", False),
+    ('supervisor.backoff_max_seconds', _is_number, "a number", False),
+    ('supervisor.max_restarts', _is_number, "a number", False),
+    ('supervisor.healthy_seconds', _is_positive_number, "a positive number", False),
+    ('caches.*.ttl_seconds', _is_number, "a number", False),
+    ('caches.*.maxsize', _is_count, "a positive whole number", False),
+    ('caches.*.policy', _is_one_of('lru', 'fifo'), "lru or fifo", False),
+    ('http_cache.file_name', _is_type(str), "a file name", False),
+    ('http_cache.max_size_mb', _is_positive_number, "a positive number", False),
+    ('http_cache.default_max_age_seconds', _is_number, "a number", False),
+    ('newsbot.article_source', _is_one_of('feed', 'html'), "feed or html", False),
+    ('newsbot.article_store_file', _is_type(str), "a file name", False),
+    ('eventbot.list_pages', _is_count, "a positive whole number", False),
+    ('eventbot.month_views', _is_count, "a positive whole number", False),
+    ('eventbot.max_workers', _is_count, "a positive whole number", False),
+    ('eventbot.event_store_file', _is_type(str), "a file name", False),
+    ('backfill.max_workers', _is_count, "a positive whole number", False),
+    ('backfill.max_requests_per_host', _is_count, "a positive whole number", False),
+    ('backfill.min_delay_seconds', _is_number, "a number", False),
+    ('backfill.request_timeout_seconds', _is_positive_number, "a positive number", False),
+    ('backfill.categories', _is_string_list, "a list of category paths", False),
+    ('sharding.lease_file', _is_type(str), "a file name", False),
+    ('sharding.lease_seconds', _is_positive_number, "a positive number", False),
+    ('sharding.replicas', _is_count, "a positive whole number", False),
+    ('ticketbot.ledger_file', _is_type(str), "a file name", False),
+    ('ticketbot.ledger_retention_days', _is_positive_number, "a positive number", False),
+    ('stream.positions_file', _is_type(str), "a file name", False),
+    ('stream.poll_interval_seconds', _is_positive_number, "a positive number", False),
+    ('stream.poll_deadline_seconds', _is_positive_number, "a positive number", False),
+    ('stream.limit', _is_count, "a positive whole number", False),
+    ('outbox.file_name', _is_type(str), "a file name", False),
+    ('outbox.batch_size', _is_count, "a positive whole number", False),
+    ('outbox.max_attempts', _is_count, "a positive whole number", False),
+    ('reddit.thread_stack_size_kb', lambda value: value == 0 or _is_count(value) and value >= 32,
+     "0 or a whole number of at least 32", False),
+    ('memory.enabled', _is_type(bool), "true or false", False),
+    ('memory.interval_seconds', _is_positive_number, "a positive number", False),
+    ('memory.frames', _is_count, "a positive whole number", False),
+    ('memory.top', _is_count, "a positive whole number", False),
+    ('tracing.sample_rate', lambda value: _is_number(value) and value <= 1, "a number from 0 to 1", False),
+    ('tracing.file_name', _is_type(str), "a file name", False),
+    ('tracing.max_size_mb', _is_positive_number, "a positive number", False),
+    ('tracing.backup_count', lambda value: _is_count(value) or value == 0, "a whole number", False),
+)
+_MISSING = object()
+
+
+def _find_settings(config, path):
+    """
+    Looks up a dotted setting name in the loaded YAML.
+    :return: A list of (name, value) tuples. The value is _MISSING if the setting is not there.
+    """
+    found = [('', config)]
+    for part in path.split('.'):
+        matches = []
+        for name, value in found:
+            prefix = name + '.' if name else ''
+            if not isinstance(value, dict):
+                matches.append((prefix + part, _MISSING))
+            elif part == '*':
+                matches.extend((prefix + str(key), item) for key, item in value.items())
+            else:
+                matches.append((prefix + part, value.get(part, _MISSING)))
+        found = matches
+    return found
+# endregion
+
+
+def validate_config(config):
+    """
+    Checks a loaded bot_config.yaml against CONFIG_SCHEMA, so a bad edit is caught before it is used.
+    Every setting is checked before raising, so one error lists everything that is wrong with the file.
+    :param config: The loaded YAML
+    :raises InvalidBotConfig if something required is missing or a setting has the wrong type
+    """
+    if not isinstance(config, dict):
+        raise InvalidBotConfig("bot_config.yaml must contain a mapping")
+    errors = []
+    for path, check, description, required in CONFIG_SCHEMA:
+        for name, value in _find_settings(config, path):
+            if value is _MISSING:
+                if required:
+                    errors.append("{} is missing".format(name))
+            elif not check(value):
+                errors.append("{} must be {}, not {!r}".format(name, description, value))
+    if errors:
+        raise InvalidBotConfig("Invalid bot_config.yaml: " + "; ".join(errors))
+
+
+def load_config(path=bot_config_path):
+    """
+    Reads and validates bot_config.yaml. The validated result is kept with the file's modification time and size,
+    so loading a file that has not changed does not parse it again.
+    :raises InvalidBotConfig if the file is not valid
+    :return: The loaded configuration as a dict. It is shared, so it must not be modified.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        raise InvalidBotConfig("Could not read {}: {}".format(path, e))
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _snapshot_lock:
+        snapshot = _snapshots.get(path)
+    if snapshot and snapshot[0] == key:
+        return snapshot[1]
+    with open(path, "rb") as ifile:
+        try:
+            config = yaml.load(ifile, Loader=SafeLoader)
+        except yaml.YAMLError as e:
+            raise InvalidBotConfig("Could not parse {}: {}".format(path, e))
+    validate_config(config)
+    with _snapshot_lock:
+        _snapshots[path] = (key, config)
+    return config
+
+
+CONFIG = load_config()
+
+
+def reload_config(path=bot_config_path):
+    """
+    Loads bot_config.yaml again and swaps it in for CONFIG in one step, then calls every reload listener with it.
+    If the new file is not valid, the current configuration is kept.
+    :raises InvalidBotConfig if the file is not valid
+    :return: The new configuration
+    """
+    global CONFIG
+    config = load_config(path)
+    with _reload_lock:
+        CONFIG = config
+        listeners = list(_reload_listeners)
+    for listener in listeners:
+        listener(config)
+    return config
+
+
+def add_reload_listener(listener):
+    """
+    :param listener: A function that takes the new configuration. It is called after every successful reload.
+    """
+    with _reload_lock:
+        _reload_listeners.append(listener)
+
+
+def remove_reload_listener(listener):
+    with _reload_lock:
+        if listener in _reload_listeners:
+            _reload_listeners.remove(listener)
+
+DEFAULT_CACHE_CONFIG = {'ttl_seconds': 600, 'maxsize': 128, 'policy': 'lru'}
+DEFAULT_HTTP_CACHE_CONFIG = {'file_name': 'http_cache.sqlite', 'max_size_mb': 64, 'default_max_age_seconds': 600}
+DEFAULT_NEWSBOT_CONFIG = {'article_source': 'feed', 'article_store_file': 'articles.sqlite'}
+DEFAULT_WATCHDOG_CONFIG = {'check_interval_seconds': 15, 'grace_seconds': 60, 'action': 'restart'}
+DEFAULT_SUPERVISOR_CONFIG = {'backoff_base_seconds': 5, 'backoff_max_seconds': 900, 'max_restarts': 10,
+                             'healthy_seconds': 3600}
+DEFAULT_EVENTBOT_CONFIG = {'list_pages': 5, 'month_views': 2, 'max_workers': 4, 'event_store_file': 'events.sqlite'}
+DEFAULT_BACKFILL_CONFIG = {'max_workers': 4, 'max_requests_per_host': 2, 'min_delay_seconds': 1.0,
+                           'request_timeout_seconds': 30, 'categories': []}
+DEFAULT_SHARDING_CONFIG = {'lease_file': 'leases.sqlite', 'lease_seconds': 60, 'replicas': 64}
+DEFAULT_TICKETBOT_CONFIG = {'ledger_file': 'messages.sqlite', 'ledger_retention_days': 30}
+DEFAULT_STREAM_CONFIG = {'positions_file': 'streams.sqlite', 'poll_interval_seconds': 30, 'poll_deadline_seconds': 60,
+                         'limit': 100}
+DEFAULT_OUTBOX_CONFIG = {'file_name': 'outbox.sqlite', 'batch_size': 20, 'max_attempts': 5}
+DEFAULT_REDDIT_CONFIG = {'thread_stack_size_kb': 0}
+DEFAULT_MEMORY_CONFIG = {'enabled': False, 'interval_seconds': 300, 'frames': 25, 'top': 10}
+DEFAULT_TRACING_CONFIG = {'sample_rate': 0.0, 'file_name': 'traces.json', 'max_size_mb': 16, 'backup_count': 3}
 
 
 def get_subreddits():
@@ -40,3 +258,116 @@ def get_intervals():
 
 def get_interval(interval_name):
     return get_intervals()[interval_name]
+
+
+def get_cache_configs():
+    """
+    :return: A dict of cache name -> settings, with defaults filled in for missing settings.
+    """
+    return {name: dict(DEFAULT_CACHE_CONFIG, **(settings or {})) for name, settings in CONFIG.get('caches', {}).items()}
+
+
+def get_cache_config(cache_name):
+    """
+    Gets the settings of one named cache. Caches that are not in bot_config.yaml use the default settings.
+    :return: A dict with ttl_seconds, maxsize, and policy keys.
+    """
+    return get_cache_configs().get(cache_name, dict(DEFAULT_CACHE_CONFIG))
+
+
+def get_http_cache_config():
+    """
+    :return: A dict with the file_name, max_size_mb, and default_max_age_seconds of the on-disk HTTP cache.
+    """
+    return get_section('http_cache', DEFAULT_HTTP_CACHE_CONFIG)
+
+
+def get_newsbot_config():
+    """
+    :return: A dict with the NewsBot settings, e.g. article_source.
+    """
+    return get_section('newsbot', DEFAULT_NEWSBOT_CONFIG)
+
+
+def get_watchdog_config():
+    """
+    :return: A dict with the settings Dispatch uses to find and handle stuck bots.
+    """
+    return get_section('watchdog', DEFAULT_WATCHDOG_CONFIG)
+
+
+def get_supervisor_config():
+    """
+    :return: A dict with the backoff settings used to retry failed work cycles and restart failed bots.
+    """
+    return get_section('supervisor', DEFAULT_SUPERVISOR_CONFIG)
+
+
+def get_eventbot_config():
+    """
+    :return: A dict with the EventBot settings, e.g. how many calendar pages are scraped.
+    """
+    return get_section('eventbot', DEFAULT_EVENTBOT_CONFIG)
+
+
+def get_backfill_config():
+    """
+    :return: A dict with the settings of the archive backfill crawler.
+    """
+    return get_section('backfill', DEFAULT_BACKFILL_CONFIG)
+
+
+def get_sharding_config():
+    """
+    :return: A dict with the settings used when accounts are split between several Dispatch processes.
+    """
+    return get_section('sharding', DEFAULT_SHARDING_CONFIG)
+
+
+def get_ticketbot_config():
+    """
+    :return: A dict with the TicketBot settings, e.g. where handled messages are recorded.
+    """
+    return get_section('ticketbot', DEFAULT_TICKETBOT_CONFIG)
+
+
+def get_stream_config():
+    """
+    :return: A dict with the settings of the comment stream shared by command bots.
+    """
+    return get_section('stream', DEFAULT_STREAM_CONFIG)
+
+
+def get_outbox_config():
+    """
+    :return: A dict with the settings of the queue of Reddit writes waiting to be sent.
+    """
+    return get_section('outbox', DEFAULT_OUTBOX_CONFIG)
+
+
+def get_reddit_config():
+    """
+    :return: A dict with the settings shared by every Reddit session in the process.
+    """
+    return get_section('reddit', DEFAULT_REDDIT_CONFIG)
+
+
+def get_memory_config():
+    """
+    :return: A dict with the settings of the memory diagnostics written to logs/memory.log.
+    """
+    return get_section('memory', DEFAULT_MEMORY_CONFIG)
+
+
+def get_tracing_config():
+    """
+    :return: A dict with the share of work cycles that are traced, and where the traces are written.
+    """
+    return get_section('tracing', DEFAULT_TRACING_CONFIG)
+
+
+def get_section(section_name, defaults=None):
+    """
+    Gets a section of bot_config.yaml as a dict, with defaults filled in for missing settings.
+    """
+    return dict(defaults or {}, **(CONFIG.get(section_name) or {}))
@@ -0,0 +1,17 @@
+import os
+from logging.handlers import TimedRotatingFileHandler
+
+
+class LazyTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    A TimedRotatingFileHandler that opens its file, and creates the file's directory, when the first record is written.
+    Importing the config package therefore leaves no logs directory behind unless something is logged.
+    """
+    def __init__(self, filename, when='h', interval=1, backup_count=0, encoding=None, utc=False):
+        super(LazyTimedRotatingFileHandler, self).__init__(filename, when, interval, backup_count, encoding,
+                                                           delay=True, utc=utc)
+
+    def _open(self):
+        # exist_ok makes this safe when several processes start at once
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super(LazyTimedRotatingFileHandler, self)._open()
@@ -1,5 +1,7 @@
 import os
 import configparser
+import tempfile
+import threading
 from enum import IntEnum
 CONFIG_PATH = os.path.dirname(os.path.abspath(__file__))
 PRAW_FILE_PATH = os.path.join(os.path.dirname(CONFIG_PATH), "praw.ini")
@@ -22,16 +24,36 @@ class InvalidParser(ValueError):
     pass
 
 
+_parser_lock = threading.Lock()
+_cached_parser = (None, None)  # ((mtime, size) of praw.ini, the ConfigParser that read it)
+
+
+def _get_file_key():
+    try:
+        stat = os.stat(PRAW_FILE_PATH)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
 def _get_parser(current_parser=None):
     """
     Helper function to reduce the number of duplicate parsers, i.e. number of file reads.
-    :param current_parser: Either None, or a config parser object. If None, a new config parser is created.
-    :return: Either the current config parser, or a new one.
-    """
-    if not current_parser:
-        current_parser = configparser.ConfigParser()
-        current_parser.read(PRAW_FILE_PATH)
-    return current_parser
+    praw.ini is only parsed again when its modification time or size changes.
+    :param current_parser: Either None, or a config parser object. If None, the parser of the current praw.ini is used.
+    :return: Either the current config parser, or the cached one.
+    """
+    global _cached_parser
+    if current_parser:
+        return current_parser
+    key = _get_file_key()
+    with _parser_lock:
+        cached_key, parser = _cached_parser
+        if parser is None or key is None or key != cached_key:
+            parser = configparser.ConfigParser()
+            parser.read(PRAW_FILE_PATH)
+            _cached_parser = (key, parser)
+        return parser
 
 
 def get_value(site_name, key, _current_parser=None):
@@ -61,10 +83,26 @@ def get_value(site_name, key, _current_parser=None):
 def _write_config(parser):
     """
     Writes to the config file. First you have to add values to the ConfigParser object, then you call this function.
+    The parser is written to a temporary file next to praw.ini, which then replaces it, so a crash in the middle of
+    a write never leaves a half written praw.ini.
     :param parser: The ConfigParser object whose data will be saved to the config file.
     """
-    with open(PRAW_FILE_PATH, "w") as c_file:
-        parser.write(c_file)
+    global _cached_parser
+    with _parser_lock:
+        directory, file_name = os.path.split(PRAW_FILE_PATH)
+        fd, temp_path = tempfile.mkstemp(prefix=file_name + ".", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as c_file:
+                parser.write(c_file)
+                c_file.flush()
+                os.fsync(c_file.fileno())
+            if os.path.exists(PRAW_FILE_PATH):
+                os.chmod(temp_path, os.stat(PRAW_FILE_PATH).st_mode & 0o777)
+            os.replace(temp_path, PRAW_FILE_PATH)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        _cached_parser = (None, None)
 
 
 def get_multi_values(site_name, keys, _current_parser=None):
@@ -108,6 +146,22 @@ def set_reddit_oauth_refresh_token(site_name, token, _current_parser=None):
     set_value(site_name, OAUTH_CRED_KEYS[CredKeys.refresh], token, _current_parser)
 
 
+def set_reddit_oauth_refresh_tokens(tokens):
+    """
+    Saves the refresh tokens of many accounts in one write of the config file.
+    praw.ini is read again first, so changes made since it was last read are kept.
+    :param tokens: A dict of site name -> new refresh token
+    :raises InvalidSiteName if a site name is not in the config file. Nothing is saved in that case.
+    """
+    parser = configparser.ConfigParser()
+    parser.read(PRAW_FILE_PATH)
+    for site_name, token in tokens.items():
+        if not parser.has_section(site_name):
+            raise InvalidSiteName(site_name)
+        parser[site_name][OAUTH_CRED_KEYS[CredKeys.refresh]] = token
+    _write_config(parser)
+
+
 def get_reddit_oauth_scope(site_name, _current_parser=None):
     """
     Retrieves the list of Reddit permissions the bot has, which is stored in the config file.
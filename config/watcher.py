@@ -0,0 +1,32 @@
+import os
+
+
+class ConfigWatcher(object):
+    """
+    Notices when config files change on disk by comparing their modification times.
+    It does not start a thread of its own; Dispatch calls poll() from its run loop.
+    """
+    def __init__(self, *paths):
+        """
+        :param paths: The files to watch. Files that do not exist yet are watched too.
+        """
+        self._mtimes = {path: self._get_mtime(path) for path in paths}
+
+    @staticmethod
+    def _get_mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def poll(self):
+        """
+        :return: A list of the watched files that changed, were created, or were deleted since the last poll.
+        """
+        changed = []
+        for path, mtime in self._mtimes.items():
+            current = self._get_mtime(path)
+            if current != mtime:
+                self._mtimes[path] = current
+                changed.append(path)
+        return changed
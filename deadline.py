@@ -0,0 +1,83 @@
+import threading
+from time import monotonic
+
+_local = threading.local()
+MIN_TIMEOUT_SECONDS = 0.1
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline(object):
+    """
+    The time by which a bot's work cycle must finish.
+    Each bot thread has its own current deadline, so helpers deep in the call stack (e.g. HTTP requests)
+    can shorten their timeouts without it being passed to them.
+    """
+    def __init__(self, seconds):
+        """
+        :param seconds: Number of seconds from now until the deadline.
+        """
+        self.seconds = seconds
+        self.started = monotonic()
+        self.expires = self.started + seconds
+
+    def remaining(self):
+        return self.expires - monotonic()
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def expire(self):
+        """
+        Moves the deadline to now, so the next check() ends the cycle.
+        """
+        self.expires = monotonic()
+
+    def shorten(self, expires):
+        """
+        Moves the deadline earlier, e.g. so a work cycle finishes before shutdown.
+        :param expires: A time.monotonic() value. The deadline is not moved if it is already earlier.
+        """
+        self.expires = min(self.expires, expires)
+
+    def check(self):
+        """
+        :raises DeadlineExceeded if the deadline has passed
+        """
+        if self.expired:
+            raise DeadlineExceeded("Work cycle took longer than {} seconds".format(self.seconds))
+
+    def timeout(self, max_timeout=None):
+        """
+        Gets a timeout for a blocking call that will not run past the deadline.
+        :param max_timeout: The longest timeout allowed, even if there is more time left.
+        :raises DeadlineExceeded if the deadline has passed
+        :return: Number of seconds
+        """
+        self.check()
+        remaining = max(self.remaining(), MIN_TIMEOUT_SECONDS)
+        return remaining if max_timeout is None else min(remaining, max_timeout)
+
+
+def get_deadline():
+    """
+    :return: The Deadline of the work cycle running in the current thread, or None.
+    """
+    return getattr(_local, 'deadline', None)
+
+
+def set_deadline(deadline):
+    _local.deadline = deadline
+
+
+def get_timeout(max_timeout=None):
+    """
+    Gets a timeout for a blocking call that respects the current thread's deadline, if it has one.
+    :param max_timeout: The longest timeout allowed.
+    :raises DeadlineExceeded if the current deadline has passed
+    """
+    deadline = get_deadline()
+    return deadline.timeout(max_timeout) if deadline else max_timeout
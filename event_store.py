@@ -0,0 +1,84 @@
+from collections import namedtuple
+
+from store import SqliteStore
+
+StoredEvent = namedtuple('StoredEvent', 'permalink title date_display description starts_at first_seen last_changed')
+
+
+class EventStore(SqliteStore):
+    """
+    A local store of events from the FAU event calendar, keyed by permalink.
+    Events from every calendar page are merged here, so the Reddit table does not depend on which page the
+    calendar happened to return. The index on start time lets past events be deleted in bulk.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            permalink TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            date_display TEXT NOT NULL,
+            description TEXT NOT NULL,
+            starts_at REAL NOT NULL,
+            first_seen REAL NOT NULL,
+            last_changed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS events_starts_at ON events (starts_at);
+    """
+
+    def save_events(self, events, now):
+        """
+        Adds new events and updates changed ones. last_changed is only updated if the event's details changed.
+        :param events: An iterable of dicts with permalink, title, date_display, description, and starts_at keys.
+                       starts_at is a UTC timestamp.
+        :param now: Current UTC timestamp
+        """
+        rows = [(event['permalink'], event['title'], event['date_display'], event['description'],
+                 event['starts_at'], now, now) for event in events]
+        with self.transaction() as conn:
+            conn.executemany("""
+                INSERT INTO events (permalink, title, date_display, description, starts_at, first_seen, last_changed)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (permalink) DO UPDATE SET
+                    last_changed = CASE WHEN (title, date_display, description, starts_at) IS NOT
+                        (excluded.title, excluded.date_display, excluded.description, excluded.starts_at)
+                        THEN excluded.last_changed ELSE last_changed END,
+                    title = excluded.title,
+                    date_display = excluded.date_display,
+                    description = excluded.description,
+                    starts_at = excluded.starts_at
+            """, rows)
+
+    def expire_events(self, before):
+        """
+        Deletes every event that started before a time.
+        :param before: UTC timestamp
+        :return: Number of events deleted
+        """
+        with self.transaction() as conn:
+            return conn.execute("DELETE FROM events WHERE starts_at < ?", (before,)).rowcount
+
+    def delete_events_except(self, permalinks, starts_after, starts_before):
+        """
+        Deletes the events that start in a time span and are not in a list, e.g. events that are no longer on the
+        calendar pages that show the whole span.
+        :param permalinks: An iterable of the permalinks of the events to keep
+        :param starts_after: UTC timestamp, the start of the span
+        :param starts_before: UTC timestamp, the end of the span
+        :return: Number of events deleted
+        """
+        keep = set(permalinks)
+        with self.transaction() as conn:
+            gone = [(row['permalink'],) for row in conn.execute(
+                "SELECT permalink FROM events WHERE starts_at >= ? AND starts_at < ?", (starts_after, starts_before))
+                if row['permalink'] not in keep]
+            conn.executemany("DELETE FROM events WHERE permalink = ?", gone)
+        return len(gone)
+
+    def get_upcoming_events(self, after):
+        """
+        :param after: UTC timestamp
+        :return: A list of StoredEvents that start at or after a time, soonest first.
+        """
+        return [StoredEvent(*row) for row in self.execute(
+            "SELECT permalink, title, date_display, description, starts_at, first_seen, last_changed "
+            "FROM events WHERE starts_at >= ? ORDER BY starts_at", (after,))]
@@ -1,15 +1,21 @@
-from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from config import getLogger
 from bs4 import BeautifulSoup
 import requests
+import http_cache
 import datetime
 import string
 import json
-from cachetools import ttl_cache
 from pytz import timezone, utc
 from dateutil.parser import parse
 from bots import RedditBot
-from config.bot_config import get_subreddits
+from cache import shared_cache
+from config.bot_config import get_eventbot_config, get_subreddits
+import tracing
+from deadline import DeadlineExceeded, get_deadline, set_deadline
+from event_store import EventStore
+from outbox import SUBMIT
+from tracing import span, traced
 
 # region constants
 BASE_URL = "http://www.upressonline.com/fauevents/"
@@ -17,6 +23,7 @@ TABLE_ROW = "{title} | {date} | {description}\n"
 HYPERLINK = "[{text}]({url})"
 HEADER_DIVIDER = "---|---|----\n"
 TABLE_HEADER = TABLE_ROW.format(title='Title', date='Date', description='Description') + HEADER_DIVIDER
+MAX_SELF_POST_LENGTH = 40000
 # endregion
 
 logger = getLogger()
@@ -29,103 +36,202 @@ class EventBot(RedditBot):
         self.base_url = BASE_URL
         self.subreddits = get_subreddits()
         self.post_title = "Event Calendar"
+        self.event_store = EventStore.shared(get_eventbot_config()['event_store_file'])
+
+    def apply_config(self):
+        self.subreddits = get_subreddits()
 
     @staticmethod
-    def has_event_passed(event_json):
+    def _get_start_time(date_display):
         """
-        Takes the date field from the event_json strips it of all symbols and then
-        format it into a time object(US/Eastern) then compare it with the system current time
-        :param event_json: JSON stripped from the event's data-tribejson HTML attribute.
-        :type event_json: str
-        :return: return true if an event has passed
+        Takes the event's display date, strips it of all symbols, and parses it as a US/Eastern time.
+        :param date_display: The dateDisplay field of the event JSON, e.g. "June 5 @ 8:00 am - 5:00 pm"
+        :return: The start time as a datetime in UTC
         """
-        event_dict = EventBot._get_event_dict(event_json)
-        timestamp = event_dict['date']
         invalidChars = set(string.punctuation)
-        if any(char in invalidChars for char in timestamp):
-            full_date = timestamp.replace(" @ ", " ")
+        if any(char in invalidChars for char in date_display):
+            full_date = date_display.replace(" @ ", " ")
             dash_idx = full_date.index('-')
             date = full_date[:dash_idx - 1]
-            start_datetime = timezone("US/Eastern").localize(parse(date), is_dst=None).astimezone(utc)
         else:
-            date = timestamp
-            start_datetime = timezone("US/Eastern").localize(parse(date), is_dst=None).astimezone(utc)
+            date = date_display
+        return timezone("US/Eastern").localize(parse(date), is_dst=None).astimezone(utc)
 
-        now = utc.localize(datetime.datetime.utcnow())  # get current time in UTC timezone
-        return now > start_datetime  # True if now is after start time
+    @staticmethod
+    def _get_months(today, count):
+        """
+        :return: A list of count + 1 (year, month) tuples, starting with the month of today
+        """
+        months = [(today.year, today.month)]
+        for _ in range(count):
+            year, month = months[-1]
+            months.append((year + 1, 1) if month == 12 else (year, month + 1))
+        return months
 
+    @staticmethod
+    def get_calendar_urls(today=None):
+        """
+        Gets the URLs of every calendar page that should be scraped: the default view,
+        the first few pages of the list view, and the month views starting with the current month.
+        The number of list pages and month views is configurable in config/bot_config.yaml.
+        :return: A list of URLs
+        """
+        today = today or datetime.date.today()
+        settings = get_eventbot_config()
+        urls = [BASE_URL]
+        urls += ["{}list/?tribe_paged={}".format(BASE_URL, page) for page in range(1, settings['list_pages'] + 1)]
+        urls += ["{}month/{}-{:02}/".format(BASE_URL, year, month)
+                 for year, month in EventBot._get_months(today, settings['month_views'])[:-1]]
+        return urls
 
     @staticmethod
-    def _get_event_html():
+    def get_month_view_window(today=None):
         """
-        Makes the HTTP request to the event calendar website.
+        The time span that the month views of get_calendar_urls() cover completely. Every event on the calendar that
+        starts in it is on one of those pages, which is not true of the list pages.
+        :return: A (start, end) tuple of UTC timestamps: the start of the current month and the end of the last month
+                 view, in US/Eastern time
+        """
+        months = EventBot._get_months(today or datetime.date.today(), get_eventbot_config()['month_views'])
+        start, end = [timezone("US/Eastern").localize(datetime.datetime(year, month, 1)).timestamp()
+                      for year, month in (months[0], months[-1])]
+        return start, end
+
+    @staticmethod
+    @traced("fetch.event_html")
+    @shared_cache('event_pages', key=lambda url=BASE_URL: url)
+    def _get_event_html(url=BASE_URL):
+        """
+        Makes the HTTP request to one page of the event calendar website.
+        :param url: URL of the calendar page
         :return: String containing HTML, or None if the response is not 200 OK.
         """
-        logger.info("Getting event calendar HTML from {}".format(BASE_URL))
-        r = requests.get(BASE_URL)
+        logger.info("Getting event calendar HTML from {}".format(url))
+        r = http_cache.get(url)
         if r.status_code == requests.codes.ok:
             data = r.text
             return data
-        logger.warning("Returning None, Response not OK: code={}".format(r.status_code))
+        logger.warning("Returning None, Response not OK: url={}, code={}".format(url, r.status_code))
         return None
 
     @staticmethod
-    def _get_event_dict(event_json):
+    def _get_all_event_html(urls):
         """
-        Takes the relevant values out of the event JSON and creates a simpler dictionary
-        that is used to format the string TABLE_ROW.
-        :param event_json: JSON stripped from the event's data-tribejson HTML attribute.
-        :type event_json: str
-        :return: A dict containing the relevant event data
+        Requests several calendar pages at the same time.
+        :param urls: A list of calendar page URLs
+        :return: A list of HTML strings for the pages that could be downloaded. If it is shorter than urls,
+                 some pages are missing.
         """
-        event_dict = json.loads(event_json)
-        return {'title': HYPERLINK.format(text=event_dict['title'], url=event_dict['permalink']),
-                'date': event_dict['dateDisplay'],
-                'description': event_dict['excerpt'][3:-4] or "None provided",}
+        pages = []
+        deadline = get_deadline()
+        trace = tracing.get_context()
+
+        def get_html(url):
+            set_deadline(deadline)  # the worker threads share the bot's deadline and trace
+            tracing.set_context(trace)
+            return EventBot._get_event_html(url)
+
+        with ThreadPoolExecutor(max_workers=get_eventbot_config()['max_workers']) as executor:
+            for url, future in [(url, executor.submit(get_html, url)) for url in urls]:
+                try:
+                    html = future.result()
+                except (requests.RequestException, DeadlineExceeded):
+                    logger.exception("Could not get calendar page: url=[{}]".format(url))
+                    continue
+                if html:
+                    pages.append(html)
+        return pages
 
     @staticmethod
-    def _make_reddit_table(html):
+    @traced("parse.events")
+    def _get_events(html):
         """
-        Scrapes event data from HTML and creates a Reddit table with it.
+        Scrapes event data from the HTML of a calendar page.
         :param html: HTML from the event website
-        :type data: str
+        :type html: str
+        :return: A list of dicts that can be saved in the EventStore
+        """
+        events = []
+        soup = BeautifulSoup(html, "html.parser")
+        for event in soup.find_all('div', attrs={'data-tribejson': True}):
+            event_json = json.loads(event.get('data-tribejson'))
+            events.append({'permalink': event_json['permalink'],
+                           'title': event_json['title'],
+                           'date_display': event_json['dateDisplay'],
+                           'description': event_json['excerpt'][3:-4] or "None provided",
+                           'starts_at': EventBot._get_start_time(event_json['dateDisplay']).timestamp()})
+        return events
+
+    @staticmethod
+    @traced("render.event_table")
+    def _make_reddit_table(events):
+        """
+        Creates a Reddit table from stored events.
+        Rows that would make the table longer than a Reddit self post allows are left out.
+        :param events: A list of StoredEvents, in the order they should appear
         :return: A single string containing a Reddit markdown table
         """
         logger.info("Generating reddit table")
 
         # start with the header, and append a new row for each event
         table = TABLE_HEADER
-        soup = BeautifulSoup(html, "html.parser")
-        for event in soup.find_all('div', attrs={'data-tribejson': True}):
-            event_json = event.get('data-tribejson')
-            event_dict = EventBot._get_event_dict(event_json)
-            if not EventBot.has_event_passed(event_json):
-                table += TABLE_ROW.format(**event_dict)
+        for event in events:
+            row = TABLE_ROW.format(title=HYPERLINK.format(text=event.title, url=event.permalink),
+                                   date=event.date_display, description=event.description)
+            if len(table) + len(row) > MAX_SELF_POST_LENGTH:
+                logger.warning("Event table is full, leaving out later events: events=[{}]".format(len(events)))
+                break
+            table += row
         return table
 
+    def update_event_store(self):
+        """
+        Scrapes every calendar page, saves the events in the EventStore, and deletes events that have started.
+        If every page was downloaded and listed events, stored events that start within the month views but were not
+        on any page were removed or cancelled on the calendar, so they are deleted too. Later events are kept, since
+        they are only on list pages that may not have been scraped. After a partial download, or when a page has no
+        events (e.g. because its layout changed), nothing is deleted.
+        """
+        today = datetime.date.today()
+        urls = self.get_calendar_urls(today)
+        pages = self._get_all_event_html(urls)
+        now = utc.localize(datetime.datetime.utcnow()).timestamp()
+        page_events = [EventBot._get_events(html) for html in pages]
+        events = [event for events in page_events for event in events]
+        self.event_store.save_events(events, now)
+        expired = self.event_store.expire_events(now)
+        removed = 0
+        if len(pages) == len(urls) and all(page_events):
+            start, end = self.get_month_view_window(today)
+            removed = self.event_store.delete_events_except((event['permalink'] for event in events), start, end)
+        logger.info("Updated event store: pages=[{}/{}], events=[{}], expired=[{}], removed=[{}]".format(
+            len(pages), len(urls), len(events), expired, removed))
+
     def create_new_table(self):
         """
-        Uses all the helper functions to get the HTML, scrape it, and generate a Reddit table.
+        Uses all the helper functions to update the event store and generate a Reddit table from it.
         :return: A single string containing a Reddit markdown table, or None if an error happens.
         """
-        table = None
-        html = self._get_event_html()
-        if html:
-            table = EventBot._make_reddit_table(html)
-        else:
+        self.update_event_store()
+        now = utc.localize(datetime.datetime.utcnow()).timestamp()
+        events = self.event_store.get_upcoming_events(now)
+        if not events:
             logger.error("Table could not be generated.")
-        return table
+            return None
+        return EventBot._make_reddit_table(events)
 
-    @ttl_cache(ttl=3600)
+    @shared_cache('table_posts', key=lambda self, subreddit: (self.USER_NAME, subreddit))
     def get_existing_table_post(self, subreddit):
         """
          Searches a subreddit for a specific post. If found, return it. Else, return None.
          :param subreddit: The subreddit where the url will be searched for
          :return: a Reddit post object, or None
          """
-        for post in self.r.search("title:{} AND author:{}".format(self.post_title, self.USER_NAME), subreddit=subreddit):
-            if post:
-                return post
+        with span("praw.search", subreddit=subreddit):
+            for post in self.r.search("title:{} AND author:{}".format(self.post_title, self.USER_NAME),
+                                      subreddit=subreddit):
+                if post:
+                    return post
         return None
 
     def submit_new_table(self, table):
@@ -134,15 +240,27 @@ class EventBot(RedditBot):
         :param table: A string containing a reddit markdown table
         """
         for subreddit in self.subreddits:
-            self.r.submit(subreddit, self.post_title, text=table)
+            # a table that is still waiting in the outbox is replaced instead of being posted twice
+            self.queue_submit(subreddit, self.post_title, text=table, coalesce_key="table:" + subreddit)
+
+    def on_action_sent(self, action):
+        """
+        An override of RedditBot.on_action_sent().
+        Once a new table is posted, the cached search result is stale, so the post is looked up again next time.
+        """
+        if action.kind == SUBMIT:
+            EventBot.get_existing_table_post.invalidate(self, action.target)
 
     def work(self):
         table = self.create_new_table()
+        if not table:
+            return
         for subreddit in self.subreddits:
+            self.check_deadline()
             existing_post = self.get_existing_table_post(subreddit)
             if existing_post:  # if it exists
                 logger.info("Editing existing table post")
-                existing_post.edit(table)
+                self.queue_edit(existing_post, table)
             else:
                 logger.info("Submitting new table post")
                 self.submit_new_table(table)
@@ -0,0 +1,115 @@
+import io
+import threading
+from collections import namedtuple
+from xml.etree import ElementTree
+
+import requests
+
+import http_cache
+from http_cache import UpstreamError
+from config import getLogger
+from tracing import traced
+
+logger = getLogger()
+FeedItem = namedtuple('FeedItem', 'guid url title published')
+MAX_ITEMS_PER_FEED = 500
+ATOM = '{http://www.w3.org/2005/Atom}'
+FEED_ROOTS = ('rss', ATOM + 'feed')
+
+
+def feed_url_for(page_url):
+    """
+    WordPress serves a feed for every archive page at <page>/feed/, e.g. /2016/05/feed/ or /category/news/feed/.
+    """
+    return "{}/feed/".format(page_url.rstrip('/'))
+
+
+def _get_rss_item(element):
+    url = element.findtext('link', '').strip()
+    return FeedItem(guid=element.findtext('guid', '').strip() or url, url=url,
+                    title=element.findtext('title', '').strip(), published=element.findtext('pubDate', '').strip())
+
+
+def _get_atom_entry(element):
+    links = element.findall(ATOM + 'link')
+    alternate = [link for link in links if link.get('rel', 'alternate') == 'alternate']
+    url = (alternate or links or [{}])[0].get('href', '').strip()
+    published = element.findtext(ATOM + 'published', '') or element.findtext(ATOM + 'updated', '')
+    return FeedItem(guid=element.findtext(ATOM + 'id', '').strip() or url, url=url,
+                    title=element.findtext(ATOM + 'title', '').strip(), published=published.strip())
+
+
+@traced("parse.feed")
+def parse_feed(content, stop_at_guid=None):
+    """
+    Parses the items of an RSS 2.0 or Atom feed, newest first.
+    Parsing stops as soon as an item with stop_at_guid is found, so only new items are parsed.
+    :param content: The feed XML as bytes.
+    :param stop_at_guid: GUID (the id of an Atom entry) of the newest item seen on the previous read, or None to parse
+                         every item.
+    :raises xml.etree.ElementTree.ParseError if the feed is not valid XML, or is neither RSS 2.0 nor Atom
+    :return: A list of FeedItems
+    """
+    items = []
+    root = None
+    for event, element in ElementTree.iterparse(io.BytesIO(content), events=('start', 'end')):
+        if root is None:
+            root = element.tag
+            if root not in FEED_ROOTS:
+                raise ElementTree.ParseError("Not an RSS or Atom feed: root=[{}]".format(root))
+        if event != 'end':
+            continue
+        if element.tag == 'item':
+            item = _get_rss_item(element)
+        elif element.tag == ATOM + 'entry':
+            item = _get_atom_entry(element)
+        else:
+            continue
+        if item.guid == stop_at_guid:
+            break
+        items.append(item)
+        element.clear()
+    return items
+
+
+class FeedReader(object):
+    """
+    Reads WordPress feeds incrementally.
+    Requests go through the HTTP cache, so an unchanged feed costs a 304 and is not parsed again. When a feed has
+    changed, only the items newer than the last seen GUID are parsed and added to the items already known.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}  # feed url -> list of FeedItems, newest first
+
+    def read(self, feed_url, timeout=None):
+        """
+        :param feed_url: URL of the feed.
+        :param timeout: Passed to the HTTP request.
+        :raises UpstreamError if the HTTP response is anything but 200 OK or 404 Not Found.
+        :raises xml.etree.ElementTree.ParseError if the feed is not valid XML, or is neither RSS 2.0 nor Atom
+        :return: A list of FeedItems, newest first.
+        """
+        with self._lock:
+            known_items = self._items.get(feed_url)
+        r = http_cache.get(feed_url, timeout=timeout)
+        if r.status_code == requests.codes.not_found:
+            logger.info("Feed not found: url=[{}]".format(feed_url))
+            return []
+        if r.status_code != requests.codes.ok:
+            raise UpstreamError("Error reading feed: url=[{}], code=[{}]".format(feed_url, r.status_code))
+        if known_items is not None and (r.from_cache or r.not_modified):
+            return known_items
+
+        known_items = known_items or []
+        new_items = parse_feed(r.content, known_items[0].guid if known_items else None)
+        logger.info("Read feed: url=[{}], newItems=[{}]".format(feed_url, len(new_items)))
+        new_guids = {item.guid for item in new_items}
+        items = (new_items + [item for item in known_items if item.guid not in new_guids])[:MAX_ITEMS_PER_FEED]
+        with self._lock:
+            self._items[feed_url] = items
+        return items
+
+
+FEED_READER = FeedReader()
+"""The FeedReader shared by every NewsBot in the process."""
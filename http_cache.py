@@ -0,0 +1,192 @@
+import json
+import re
+import zlib
+from email.utils import parsedate_to_datetime
+from time import time
+
+import requests
+
+from config import getLogger
+from config.bot_config import get_http_cache_config, get_interval
+from deadline import get_timeout
+from store import SqliteStore
+from tracing import span
+
+logger = getLogger()
+CACHEABLE_CODES = (requests.codes.ok, requests.codes.not_found)
+MAX_AGE_PATTERN = re.compile(r"(?:s-maxage|max-age)=(\d+)")
+
+
+class UpstreamError(ValueError):
+    """
+    Raised when a website the bots scrape answers with an unexpected HTTP status.
+    """
+    pass
+
+
+class CachedResponse(object):
+    """
+    The parts of a requests.Response that the bots use, whether it came from the network or from the disk cache.
+    """
+    def __init__(self, url, status_code, headers, content, encoding=None, from_cache=False, not_modified=False):
+        """
+        :param from_cache: True if no request was made because the cached copy was still fresh.
+        :param not_modified: True if the server answered 304 Not Modified and the cached copy was used.
+        """
+        self.url = url
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.content = content
+        self.encoding = encoding
+        self.from_cache = from_cache
+        self.not_modified = not_modified
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+
+def _get_freshness_lifetime(headers, default_max_age):
+    """
+    Works out how many seconds a response may be used without asking the server again.
+    :return: Number of seconds, or None if the response must not be stored at all.
+    """
+    cache_control = headers.get('Cache-Control', '').lower()
+    if 'no-store' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        return 0
+    max_age = MAX_AGE_PATTERN.search(cache_control)
+    if max_age:
+        return int(max_age.group(1))
+    if 'Expires' in headers:
+        try:
+            return max(0, parsedate_to_datetime(headers['Expires']).timestamp() - time())
+        except (TypeError, ValueError):
+            return 0
+    return default_max_age
+
+
+class HttpCache(SqliteStore):
+    """
+    A disk-backed HTTP cache shared by every bot in the process, so pages survive restarts.
+    Fresh responses are served without a request, and stale ones are revalidated with ETag/Last-Modified,
+    so an unchanged page costs one small 304 response. Bodies are stored compressed, and the least recently used
+    responses are deleted when the cache grows past its size limit.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            status INTEGER NOT NULL,
+            headers TEXT NOT NULL,
+            encoding TEXT,
+            body BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            fresh_until REAL NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access);
+    """
+
+    def __init__(self, file_name, max_size_bytes, default_max_age=600):
+        """
+        :param file_name: Name of the database file in the data directory.
+        :param max_size_bytes: Compressed bodies are evicted once their total size passes this limit.
+        :param default_max_age: Seconds a response stays fresh when the server sends no caching headers.
+        """
+        super(HttpCache, self).__init__(file_name)
+        self.max_size_bytes = max_size_bytes
+        self.default_max_age = default_max_age
+        self._total_size = self.execute("SELECT COALESCE(SUM(size), 0) FROM responses")[0][0]
+
+    def get(self, url, timeout=None):
+        """
+        Drop-in replacement for requests.get that uses the cache.
+        :param url: The URL to request.
+        :param timeout: Passed to requests.get. If None, the http_timeout_seconds interval is used.
+                        Either way, the timeout is shortened to fit the current work cycle's deadline.
+        :raises deadline.DeadlineExceeded if the current work cycle's deadline has passed
+        :return: A CachedResponse
+        """
+        with span("http.get", url=url) as span_args:
+            response = self._get(url, get_timeout(timeout or get_interval('http_timeout_seconds')))
+            span_args.update(status=response.status_code, from_cache=response.from_cache,
+                             not_modified=response.not_modified)
+            return response
+
+    def _get(self, url, timeout):
+        now = time()
+        rows = self.execute("SELECT * FROM responses WHERE url = ?", (url,))
+        entry = rows[0] if rows else None
+        if entry and entry['fresh_until'] > now:
+            self.execute("UPDATE responses SET last_access = ? WHERE url = ?", (now, url))
+            return self._to_response(entry, from_cache=True)
+
+        request_headers = {}
+        if entry:
+            # header names are stored as the server sent them, e.g. 'ETag' or 'etag'
+            cached_headers = requests.structures.CaseInsensitiveDict(json.loads(entry['headers']))
+            if 'ETag' in cached_headers:
+                request_headers['If-None-Match'] = cached_headers['ETag']
+            if 'Last-Modified' in cached_headers:
+                request_headers['If-Modified-Since'] = cached_headers['Last-Modified']
+
+        r = requests.get(url, headers=request_headers, timeout=timeout)
+        if entry and r.status_code == requests.codes.not_modified:
+            lifetime = _get_freshness_lifetime(r.headers, self.default_max_age) or 0
+            self.execute("UPDATE responses SET fresh_until = ?, last_access = ? WHERE url = ?",
+                         (now + lifetime, now, url))
+            return self._to_response(entry, not_modified=True)
+
+        headers = requests.structures.CaseInsensitiveDict(r.headers)
+        lifetime = _get_freshness_lifetime(headers, self.default_max_age)
+        if r.status_code in CACHEABLE_CODES and lifetime is not None:
+            self._store(url, r.status_code, headers, r.encoding, r.content, now + lifetime, now)
+        return CachedResponse(url, r.status_code, headers, r.content, r.encoding)
+
+    @staticmethod
+    def _to_response(entry, from_cache=False, not_modified=False):
+        return CachedResponse(entry['url'], entry['status'], json.loads(entry['headers']),
+                              zlib.decompress(entry['body']), entry['encoding'],
+                              from_cache=from_cache, not_modified=not_modified)
+
+    def _store(self, url, status, headers, encoding, content, fresh_until, now):
+        body = zlib.compress(content)
+        with self.transaction() as conn:
+            old = conn.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (url, status, json.dumps(dict(headers)), encoding, body, len(body), fresh_until, now))
+            self._total_size += len(body) - (old['size'] if old else 0)
+            if self._total_size > self.max_size_bytes:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        """
+        Deletes the least recently used responses until the cache is under its size limit.
+        Must be called inside a transaction.
+        """
+        evicted = 0
+        for row in conn.execute("SELECT url, size FROM responses ORDER BY last_access").fetchall():
+            if self._total_size <= self.max_size_bytes:
+                break
+            conn.execute("DELETE FROM responses WHERE url = ?", (row['url'],))
+            self._total_size -= row['size']
+            evicted += 1
+        logger.info("Evicted HTTP responses: count=[{}], cacheSize=[{}]".format(evicted, self._total_size))
+
+
+def get_http_cache():
+    """
+    :return: The HttpCache shared by every bot in the process.
+    """
+    settings = get_http_cache_config()
+    return HttpCache.shared(settings['file_name'], settings['max_size_mb'] * 1024 * 1024,
+                            settings['default_max_age_seconds'])
+
+
+def get(url, timeout=None):
+    """
+    Requests a URL through the shared HttpCache.
+    """
+    return get_http_cache().get(url, timeout=timeout)
@@ -0,0 +1,227 @@
+import gc
+import os
+import signal
+import sys
+import threading
+import tracemalloc
+import types
+from collections import Counter
+from functools import lru_cache
+from time import monotonic
+
+import praw
+import requests
+from praw.handlers import DefaultHandler
+
+import cache
+from config import bot_config, getLogger, root
+from config.bot_config import get_memory_config
+
+logger = getLogger()
+memory_logger = getLogger('memdiag')  # writes to logs/memory.log, see log_config.ini
+CHECK_SECONDS = 5
+# praw objects refer to the Reddit session that made them, which refers to the shared handler and its HTTP session.
+# Those are shared by the whole process, so they are not charged to a cache that holds a praw object.
+_SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, praw.Reddit, DefaultHandler,
+                  requests.Session)
+
+
+@lru_cache(maxsize=4096)
+def get_module_name(filename):
+    """
+    :param filename: The file of a stack frame
+    :return: A (name, is_local) tuple. name is the dotted name of a module in this repository, e.g. 'newsbot' or
+             'config.bot_config', or the top-level package of an installed module, e.g. 'bs4', or None for the
+             standard library. is_local is True for modules in this repository.
+    """
+    path = os.path.abspath(filename)
+    parts = path.split(os.sep)
+    if 'site-packages' in parts:
+        rest = parts[parts.index('site-packages') + 1:]
+        return (os.path.splitext(rest[0])[0] if rest else None), False
+    if path.startswith(root + os.sep):
+        return os.path.splitext(os.path.relpath(path, root))[0].replace(os.sep, '.'), True
+    return None, False
+
+
+def get_owner(traceback):
+    """
+    Names the module an allocation belongs to: the module of this repository nearest to the allocation in its
+    traceback, e.g. 'newsbot' for a BeautifulSoup tree parsed in newsbot.py. If no module of this repository was on
+    the stack, the installed package that made the allocation is used, e.g. 'praw'.
+    :param traceback: A tracemalloc.Traceback, which lists the oldest frame first
+    """
+    package = None
+    for frame in reversed(traceback):
+        name, is_local = get_module_name(frame.filename)
+        if is_local:
+            return name
+        package = package or name
+    return package or '<python>'
+
+
+def get_owner_sizes(snapshot):
+    """
+    :param snapshot: A tracemalloc.Snapshot taken with more than one frame per traceback
+    :return: A Counter of owner (see get_owner) -> bytes allocated and still alive
+    """
+    sizes = Counter()
+    for stat in snapshot.statistics('traceback'):
+        sizes[get_owner(stat.traceback)] += stat.size
+    return sizes
+
+
+def get_deep_size(obj):
+    """
+    Approximates the memory kept alive by an object: its own size and the sizes of everything it refers to.
+    Classes, modules, and functions are not followed, since they are not kept alive by the object, and neither are
+    Reddit sessions, request handlers, and HTTP sessions, which are shared by every praw object.
+    Objects that are shared with other objects are included too, so sizes of different objects may overlap.
+    :return: Number of bytes
+    """
+    seen = set()
+    pending = [obj]
+    size = 0
+    while pending:
+        item = pending.pop()
+        if id(item) in seen or isinstance(item, _SKIPPED_TYPES):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item, 0)
+        pending.extend(gc.get_referents(item))
+    return size
+
+
+def get_cache_sizes():
+    """
+    :return: A list of (cache name, number of entries, approximate bytes kept alive) tuples, biggest first.
+    """
+    sizes = []
+    for c in cache.get_caches():
+        values = c.values()
+        sizes.append((c.name, len(values), get_deep_size(values)))
+    return sorted(sizes, key=lambda size: size[2], reverse=True)
+
+
+def _format_kb(size):
+    return "{:+.1f} KB".format(size / 1024) if size else "0 KB"
+
+
+class MemoryMonitor(threading.Thread):
+    """
+    Takes tracemalloc snapshots while memory diagnostics are enabled, and writes the memory held by each module and
+    cache, and the lines that grew most since the last snapshot, to logs/memory.log.
+    Diagnostics can be turned on and off while the bots run: by the 'enabled' flag in the 'memory' section of
+    bot_config.yaml, or by toggle(), which Dispatch calls on SIGUSR1. A toggle lasts until bot_config.yaml is reloaded.
+    """
+    def __init__(self):
+        super(MemoryMonitor, self).__init__(daemon=True, name="MemoryMonitor")
+        self.stop_event = threading.Event()
+        self._wake = threading.Event()
+        self.override = None  # True or False after a toggle, None to follow bot_config.yaml
+        self._started_tracing = False
+        self._previous = None  # (snapshot, Counter of owner sizes) of the last report
+        self._last_report = None  # monotonic time of the last report
+        bot_config.add_reload_listener(self.on_config_reload)
+
+    def is_enabled(self):
+        return get_memory_config()['enabled'] if self.override is None else self.override
+
+    def toggle(self):
+        """
+        Turns diagnostics on if they are off, or off if they are on. Safe to call from a signal handler.
+        """
+        self.override = not self.is_enabled()
+        self._wake.set()
+
+    def on_config_reload(self, config):
+        self.override = None
+        self._wake.set()
+
+    def stop(self):
+        bot_config.remove_reload_listener(self.on_config_reload)
+        self.stop_event.set()
+        self._wake.set()
+
+    def run(self):
+        """
+        An override of Thread.run(). Checks whether diagnostics are enabled every few seconds, until stopped.
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Could not report memory use")
+            self._wake.wait(CHECK_SECONDS)
+            self._wake.clear()
+        self.stop_tracing()
+
+    def check(self):
+        """
+        Starts or stops tracing to match is_enabled(), and writes a report when one is due.
+        """
+        if not self.is_enabled():
+            self.stop_tracing()
+            return
+        settings = get_memory_config()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(settings['frames'])
+            self._started_tracing = True
+            logger.info("Memory diagnostics started: frames=[{}], intervalSeconds=[{}]".format(
+                settings['frames'], settings['interval_seconds']))
+        if self._last_report is None or monotonic() - self._last_report >= settings['interval_seconds']:
+            self.report(settings['top'])
+
+    def stop_tracing(self):
+        """
+        Stops tracing, if this monitor started it, and forgets the last snapshot.
+        """
+        if self._started_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+            logger.info("Memory diagnostics stopped")
+        self._started_tracing = False
+        self._previous = None
+        self._last_report = None
+
+    def report(self, top):
+        """
+        Takes a snapshot and writes it to logs/memory.log, compared with the previous snapshot.
+        :param top: Number of modules and lines written
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        traced, peak = tracemalloc.get_traced_memory()
+        owners = get_owner_sizes(snapshot)
+        previous_snapshot, previous_owners = self._previous or (None, Counter())
+        memory_logger.info("Memory snapshot: traced=[{:.1f} MB], peak=[{:.1f} MB], tracingOverhead=[{:.1f} MB]".format(
+            traced / 2 ** 20, peak / 2 ** 20, tracemalloc.get_tracemalloc_memory() / 2 ** 20))
+
+        growth = {owner: owners[owner] - previous_owners[owner] for owner in set(owners) | set(previous_owners)}
+        for owner in sorted(growth, key=lambda owner: (growth[owner], owners[owner]), reverse=True)[:top]:
+            memory_logger.info("Module memory: module=[{}], size=[{:.1f} KB], growth=[{}]".format(
+                owner, owners[owner] / 1024, _format_kb(growth[owner])))
+
+        for name, entries, size in get_cache_sizes():
+            memory_logger.info("Cache memory: name=[{}], entries=[{}], size=[{:.1f} KB]".format(
+                name, entries, size / 1024))
+
+        if previous_snapshot is not None:
+            for stat in snapshot.compare_to(previous_snapshot, 'lineno')[:top]:
+                frame = stat.traceback[0]
+                memory_logger.info("Line growth: line=[{}:{}], module=[{}], size=[{:.1f} KB], growth=[{}], "
+                                   "countGrowth=[{:+d}]".format(frame.filename, frame.lineno,
+                                                                get_owner(stat.traceback), stat.size / 1024,
+                                                                _format_kb(stat.size_diff), stat.count_diff))
+        self._previous = (snapshot, owners)
+        self._last_report = monotonic()
+
+
+def install_signal_handler(monitor):
+    """
+    Makes SIGUSR1 toggle a MemoryMonitor. Must be called from the main thread.
+    Does nothing on systems without SIGUSR1, e.g. Windows.
+    """
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: monitor.toggle())
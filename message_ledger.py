@@ -0,0 +1,73 @@
+from time import time
+
+from store import SqliteStore
+
+# the states a message goes through
+SEEN = 'seen'  # fetched from the inbox, not handled yet
+IGNORED = 'ignored'  # has no command, and was marked read
+REPLYING = 'replying'  # a reply is waiting in the outbox
+REPLIED = 'replied'  # the reply was sent, but the message is not marked read yet
+DONE = 'done'  # the reply was sent and the message was marked read
+FAILED = 'failed'  # the outbox dropped the reply, so the message is marked read without one
+STATES = (SEEN, IGNORED, REPLYING, REPLIED, DONE, FAILED)
+
+
+class MessageLedger(SqliteStore):
+    """
+    A local record of the inbox messages a bot has handled, keyed by account and message fullname.
+    Reddit's unread flag is only cleared after a message is handled, so a crash or rate limit in between brings the
+    message back. The ledger remembers how far each message got, so it is never handled twice.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            account TEXT NOT NULL,
+            fullname TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (account, fullname)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS messages_updated_at ON messages (updated_at);
+    """
+
+    def get_states(self, account, fullnames):
+        """
+        Looks up a batch of messages, recording the ones that were never seen as SEEN.
+        :param fullnames: Fullnames of messages, e.g. ["t4_abc", "t1_def"]
+        :return: A dict of fullname -> state
+        """
+        fullnames = list(fullnames)
+        if not fullnames:
+            return {}
+        now = time()
+        with self.transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?)",
+                             [(account, fullname, SEEN, now) for fullname in fullnames])
+            rows = conn.execute("SELECT fullname, state FROM messages WHERE account = ? AND fullname IN ({})".format(
+                ", ".join("?" * len(fullnames))), [account] + fullnames).fetchall()
+        return {row['fullname']: row['state'] for row in rows}
+
+    def get_state(self, account, fullname):
+        """
+        :return: The state of a message, or None if it was never seen.
+        """
+        rows = self.execute("SELECT state FROM messages WHERE account = ? AND fullname = ?", (account, fullname))
+        return rows[0]['state'] if rows else None
+
+    def set_state(self, account, fullname, state):
+        if state not in STATES:
+            raise ValueError("Unknown message state: state=[{}]".format(state))
+        self.execute("INSERT INTO messages VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (account, fullname) DO UPDATE SET state = excluded.state, "
+                     "updated_at = excluded.updated_at", (account, fullname, state, time()))
+
+    def prune(self, before):
+        """
+        Forgets finished messages (DONE, IGNORED or FAILED) that were last updated before a time.
+        They are marked read, so they do not come back in the unread listing.
+        :param before: A time.time() value
+        :return: Number of messages forgotten
+        """
+        with self.transaction() as conn:
+            return conn.execute("DELETE FROM messages WHERE updated_at < ? AND state IN (?, ?, ?)",
+                                (before, DONE, IGNORED, FAILED)).rowcount
@@ -1,15 +1,22 @@
 import requests
+import http_cache
+from http_cache import UpstreamError
 import datetime
-from cachetools import ttl_cache
 from collections import namedtuple
 from bs4 import BeautifulSoup
+from xml.etree.ElementTree import ParseError
 from random import randint
 from config import getLogger
-from config.bot_config import get_interval, get_subreddits
+from config.bot_config import get_interval, get_newsbot_config, get_subreddits
+from article_store import ArticleStore, get_category_paths
 from bots import RedditBot
+from cache import shared_cache
+from feed import FEED_READER, feed_url_for
+from outbox import SUBMIT
+from tracing import span, traced
 
 # region constants
-SUBMISSION_INTERVAL_HOURS = get_interval('submission_interval_hours')
+NEWS_BASE_URL = "http://www.upressonline.com"
 # endregion
 
 # region globals
@@ -39,21 +46,45 @@ def clean_dir(obj):
     :return: A list of public methods and/or attributes of the object.
     """
     return [d for d in dir(obj) if not d.startswith('_') and not d.endswith('_')]
+
+
+def _clean_title(title):
+    """
+    Replaces the curly quotes WordPress puts in titles with plain ones.
+    """
+    return title.replace("“", '"').replace("”", '"').replace("’", "'")
+
+
+@traced("parse.link_list")
+def parse_link_list(html):
+    """
+    Parses a web page's HTML for links with a particular attribute (rel=bookmark),
+    which are assumed to be links to articles on the school paper's website.
+    :param html: HTML of an archive or category page
+    :return: A list of Links (namedtuples)
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    return [Link(url=link['href'], title=_clean_title(link.get_text())) for link in soup.find_all(rel='bookmark')]
 # endregion
 
 
 class NewsBot(RedditBot):
     def __init__(self, user_name, *args, **kwargs):
         super(NewsBot, self).__init__(user_name=user_name, *args, **kwargs)
-        self.base_url = "http://www.upressonline.com"
+        self.base_url = NEWS_BASE_URL
+        self.article_store = ArticleStore.shared(get_newsbot_config()['article_store_file'])
         self.subreddits = get_subreddits()
         self._last_created = None
 
 
-    @ttl_cache(ttl=86400)
+    def apply_config(self):
+        self.subreddits = get_subreddits()
+
+    @shared_cache('submitted_links', key=lambda self, url, subreddit: (url, subreddit))
     def is_already_submitted(self, url, subreddit):
         """
         Checks if a URL has already been shared on self.subreddit.
+        Submissions recorded in the article store are checked first, so Reddit is only searched for unknown URLs.
         Because praw.Reddit.search returns a generator instead of a list,
         we have to actually loop through it to see if the post exists.
         If no post exists, the loop won't happen and it will return False.
@@ -61,10 +92,13 @@ class NewsBot(RedditBot):
         :param subreddit: The subreddit where the url will be searched for
         :return: True if the url has already been posted to the subreddit
         """
-        for link in self.r.search("url:"+url, subreddit=subreddit):
-            if link:
-                return True
-        return False
+        if self.article_store.is_submitted(url, subreddit):
+            return True
+        with span("praw.search", subreddit=subreddit):
+            found = any(link for link in self.r.search("url:"+url, subreddit=subreddit))
+        if found:
+            self.article_store.mark_submitted(url, subreddit)
+        return found
 
     def get_articles_from_today(self):
         """
@@ -85,7 +119,9 @@ class NewsBot(RedditBot):
         url = "{}/category/{}".format(self.base_url, category_name)
         if category_subname:
             url = "{}/{}".format(url, category_subname)
-        return self._get_link_list(url)
+        links = self._get_link_list(url)
+        self.article_store.add_articles(links, get_category_paths(category_name, category_subname))
+        return links
 
     def get_articles_by_date(self, year, month=None, day=None):
         """
@@ -108,31 +144,54 @@ class NewsBot(RedditBot):
                 url = "{}/{:02}".format(url, day)
         elif day:
             raise ValueError("Cannot specify day without month.")
-        return self._get_link_list(url)
+        links = self._get_link_list(url)
+        self.article_store.add_articles(links)
+        return links
     
-    @ttl_cache(ttl=600)  # cache for 10 minutes todo configurable ttl
+    @traced("fetch.link_list")
+    @shared_cache('link_lists', key=lambda self, url: url)
     def _get_link_list(self, url):
         """
-        Parses a web page's HTML for links with a particular attribute (rel=bookmark),
-        which are assumed to be links to articles on the school paper's website.
+        Gets the articles listed on an archive page, from the page's feed or by scraping its HTML,
+        depending on the article_source setting in bot_config.yaml. If the feed cannot be read, the HTML is scraped.
         :param url: The url to the page that should contain links to articles
-        :raises ValueError if the HTTP response is anything but 200 OK.
+        :raises UpstreamError if the HTTP response is anything but 200 OK.
         :return: A list of Links (namedtuples)
         """
-        link_list = []
-        r = requests.get(url)
+        if get_newsbot_config()['article_source'] == 'feed':
+            try:
+                return self._get_feed_link_list(url)
+            except (UpstreamError, ParseError):
+                logger.warning("Could not read feed, scraping HTML instead: url=[{}]".format(url))
+        return self._get_html_link_list(url)
+
+    @staticmethod
+    def _get_feed_link_list(url):
+        """
+        Reads the WordPress feed of an archive page.
+        :param url: The url to the page that should contain links to articles
+        :raises UpstreamError if the HTTP response is anything but 200 OK or 404 Not Found.
+        :raises xml.etree.ElementTree.ParseError if the feed is not valid XML
+        :return: A list of Links (namedtuples)
+        """
+        return [Link(url=item.url, title=_clean_title(item.title)) for item in FEED_READER.read(feed_url_for(url))]
+
+    @staticmethod
+    def _get_html_link_list(url):
+        """
+        Downloads an archive page and scrapes its HTML for links to articles.
+        :param url: The url to the page that should contain links to articles
+        :raises UpstreamError if the HTTP response is anything but 200 OK.
+        :return: A list of Links (namedtuples)
+        """
+        r = http_cache.get(url)
         if r.status_code == requests.codes.ok:
-            soup = BeautifulSoup(r.content, 'html.parser')
-            for link in soup.find_all(rel='bookmark'):
-                url = link['href']
-                title = link.get_text().replace("“", '"').replace("”", '"').replace("’", "'")
-                link_list.append(Link(url=url, title=title))
-            return link_list
+            return parse_link_list(r.content)
         elif r.status_code == requests.codes.not_found:
             logger.info("No links found: url=[{}], code=[{}]".format(url, r.status_code))
-            return link_list
+            return []
         else:
-            raise ValueError("Error talking to UPress: url=[{}], code=[{}]".format(url, r.status_code))
+            raise UpstreamError("Error talking to UPress: url=[{}], code=[{}]".format(url, r.status_code))
 
     def submit_link(self, link_tuple):
         """
@@ -140,14 +199,26 @@ class NewsBot(RedditBot):
         :param link_tuple: A namedtuple with a url and a title.
         """
         for subreddit in self.subreddits:
+            self.check_deadline()
             if self.is_already_submitted(link_tuple.url, subreddit):
                 logger.info("Link already submitted: subreddit=[{}], url=[{}]".format(subreddit, link_tuple.url))
                 # sleep for shorter time if time to submit but random article was already submitted
                 self.sleep_interval = 5
             else:
                 logger.info("Submitting link: subreddit=[{}], url=[{}]".format(subreddit, link_tuple.url))
-                self.r.submit(subreddit, link_tuple.title, url=link_tuple.url)
+                self.queue_submit(subreddit, link_tuple.title, url=link_tuple.url,
+                                  coalesce_key="link:{}:{}".format(subreddit, link_tuple.url))
                 self._last_created = datetime.datetime.utcnow()
+                # search results lag behind new submissions, and the submission is only sent after the work cycle,
+                # so remember this one ourselves
+                NewsBot.is_already_submitted.prime(True, self, link_tuple.url, subreddit)
+
+    def on_action_sent(self, action):
+        """
+        An override of RedditBot.on_action_sent(). Records sent link submissions in the article store.
+        """
+        if action.kind == SUBMIT and action.payload['url']:
+            self.article_store.mark_submitted(action.payload['url'], action.target)
 
     @staticmethod
     def _get_random_article(articles):
@@ -181,21 +252,34 @@ class NewsBot(RedditBot):
     def get_random_article_by_date(self, year, month=None, day=None):
         """
         Get articles from a certain date, and return a random one.
+        Articles in the local article store (see backfill.py) are picked without scraping the website, skipping
+        articles that were already submitted to every subreddit.
         :param year:
         :param month:
         :param day:
         :return: A Link representing a random article that was published on a certain date.
         """
+        article = self.article_store.get_random_article_by_date(year, month, day, unsubmitted_to=self.subreddits)
+        if article:
+            logger.info("Random article from store: url=[{}], title=[{}]".format(article.url, article.title))
+            return article
         articles = self.get_articles_by_date(year, month, day)
         return NewsBot._get_random_article(articles)
 
     def get_random_article_by_category(self, category, subcategory=None):
         """
         Get articles from a certain category, and return a random one.
+        Articles in the local article store (see backfill.py) are picked without scraping the website, skipping
+        articles that were already submitted to every subreddit.
         :param category:
         :param subcategory:
         :return: A Link representing a random article that was published in a certain category.
         """
+        article = self.article_store.get_random_article_by_category(category, subcategory,
+                                                                    unsubmitted_to=self.subreddits)
+        if article:
+            logger.info("Random article from store: url=[{}], title=[{}]".format(article.url, article.title))
+            return article
         articles = self.get_articles_by_category(category, subcategory)
         return NewsBot._get_random_article(articles)
 
@@ -235,7 +319,7 @@ class NewsBot(RedditBot):
         is_time = True
         me = self.r.get_me()
         now = datetime.datetime.utcnow()
-        target_interval = datetime.timedelta(hours=SUBMISSION_INTERVAL_HOURS)
+        target_interval = datetime.timedelta(hours=get_interval('submission_interval_hours'))
         logger.info("Checking if time to submit: targetInterval=[{}]".format(target_interval))
 
         if self._last_created:
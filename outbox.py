@@ -0,0 +1,91 @@
+import json
+from collections import namedtuple
+from time import time
+
+from store import SqliteStore
+
+# lower numbers are sent first
+PRIORITY_REPLY = 0
+PRIORITY_SUBMIT = 10
+PRIORITY_EDIT = 20
+
+SUBMIT = 'submit'
+EDIT = 'edit'
+SEND_MESSAGE = 'send_message'
+REPLY = 'reply'
+
+Action = namedtuple('Action', 'id account kind target payload priority attempts')
+
+
+class Outbox(SqliteStore):
+    """
+    A durable queue of Reddit writes (submissions, edits, and messages) waiting to be sent, one queue per account.
+    Bots add actions during their work cycle instead of calling Reddit, and the actions are sent after the cycle
+    (see RedditBot.flush_outbox), so actions survive crashes and rate limits.
+    An action added with a coalesce key replaces the pending action with the same key, so e.g. several edits of
+    the same post before the queue is flushed cost one API call, and the last edit wins.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS actions (
+            id INTEGER PRIMARY KEY,
+            account TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            target TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            coalesce_key TEXT UNIQUE,
+            not_before REAL NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS actions_account_priority ON actions (account, priority, id);
+    """
+
+    def add(self, account, kind, target, payload, priority, coalesce_key=None):
+        """
+        Queues an action. If an action with the same account and coalesce key is waiting, its payload and priority
+        are replaced instead, and it keeps its place in the queue.
+        :param account: Username of the account that sends the action
+        :param kind: SUBMIT, EDIT, SEND_MESSAGE, or REPLY
+        :param target: What the action applies to, e.g. a subreddit, a post's fullname, or a username
+        :param payload: A dict of the arguments of the praw call
+        :param priority: PRIORITY_REPLY, PRIORITY_SUBMIT, PRIORITY_EDIT, or any other int (lower is sent first)
+        :param coalesce_key: Actions with the same key replace each other, or None to never coalesce
+        """
+        key = None if coalesce_key is None else "{}:{}".format(account, coalesce_key)
+        self.execute("""
+            INSERT INTO actions (account, kind, target, payload, priority, coalesce_key) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (coalesce_key) DO UPDATE SET
+                kind = excluded.kind, target = excluded.target, payload = excluded.payload,
+                priority = MIN(priority, excluded.priority)
+        """, (account, kind, target, json.dumps(payload), priority, key))
+
+    def get_pending(self, account, limit, now=None):
+        """
+        :return: A list of up to limit Actions of an account that may be sent now, highest priority first.
+        """
+        rows = self.execute("""
+            SELECT id, account, kind, target, payload, priority, attempts FROM actions
+            WHERE account = ? AND not_before <= ? ORDER BY priority, id LIMIT ?
+        """, (account, time() if now is None else now, limit))
+        return [Action(row['id'], row['account'], row['kind'], row['target'], json.loads(row['payload']),
+                       row['priority'], row['attempts']) for row in rows]
+
+    def count(self, account):
+        return self.execute("SELECT COUNT(*) FROM actions WHERE account = ?", (account,))[0][0]
+
+    def complete(self, action):
+        """
+        Removes an action that was sent, or that is given up on.
+        An action that was coalesced with a newer one while it was being sent is kept, so the newer one is sent too.
+        """
+        self.execute("DELETE FROM actions WHERE id = ? AND payload = ?", (action.id, json.dumps(action.payload)))
+
+    def retry(self, action, not_before, count_attempt=True):
+        """
+        Puts an action back to be sent again after a time.
+        :param not_before: A time.time() value
+        :param count_attempt: False if the action did not fail, e.g. because it was held back by Reddit's rate limit.
+        """
+        self.execute("UPDATE actions SET attempts = attempts + ?, not_before = ? WHERE id = ?",
+                     (int(count_attempt), not_before, action.id))
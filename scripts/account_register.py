@@ -1,7 +1,14 @@
 import configparser
+import html
 import praw
+import secrets
+import threading
 import webbrowser
-from config.praw_config import CredKeys, OAUTH_CRED_KEYS, set_reddit_oauth_refresh_token, PRAW_FILE_PATH, get_reddit_oath_credentials
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from config.praw_config import CredKeys, OAUTH_CRED_KEYS, set_reddit_oauth_refresh_token, PRAW_FILE_PATH, get_reddit_oath_credentials, \
+    set_reddit_oauth_refresh_tokens
 
 
 def get_sites_with_scopes(_parser=None):
@@ -28,6 +35,14 @@ def get_sites_without_refresh_tokens():
     return [(site_name, scope) for (site_name, scope) in get_sites_with_scopes(cp)if not cp[site_name][refresh_config_key]]
 
 
+def get_oauth_reddit(account_name, oauth_credentials):
+    r = praw.Reddit("Getting first OAuth refresh token for /u/{}".format(account_name))
+    r.set_oauth_app_info(client_id=oauth_credentials[OAUTH_CRED_KEYS[CredKeys.client]],
+                         client_secret=oauth_credentials[OAUTH_CRED_KEYS[CredKeys.secret]],
+                         redirect_uri=oauth_credentials[OAUTH_CRED_KEYS[CredKeys.uri]])
+    return r
+
+
 def set_oauth_refresh_token(account_name, oauth_scope):
     """
     Triggers the login process to generate a refresh token, and saves the token. The process steps are:
@@ -38,12 +53,7 @@ def set_oauth_refresh_token(account_name, oauth_scope):
     :param account_name: The Reddit user who will be logged in.
     :param oauth_scope: A string of Oauth permissions that the automated program will have on behalf of the Reddit user.
     """
-    oauth_credentials = get_reddit_oath_credentials(account_name)
-    r = praw.Reddit("Getting first OAuth refresh token for /u/{}".format(account_name))
-    r.set_oauth_app_info(client_id=oauth_credentials[OAUTH_CRED_KEYS[CredKeys.client]],
-                         client_secret=oauth_credentials[OAUTH_CRED_KEYS[CredKeys.secret]],
-                         redirect_uri=oauth_credentials[OAUTH_CRED_KEYS[CredKeys.uri]])
-
+    r = get_oauth_reddit(account_name, get_reddit_oath_credentials(account_name))
     url = r.get_authorize_url(state=account_name, scope=oauth_scope, refreshable=True)
     webbrowser.open(url)
     code = input("Enter code: ")
@@ -54,14 +64,167 @@ def set_oauth_refresh_token(account_name, oauth_scope):
     set_reddit_oauth_refresh_token(account_name, refresh_token)
 
 
-def register_new_accounts():
+# region BATCH
+class OAuthCallbackHandler(BaseHTTPRequestHandler):
+    """
+    Answers the redirects from Reddit's authorization page, and hands the code in each one to the server's on_code.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path not in self.server.callback_paths:
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        message = self.server.on_code(*(query.get(key, [None])[0] for key in ('state', 'code', 'error')))
+        body = "<html><body><p>{}</p></body></html>".format(html.escape(message)).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # the batch prints its own progress
+
+
+class OAuthCallbackServer(ThreadingHTTPServer):
+    """
+    A local web server at an oauth_redirect_uri, so the codes in Reddit's redirects do not have to be copied by hand.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, on_code):
+        """
+        :param address: A (host, port) tuple
+        :param on_code: A function of (state, code, error) that returns the message shown in the browser
+        """
+        super(OAuthCallbackServer, self).__init__(address, OAuthCallbackHandler)
+        self.callback_paths = set()
+        self.on_code = on_code
+
+
+def get_refresh_token(r, account_name, oauth_scope, code):
+    """
+    Exchanges a code for a refresh token. If the identity scope was granted, it also checks that the code was given by
+    the right account, since the browser may still be logged in as the previous one.
+    """
+    access_information = r.get_access_information(code)
+    if 'identity' in oauth_scope.split():
+        user_name = str(r.get_me())
+        if user_name.lower() != account_name.lower():
+            raise ValueError("Authorized by /u/{} instead of /u/{}".format(user_name, account_name))
+    return access_information['refresh_token']
+
+
+class BatchRegistration(object):
+    """
+    Gets refresh tokens for many accounts in one go. The authorization page of each account is opened in turn, and a
+    local callback server catches the redirect, so the next account can be authorized right away while the code of
+    the previous one is exchanged in the background. All tokens are saved in one write of praw.ini at the end.
+    """
+
+    def __init__(self, accounts, open_browser=True, timeout=300, workers=8):
+        """
+        :param accounts: A list of (account name, oauth scope) tuples, like get_sites_without_refresh_tokens() returns
+        :param open_browser: If False, the authorization URLs are only printed
+        :param timeout: Seconds to wait for each account's redirect before moving on to the next account
+        :param workers: Number of codes exchanged at the same time
+        """
+        self.open_browser = open_browser
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.pending = {}  # state -> (account name, oauth scope, praw.Reddit, threading.Event)
+        self.futures = {}  # account name -> Future of its refresh token
+        self.errors = {}  # account name -> error
+        self.servers = {}  # (host, port) -> OAuthCallbackServer
+        self.urls = []
+        for account_name, oauth_scope in accounts:
+            oauth_credentials = get_reddit_oath_credentials(account_name)
+            r = get_oauth_reddit(account_name, oauth_credentials)
+            state = secrets.token_urlsafe(16)
+            self.pending[state] = (account_name, oauth_scope, r, threading.Event())
+            self.urls.append((state, r.get_authorize_url(state=state, scope=oauth_scope, refreshable=True)))
+            redirect_uri = urlparse(oauth_credentials[OAUTH_CRED_KEYS[CredKeys.uri]])
+            address = (redirect_uri.hostname, redirect_uri.port or 80)
+            if address not in self.servers:
+                self.servers[address] = OAuthCallbackServer(address, self.on_code)
+            self.servers[address].callback_paths.add(redirect_uri.path or "/")
+
+    def on_code(self, state, code, error):
+        # the account is taken from pending and its outcome recorded in one step, so run() sees either both or neither
+        with self.lock:
+            account_name, oauth_scope, r, received = self.pending.pop(state, (None, None, None, None))
+            if account_name is None:
+                return "Unknown or already used authorization. Nothing was saved."
+            if error or not code:
+                self.errors[account_name] = error or "no code"
+                message = "Authorization of /u/{} failed: {}".format(account_name, self.errors[account_name])
+            else:
+                self.futures[account_name] = self.executor.submit(get_refresh_token, r, account_name, oauth_scope,
+                                                                  code)
+                message = "Authorized /u/{}. You can close this page.".format(account_name)
+        print(message)
+        received.set()
+        return message
+
+    def run(self):
+        """
+        Authorizes each account and saves the refresh tokens that were received.
+        :return: A dict of account name -> error, for the accounts that did not get a refresh token
+        """
+        for server in self.servers.values():
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            for state, url in self.urls:
+                with self.lock:
+                    if state not in self.pending:
+                        continue  # already authorized from a printed URL
+                    account_name, _, _, received = self.pending[state]
+                print("Log in as /u/{} and allow access: {}".format(account_name, url))
+                if self.open_browser:
+                    webbrowser.open(url)
+                if not received.wait(self.timeout):
+                    print("No authorization received for /u/{}, skipping it.".format(account_name))
+            with self.lock:
+                # redirects that arrive from now on are turned away, instead of being authorized but never saved
+                for account_name, _, _, _ in self.pending.values():
+                    self.errors.setdefault(account_name, "timed out")
+                self.pending.clear()
+                futures = dict(self.futures)
+            tokens = {}
+            for account_name, future in futures.items():
+                try:
+                    tokens[account_name] = future.result()
+                except Exception as e:
+                    with self.lock:
+                        self.errors[account_name] = e
+        finally:
+            for server in self.servers.values():
+                server.shutdown()
+                server.server_close()
+            self.executor.shutdown(wait=False)
+        if tokens:
+            print("Saving {} refresh tokens.".format(len(tokens)))
+            set_reddit_oauth_refresh_tokens(tokens)
+        for account_name, error in self.errors.items():
+            print("Could not register /u/{}: {}".format(account_name, error))
+        return self.errors
+# endregion
+
+
+def register_new_accounts(batch=False, **batch_options):
     """
     High-level helper function that gets all Reddit users in praw.ini that have no refresh token, and triggers the login
     process for each of them.
+    :param batch: If True, the accounts are registered with a BatchRegistration, which takes batch_options.
     """
     new_accounts = get_sites_without_refresh_tokens()
     if not new_accounts:
         print("No new accounts are in the PRAW config file.")
+    elif batch:
+        BatchRegistration(new_accounts, **batch_options).run()
     else:
         for (account, scope) in new_accounts:
             set_oauth_refresh_token(account, scope)
@@ -79,18 +242,31 @@ def main():
                     help="Find all new accounts in the config file, and set their refresh tokens.")
     ap.add_argument("--account-names", "-a", dest="account_names", nargs="+", default=[], choices=choices,
                     help="Only set refresh tokens for specific accounts.")
+    ap.add_argument("--batch", "-b", dest="batch", action="store_true",
+                    help="Catch Reddit's redirects with a local server at the oauth_redirect_uri instead of asking for "
+                         "each code, and save all refresh tokens at once.")
+    ap.add_argument("--no-browser", dest="open_browser", action="store_false",
+                    help="In batch mode, print the authorization URLs instead of opening them.")
+    ap.add_argument("--timeout", dest="timeout", type=int, default=300,
+                    help="In batch mode, seconds to wait for each account's authorization.")
+    ap.add_argument("--workers", dest="workers", type=int, default=8,
+                    help="In batch mode, number of codes exchanged for refresh tokens at the same time.")
     args = ap.parse_args()
+    batch_options = {'open_browser': args.open_browser, 'timeout': args.timeout, 'workers': args.workers}
 
     if args.only_new_accounts and args.account_names:
         print("You cannot have both new-accounts and account-names set.")
     elif args.only_new_accounts:
         print("Registering all new accounts")
-        register_new_accounts()
+        register_new_accounts(args.batch, **batch_options)
     elif args.account_names:
         print("Registering accounts: {}".format(", ".join(account for account in args.account_names)))
-        for account in args.account_names:
-            scope = scopes[account]
-            set_oauth_refresh_token(account, scope)
+        if args.batch:
+            BatchRegistration([(account, scopes[account]) for account in args.account_names], **batch_options).run()
+        else:
+            for account in args.account_names:
+                scope = scopes[account]
+                set_oauth_refresh_token(account, scope)
     else:
         print("You have chosen to do nothing.")
     print("Done.")
@@ -0,0 +1,96 @@
+"""
+Measures the memory each Reddit account costs a Dispatch process, with a handler and HTTP session per account (the
+old way) and with the handler shared by every account (the current way).
+Each measurement runs in its own process, so one does not inherit memory from another. No requests are made: the
+accounts' praw.Reddit objects are created but not logged in, and each account's thread waits instead of working.
+
+    python scripts/memory_benchmark.py --accounts 1 50 500
+"""
+import gc
+import json
+import os
+import subprocess
+import sys
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODES = ('separate', 'shared')
+
+
+def get_rss_kb():
+    """
+    :return: The resident memory of this process in KB, or None if it cannot be read.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def measure(mode, accounts):
+    """
+    Creates the praw.Reddit objects and threads of a number of accounts.
+    :param mode: 'separate' gives each account its own DeadlineHandler and the OS default thread stack size,
+                 'shared' uses bots.create_reddit() and the stack size in bot_config.yaml.
+    :return: A dict with the memory used in KB, measured by tracemalloc and by the OS
+    """
+    import praw
+    from bots import DeadlineHandler, create_reddit, set_thread_stack_size
+    from config.bot_config import get_user_agent
+
+    if mode == 'shared':
+        set_thread_stack_size()
+        create_reddit(get_user_agent())  # the shared handler is created once, not once per account
+    gc.collect()
+    rss_before = get_rss_kb()
+    tracemalloc.start()
+    stop = threading.Event()
+    sessions, threads = [], []
+    for number in range(accounts):
+        user_agent = get_user_agent() + " #{}".format(number)
+        if mode == 'shared':
+            sessions.append(create_reddit(user_agent))
+        else:
+            sessions.append(praw.Reddit(user_agent=user_agent, handler=DeadlineHandler(), disable_update_check=True))
+        thread = threading.Thread(target=stop.wait, daemon=True)
+        thread.start()
+        threads.append(thread)
+    gc.collect()
+    traced_kb = tracemalloc.get_traced_memory()[0] // 1024
+    tracemalloc.stop()
+    rss_after = get_rss_kb()
+    stop.set()
+    return {'mode': mode, 'accounts': accounts, 'traced_kb': traced_kb,
+            'rss_kb': None if rss_before is None else rss_after - rss_before}
+
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser(description="Measure the memory used per Reddit account.")
+    ap.add_argument("--accounts", "-a", type=int, nargs="+", default=[1, 50, 500],
+                    help="Numbers of accounts to measure.")
+    ap.add_argument("--child", nargs=2, metavar=("MODE", "ACCOUNTS"), help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child[0], int(args.child[1]))))
+        return
+
+    print("{:>8}  {:>8}  {:>14}  {:>14}  {:>16}  {:>16}".format(
+        "accounts", "mode", "traced KB", "RSS KB", "traced KB/acct", "RSS KB/acct"))
+    for accounts in args.accounts:
+        for mode in MODES:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode, str(accounts)],
+                                    stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            rss_kb = result['rss_kb']
+            print("{:>8}  {:>8}  {:>14}  {:>14}  {:>16.1f}  {:>16}".format(
+                accounts, mode, result['traced_kb'], "n/a" if rss_kb is None else rss_kb,
+                result['traced_kb'] / accounts, "n/a" if rss_kb is None else "{:.1f}".format(rss_kb / accounts)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import socket
+from bisect import bisect
+from time import time
+
+from config import getLogger
+from store import SqliteStore
+
+logger = getLogger()
+STREAM_LEASE_PREFIX = "stream:"
+"""Leases whose key starts with this are held by a CommentStream for a subreddit, not by the bots of an account."""
+
+
+def get_default_worker_id():
+    """
+    :return: A name for this process that is unique across hosts, e.g. "botbox:1234"
+    """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """
+    A consistent hash ring that assigns each account to one worker.
+    Each worker is placed on the ring many times (replicas), so accounts are spread evenly, and when a worker
+    joins or leaves only the accounts next to its points move.
+    """
+    def __init__(self, workers, replicas=64):
+        """
+        :param workers: The ids of the live workers
+        :param replicas: Number of points each worker has on the ring
+        """
+        points = sorted((_hash("{}#{}".format(worker, i)), worker) for worker in set(workers) for i in range(replicas))
+        self._hashes = [point[0] for point in points]
+        self._workers = [point[1] for point in points]
+
+    def get_owner(self, key):
+        """
+        :return: The id of the worker that should own a key, or None if there are no workers.
+        """
+        if not self._hashes:
+            return None
+        return self._workers[bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+
+class LeaseStore(SqliteStore):
+    """
+    Worker heartbeats and account leases, shared by every Dispatch process through one SQLite file.
+    A worker may only run an account's bots while it holds the account's lease, and a lease that is not renewed
+    expires, so a dead worker's accounts can be taken over. Times are wall clock timestamps because they are
+    compared across processes and hosts.
+    """
+
+    # WAL needs shared memory, which does not work across hosts on a shared filesystem
+    JOURNAL_MODE = 'DELETE'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS workers (
+            worker_id TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS leases (
+            account TEXT PRIMARY KEY,
+            worker_id TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS leases_worker_id ON leases (worker_id);
+    """
+
+    def heartbeat(self, worker_id, expires_at):
+        """
+        Records that a worker is alive until a time.
+        """
+        self.execute("INSERT INTO workers VALUES (?, ?) ON CONFLICT (worker_id) DO UPDATE SET expires_at = ?",
+                     (worker_id, expires_at, expires_at))
+
+    def get_live_workers(self, now):
+        """
+        Deletes workers whose heartbeat expired.
+        :return: A list of the ids of every live worker.
+        """
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM workers WHERE expires_at < ?", (now,))
+            return [row['worker_id'] for row in conn.execute("SELECT worker_id FROM workers")]
+
+    def remove_worker(self, worker_id):
+        self.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    def acquire(self, account, worker_id, expires_at, now):
+        """
+        Takes or renews an account's lease. Only a lease that is free, expired, or already held by the worker
+        can be taken.
+        :return: True if the worker holds the lease until expires_at
+        """
+        with self.transaction() as conn:
+            conn.execute("""
+                INSERT INTO leases VALUES (?, ?, ?)
+                ON CONFLICT (account) DO UPDATE SET worker_id = excluded.worker_id, expires_at = excluded.expires_at
+                WHERE leases.worker_id = excluded.worker_id OR leases.expires_at < ?
+            """, (account, worker_id, expires_at, now))
+            row = conn.execute("SELECT worker_id FROM leases WHERE account = ?", (account,)).fetchone()
+            return row['worker_id'] == worker_id
+
+    def release(self, account, worker_id):
+        """
+        Gives up a lease, if the worker holds it.
+        """
+        self.execute("DELETE FROM leases WHERE account = ? AND worker_id = ?", (account, worker_id))
+
+    def get_leases(self, worker_id):
+        """
+        :return: A set of the accounts whose lease the worker holds, expired or not.
+        """
+        return {row['account'] for row in self.execute("SELECT account FROM leases WHERE worker_id = ?",
+                                                       (worker_id,))}
+
+
+class ShardCoordinator(object):
+    """
+    Decides which accounts this worker runs. Accounts are assigned to the live workers with a HashRing,
+    and a worker must hold an account's lease before starting its bots, so two workers never run the same account.
+    When the ring changes, the old owner keeps renewing the lease until its bots have stopped, and only then
+    releases it to the new owner.
+    """
+    def __init__(self, store, worker_id=None, lease_seconds=60, replicas=64):
+        """
+        :param store: The LeaseStore shared by every worker
+        :param worker_id: A name that is unique among the workers. Defaults to hostname:pid.
+        :param lease_seconds: How long a heartbeat or lease lasts without being renewed. It must be longer than the
+                              time between calls to update(), or leases will expire while in use.
+        """
+        self.store = store
+        self.worker_id = worker_id or get_default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.replicas = replicas
+
+    def update(self, accounts, running=()):
+        """
+        Renews this worker's heartbeat and leases, takes leases for the accounts it now owns,
+        and releases leases it no longer needs.
+        :param accounts: Every account name in praw.ini
+        :param running: The accounts that still have bots running in this worker, including bots that are stopping.
+                        Their leases are kept until the bots have stopped.
+        :return: A set of the accounts this worker should run
+        """
+        now = time()
+        expires_at = now + self.lease_seconds
+        self.store.heartbeat(self.worker_id, expires_at)
+        ring = HashRing(self.store.get_live_workers(now), self.replicas)
+        owned = set()
+        for account in accounts:
+            if ring.get_owner(account) == self.worker_id or account in running:
+                if self.store.acquire(account, self.worker_id, expires_at, now):
+                    if ring.get_owner(account) == self.worker_id:
+                        owned.add(account)
+                elif account in running:
+                    logger.error("Lost the lease of a running account: account=[{}], worker=[{}]".format(
+                        account, self.worker_id))
+        for account in self.store.get_leases(self.worker_id) - owned - set(running):
+            if not account.startswith(STREAM_LEASE_PREFIX):
+                self.store.release(account, self.worker_id)
+        return owned
+
+    def leave(self, keep=()):
+        """
+        Takes this worker off the ring and gives up its leases at shutdown, so other workers can take its accounts
+        right away instead of waiting for the leases to expire.
+        :param keep: Accounts whose bots are still running. Their leases are left to expire.
+        """
+        self.store.remove_worker(self.worker_id)
+        for account in self.store.get_leases(self.worker_id) - set(keep):
+            self.store.release(account, self.worker_id)
@@ -0,0 +1,81 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from config import data_directory
+
+
+class SqliteStore(object):
+    """
+    Base class for the local SQLite databases kept in the data directory.
+    One connection is shared by every thread in the process and guarded by a lock.
+    Subclasses only need to define SCHEMA and their own query methods.
+    """
+
+    SCHEMA = ""
+    JOURNAL_MODE = 'WAL'
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, file_name):
+        """
+        :param file_name: Name of the database file in the data directory, an absolute path, or ':memory:'.
+        """
+        if file_name == ':memory:' or os.path.isabs(file_name):
+            self.path = file_name
+        else:
+            self.path = os.path.join(data_directory, file_name)
+        if self.path != ':memory:':
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        if self.path != ':memory:':
+            self._conn.execute("PRAGMA journal_mode={}".format(self.JOURNAL_MODE))
+        self._conn.executescript(self.SCHEMA)
+
+    @classmethod
+    def shared(cls, file_name, *args, **kwargs):
+        """
+        Gets the store that every bot in the process shares for a database file, creating it if needed.
+        Extra arguments are passed to the constructor the first time.
+        """
+        with SqliteStore._shared_lock:
+            key = (cls, file_name)
+            if key not in SqliteStore._shared:
+                SqliteStore._shared[key] = cls(file_name, *args, **kwargs)
+            return SqliteStore._shared[key]
+
+    def execute(self, sql, params=()):
+        """
+        Runs a single statement in its own transaction.
+        :return: A list of sqlite3.Row
+        """
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def executemany(self, sql, param_list):
+        with self.transaction() as conn:
+            conn.executemany(sql, param_list)
+
+    @contextmanager
+    def transaction(self):
+        """
+        A context manager that runs several statements in one transaction.
+        The transaction is rolled back if an exception is raised.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            else:
+                self._conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,302 @@
+import re
+import threading
+import zlib
+from collections import defaultdict, namedtuple
+from time import time
+
+from bots import create_reddit
+from config import getLogger
+from config.bot_config import get_sharding_config, get_stream_config, get_subreddits, get_user_agent
+from deadline import Deadline, set_deadline
+from sharding import STREAM_LEASE_PREFIX, get_default_worker_id
+from store import SqliteStore
+
+logger = getLogger()
+StreamComment = namedtuple('StreamComment', 'fullname subreddit author body match')
+"""
+A comment routed to a bot. It is a plain tuple instead of a praw Comment, so it can be handed to another thread
+without that thread making requests with the stream's Reddit session. match is the re.Match of the bot's pattern.
+"""
+
+
+def get_fullname_number(fullname):
+    """
+    Fullnames are base 36 ids with a type prefix, e.g. t1_d2x0k9l. Newer comments have bigger ids.
+    """
+    return int(fullname.partition('_')[2], 36)
+
+
+class StreamStore(SqliteStore):
+    """
+    The fullname of the newest comment read from each subreddit, the subscribers of every Dispatch process, and the
+    comments routed to each subscriber that it has not handled yet. A position only moves forward in the same
+    transaction that records the comments routed from it, so a restart neither reads old comments again nor loses
+    the comments that were routed but not handled.
+    """
+
+    # the Dispatch processes of several hosts may share the file, like the LeaseStore
+    JOURNAL_MODE = 'DELETE'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS stream_positions (
+            subreddit TEXT PRIMARY KEY,
+            fullname TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS stream_subscriptions (
+            name TEXT PRIMARY KEY,
+            pattern TEXT NOT NULL,
+            flags INTEGER NOT NULL,
+            account TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS stream_comments (
+            subscriber TEXT NOT NULL,
+            fullname TEXT NOT NULL,
+            subreddit TEXT NOT NULL,
+            author TEXT,
+            body TEXT NOT NULL,
+            UNIQUE (subscriber, fullname)
+        );
+    """
+
+    def get_position(self, subreddit):
+        rows = self.execute("SELECT fullname FROM stream_positions WHERE subreddit = ?", (subreddit.lower(),))
+        return rows[0]['fullname'] if rows else None
+
+    def set_position(self, subreddit, fullname):
+        self.execute("INSERT OR REPLACE INTO stream_positions VALUES (?, ?)", (subreddit.lower(), fullname))
+
+    def advance(self, subreddit, old_position, new_position, routed):
+        """
+        Records the comments routed from a subreddit and moves its position, unless another poll moved the position
+        since it was read.
+        :param routed: A list of (subscriber name, StreamComment) tuples, oldest comment first
+        :return: True if the position was moved
+        """
+        with self.transaction() as conn:
+            row = conn.execute("SELECT fullname FROM stream_positions WHERE subreddit = ?",
+                               (subreddit.lower(),)).fetchone()
+            if (row['fullname'] if row else None) != old_position:
+                return False
+            conn.executemany("INSERT OR IGNORE INTO stream_comments VALUES (?, ?, ?, ?, ?)",
+                             [(name, comment.fullname, comment.subreddit, comment.author, comment.body)
+                              for name, comment in routed])
+            conn.execute("INSERT OR REPLACE INTO stream_positions VALUES (?, ?)", (subreddit.lower(), new_position))
+            return True
+
+    def subscribe(self, name, pattern, account, expires_at):
+        """
+        Adds or renews a subscriber until a time.
+        :param pattern: A compiled regular expression
+        """
+        self.execute("INSERT OR REPLACE INTO stream_subscriptions VALUES (?, ?, ?, ?, ?)",
+                     (name, pattern.pattern, pattern.flags, account, expires_at))
+
+    def unsubscribe(self, name):
+        self.execute("DELETE FROM stream_subscriptions WHERE name = ?", (name,))
+
+    def get_subscriptions(self, now):
+        """
+        Deletes subscribers that were not renewed, e.g. because their process died.
+        :return: A list of (name, pattern, flags, account) rows of the live subscribers, in every process
+        """
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM stream_subscriptions WHERE expires_at < ?", (now,))
+            return conn.execute("SELECT name, pattern, flags, account FROM stream_subscriptions").fetchall()
+
+    def get_routed(self, subscriber):
+        """
+        :return: A list of the (fullname, subreddit, author, body) rows routed to a subscriber, oldest first
+        """
+        return self.execute("SELECT fullname, subreddit, author, body FROM stream_comments WHERE subscriber = ? "
+                            "ORDER BY rowid", (subscriber,))
+
+    def remove_routed(self, subscriber, fullnames):
+        self.executemany("DELETE FROM stream_comments WHERE subscriber = ? AND fullname = ?",
+                         [(subscriber, fullname) for fullname in fullnames])
+
+
+class RoutedComments(object):
+    """
+    The comments routed to one subscriber. They are kept in the StreamStore until the subscriber marks them handled,
+    so a bot that stops, or is replaced by a bot in another process, gets them again.
+    """
+    def __init__(self, store, name, pattern):
+        self.store = store
+        self.name = name
+        self.pattern = pattern
+
+    def get(self):
+        """
+        :return: A list of the StreamComments that were routed to the subscriber and not handled yet, oldest first.
+        """
+        comments = []
+        for row in self.store.get_routed(self.name):
+            match = self.pattern.search(row['body'])
+            if match:
+                comments.append(StreamComment(row['fullname'], row['subreddit'], row['author'], row['body'], match))
+        return comments
+
+    def remove(self, fullnames):
+        """
+        Marks comments handled, so they are not returned again.
+        """
+        self.store.remove_routed(self.name, fullnames)
+
+
+class CommentStream(threading.Thread):
+    """
+    Reads the new comments of every subreddit in bot_config.yaml once, and routes the comments that match a bot's
+    command pattern to that bot. Bots subscribe with a pattern and get a RoutedComments, which they read in their
+    own thread. When several bots subscribe with the same pattern, e.g. one TicketBot per account, each comment goes
+    to only one of them, so it is answered once.
+    Subscribers are kept in the StreamStore, so when the bots are spread over several Dispatch processes, a comment
+    is routed among the bots of every process. Each subreddit is then read by only one process: the one holding the
+    subreddit's lease in the LeaseStore.
+    Nothing is read while no bot is subscribed.
+    """
+    def __init__(self, store=None, reddit=None, leases=None, worker_id=None):
+        """
+        :param store: A StreamStore. If None, the one in bot_config.yaml is used.
+        :param reddit: The praw.Reddit used to read comments. If None, a logged out session is created.
+        :param leases: The LeaseStore shared with the other Dispatch processes, or None if this is the only one.
+        :param worker_id: This process's id in the LeaseStore
+        """
+        super(CommentStream, self).__init__(daemon=True, name="CommentStream")
+        self.stop_event = threading.Event()
+        self.store = store or StreamStore.shared(get_stream_config()['positions_file'])
+        self.r = reddit
+        self.leases = leases
+        self.worker_id = worker_id or get_default_worker_id()
+        self._lock = threading.Lock()
+        self._subscriptions = {}  # subscriber name -> (compiled pattern, account username, RoutedComments)
+        self._patterns = {}  # (pattern, flags) -> compiled pattern, for the subscribers of other processes
+        self.reads = 0
+
+    @staticmethod
+    def get_lease_seconds():
+        """
+        How long a subreddit's lease or a subscriber lasts without being renewed. They are renewed on every poll.
+        """
+        return get_sharding_config()['lease_seconds'] + get_stream_config()['poll_interval_seconds']
+
+    def subscribe(self, name, pattern, account):
+        """
+        Routes comments that match a pattern to a subscriber. Comments routed to a name are kept until they are
+        handled, so a bot that replaces another bot receives the comments that were waiting for it.
+        :param name: A name that is unique across processes, e.g. the bot's name
+        :param pattern: A compiled regular expression that is searched for in each comment's body
+        :param account: The subscriber's username. Comments posted by it are not routed to it.
+        :return: The subscriber's RoutedComments
+        """
+        with self._lock:
+            if name in self._subscriptions:
+                comments = self._subscriptions[name][2]
+            else:
+                comments = RoutedComments(self.store, name, pattern)
+            self._subscriptions[name] = (pattern, account, comments)
+        self.store.subscribe(name, pattern, account, time() + self.get_lease_seconds())
+        return comments
+
+    def unsubscribe(self, name):
+        with self._lock:
+            self._subscriptions.pop(name, None)
+        self.store.unsubscribe(name)
+
+    def run(self):
+        """
+        An override of Thread.run(). Polls until stop_event is set, then gives up the subreddits' leases.
+        """
+        while not self.stop_event.wait(get_stream_config()['poll_interval_seconds']):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Could not read comments")
+        if self.leases is not None:
+            for subreddit in get_subreddits():
+                self.leases.release(STREAM_LEASE_PREFIX + subreddit.lower(), self.worker_id)
+
+    def poll(self):
+        """
+        Renews this process's subscribers, then reads each subreddit's comments newer than its saved position, and
+        routes them to the subscribers of every process. Subreddits whose lease another process holds are skipped.
+        The first time a subreddit is read, only its position is saved, so old comments are not answered.
+        """
+        now = time()
+        expires_at = now + self.get_lease_seconds()
+        with self._lock:
+            local = list(self._subscriptions.items())
+        for name, (pattern, account, _) in local:
+            self.store.subscribe(name, pattern, account, expires_at)
+        subscriptions = [(row['name'], self.get_pattern(row['pattern'], row['flags']), row['account'])
+                         for row in self.store.get_subscriptions(now)]
+        if not subscriptions:
+            return
+        if self.r is None:
+            self.r = create_reddit(get_user_agent())
+        settings = get_stream_config()
+        for subreddit in get_subreddits():
+            if self.leases is not None and not self.leases.acquire(STREAM_LEASE_PREFIX + subreddit.lower(),
+                                                                   self.worker_id, expires_at, now):
+                continue
+            set_deadline(Deadline(settings['poll_deadline_seconds']))
+            try:
+                self.poll_subreddit(subreddit, subscriptions, settings['limit'])
+            finally:
+                set_deadline(None)
+
+    def get_pattern(self, pattern, flags):
+        """
+        :return: The compiled regular expression of a subscriber, which may be in another process
+        """
+        if (pattern, flags) not in self._patterns:
+            self._patterns[pattern, flags] = re.compile(pattern, flags)
+        return self._patterns[pattern, flags]
+
+    def poll_subreddit(self, subreddit, subscriptions, limit):
+        """
+        Reads a subreddit's comments newer than its saved position, newest first, and routes them oldest first.
+        Comments are compared by id as well as by fullname, so a deleted position comment does not make old
+        comments look new.
+        :param subscriptions: A list of (subscriber name, compiled pattern, account username) tuples
+        """
+        position = self.store.get_position(subreddit)
+        mark = get_fullname_number(position) if position else None
+        new_comments = []
+        self.reads += 1
+        for comment in self.r.get_comments(subreddit, limit=limit, place_holder=position):
+            if mark is not None and get_fullname_number(comment.fullname) <= mark:
+                break
+            new_comments.append(comment)
+        if not new_comments:
+            return
+        routed = []
+        if mark is not None:
+            if len(new_comments) >= limit:
+                logger.warning("Comments may have been missed: subreddit=[{}], read=[{}]".format(subreddit, limit))
+            for comment in reversed(new_comments):
+                routed += self.route(comment, subreddit, subscriptions)
+        if not self.store.advance(subreddit, position, new_comments[0].fullname, routed):
+            logger.warning("Comments were routed by another process: subreddit=[{}]".format(subreddit))
+
+    @staticmethod
+    def route(comment, subreddit, subscriptions):
+        """
+        Picks one subscriber of each pattern that matches a comment. The subscriber is picked by a hash of the
+        comment's fullname, so the same comment always goes to the same subscriber, and comments are spread evenly
+        over the subscribers.
+        :return: A list of (subscriber name, StreamComment) tuples
+        """
+        author = str(comment.author) if comment.author else None
+        owners = defaultdict(list)  # (pattern, flags) -> the names and patterns of the pattern's subscribers
+        for name, pattern, account in sorted(subscriptions, key=lambda subscription: subscription[0]):
+            if author is not None and author.lower() == account.lower():
+                continue  # never answer the account's own comments
+            owners[pattern.pattern, pattern.flags].append((name, pattern))
+        routed = []
+        for candidates in owners.values():
+            name, pattern = candidates[zlib.crc32(comment.fullname.encode()) % len(candidates)]
+            match = pattern.search(comment.body)
+            if match:
+                routed.append((name, StreamComment(comment.fullname, subreddit, author, comment.body, match)))
+        return routed
@@ -0,0 +1,87 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from urllib.parse import parse_qs, urlparse
+
+from scripts import account_register
+
+CREDENTIALS = {'oauth_client_id': "id", 'oauth_client_secret': "secret",
+               'oauth_redirect_uri': "http://127.0.0.1:65010/authorize_callback"}
+
+
+class FakeReddit:
+    def __init__(self, account_name):
+        self.account_name = account_name
+
+    def get_authorize_url(self, state, scope, refreshable):
+        return "https://www.reddit.com/api/v1/authorize?state=" + state
+
+    def get_access_information(self, code):
+        return {'refresh_token': "token-" + code}
+
+    def get_me(self):
+        return self.account_name
+
+
+class BatchRegistrationTest(unittest.TestCase):
+
+    def setUp(self):
+        for patcher in (patch.object(account_register, 'get_reddit_oath_credentials', return_value=CREDENTIALS),
+                        patch.object(account_register, 'get_oauth_reddit', side_effect=lambda name, _: FakeReddit(name)),
+                        patch.object(account_register, 'OAuthCallbackServer', MagicMock()),
+                        patch('builtins.print')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        save_patcher = patch.object(account_register, 'set_reddit_oauth_refresh_tokens')
+        self.save = save_patcher.start()
+        self.addCleanup(save_patcher.stop)
+
+    def register(self, accounts, responses):
+        """
+        Runs a BatchRegistration whose browser answers each authorization page at once.
+        :param responses: A dict of account name -> (code, error) sent back for it
+        :return: The errors returned by run()
+        """
+        batch = account_register.BatchRegistration(accounts, timeout=1)
+        names = {state: name for (name, _), (state, _) in zip(accounts, batch.urls)}
+
+        def answer(url):
+            state = parse_qs(urlparse(url).query)['state'][0]
+            batch.on_code(state, *responses[names[state]])
+        with patch.object(account_register.webbrowser, 'open', side_effect=answer):
+            return batch.run()
+
+    def test_unknown_or_used_state_is_rejected(self):
+        batch = account_register.BatchRegistration([("a", "identity")], timeout=1)
+        state = batch.urls[0][0]
+        self.assertIn("Unknown", batch.on_code("forged", "code", None))
+        self.assertIn(state, batch.pending)
+        self.assertIn("Authorized", batch.on_code(state, "code", None))
+        self.assertIn("Unknown", batch.on_code(state, "code", None))
+        self.assertEqual(list(batch.futures), ["a"])
+        batch.executor.shutdown()
+
+    def test_error_response_keeps_other_accounts(self):
+        errors = self.register([("a", "identity"), ("b", "identity"), ("c", "edit")],
+                               {'a': ("1", None), 'b': (None, "access_denied"), 'c': ("3", None)})
+        self.assertEqual(errors, {'b': "access_denied"})
+        self.save.assert_called_once_with({'a': "token-1", 'c': "token-3"})
+
+    def test_tokens_saved_in_one_write(self):
+        errors = self.register([("a", "identity"), ("b", "identity"), ("c", "edit")],
+                               {'a': ("1", None), 'b': ("2", None), 'c': ("3", None)})
+        self.assertEqual(errors, {})
+        self.save.assert_called_once_with({'a': "token-1", 'b': "token-2", 'c': "token-3"})
+
+
+    def test_redirect_after_run_is_rejected(self):
+        batch = account_register.BatchRegistration([("a", "identity")], timeout=0.01)
+        state = batch.urls[0][0]
+        with patch.object(account_register.webbrowser, 'open'):
+            self.assertEqual(batch.run(), {'a': "timed out"})
+        self.assertIn("Unknown", batch.on_code(state, "code", None))
+        self.assertEqual(batch.futures, {})
+        self.save.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+from collections import namedtuple
+from unittest.mock import patch
+from ddt import ddt, unpack, data
+import article_store
+
+Link = namedtuple('Link', 'url title')
+OLD_LINK = Link("http://www.upressonline.com/1999/10/31/old-article/", "Old article")
+NEW_LINK = Link("http://www.upressonline.com/2016/05/12/new-article/", "New article")
+
+
+@ddt
+class ArticleStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = article_store.ArticleStore(':memory:')
+
+    @data(("http://www.upressonline.com/2016/05/12/title/", (2016, 5, 12)),
+          ("http://www.upressonline.com/category/news/", (None, None, None)))
+    @unpack
+    def test_get_date_from_url(self, url, expected_output):
+        self.assertEqual(article_store.get_date_from_url(url), expected_output)
+
+    @data((2016, None, None, [NEW_LINK.url]),
+          (2016, 5, None, [NEW_LINK.url]),
+          (2016, 5, 13, []),
+          (1999, 10, 31, [OLD_LINK.url]))
+    @unpack
+    def test_get_articles_by_date(self, year, month, day, expected_urls):
+        self.store.add_articles([OLD_LINK, NEW_LINK])
+        articles = self.store.get_articles_by_date(year, month, day)
+        self.assertEqual([article.url for article in articles], expected_urls)
+
+    def test_get_articles_by_category(self):
+        self.store.add_articles([NEW_LINK], article_store.get_category_paths('reviews', 'books'))
+        self.store.add_articles([OLD_LINK], article_store.get_category_paths('reviews'))
+        self.assertEqual(len(self.store.get_articles_by_category('reviews')), 2)
+        self.assertEqual([a.url for a in self.store.get_articles_by_category('reviews', 'books')], [NEW_LINK.url])
+
+    def test_get_random_article_by_date(self):
+        self.store.add_articles([OLD_LINK, NEW_LINK])
+        for _ in range(10):
+            self.assertEqual(self.store.get_random_article_by_date(2016, 5).url, NEW_LINK.url)
+        self.assertIsNone(self.store.get_random_article_by_date(2015))
+
+    def test_get_random_article_by_category(self):
+        self.store.add_articles([OLD_LINK, NEW_LINK], article_store.get_category_paths('news'))
+        urls = {self.store.get_random_article_by_category('news').url for _ in range(50)}
+        self.assertEqual(urls, {OLD_LINK.url, NEW_LINK.url})
+
+    def test_random_article_picked_at_random_key(self):
+        with patch.object(article_store.random, 'random', side_effect=[0.2, 0.6]):
+            self.store.add_articles([OLD_LINK, NEW_LINK], article_store.get_category_paths('news'))
+        with patch.object(article_store.random, 'random', side_effect=[0.5, 0.9]):
+            self.assertEqual(self.store.get_random_article_by_category('news').url, NEW_LINK.url)
+        with patch.object(article_store.random, 'random', side_effect=[0.95, 0.1]):  # wraps around to the first key
+            self.assertEqual(self.store.get_random_article_by_category('news').url, OLD_LINK.url)
+        with patch.object(article_store.random, 'random', side_effect=[0.15, 0.5]):
+            self.assertEqual(self.store.get_random_article_by_date(2016).url, NEW_LINK.url)
+
+    @data((2016, None, None), (2016, 5, None), (2016, 5, 12))
+    @unpack
+    def test_random_article_seeks_an_index(self, year, month, day):
+        self.store.add_articles([OLD_LINK, NEW_LINK], article_store.get_category_paths('news'))
+        statements = []
+        self.store._conn.set_trace_callback(statements.append)
+        with patch.object(article_store.random, 'random', return_value=0.0):
+            self.store.get_random_article_by_date(year, month, day, unsubmitted_to=['FAUbot'])
+            self.store.get_random_article_by_category('news', unsubmitted_to=['FAUbot'])
+        self.store._conn.set_trace_callback(None)
+        picks = [statement for statement in statements if statement.startswith("SELECT a.url")]
+        self.assertEqual(len(picks), 2)
+        for statement in picks:
+            plan = [row[-1] for row in self.store.execute("EXPLAIN QUERY PLAN " + statement)]
+            self.assertIn("rand_key>?", plan[0])
+            self.assertFalse([step for step in plan if step.startswith("SCAN") or "TEMP B-TREE" in step], plan)
+
+    def test_random_article_skips_submitted(self):
+        self.store.add_articles([OLD_LINK, NEW_LINK], article_store.get_category_paths('news'))
+        self.store.mark_submitted(NEW_LINK.url, 'FAUbot')
+        self.assertTrue(self.store.is_submitted(NEW_LINK.url, 'FAUbot'))
+        for _ in range(10):
+            article = self.store.get_random_article_by_category('news', unsubmitted_to=['FAUbot'])
+            self.assertEqual(article.url, OLD_LINK.url)
+        self.assertIsNone(self.store.get_random_article_by_date(2016, unsubmitted_to=['FAUbot']))
+        self.assertIsNotNone(self.store.get_random_article_by_date(2016, unsubmitted_to=['FAUbot', 'FAU']))
+
+    @data(("new", [NEW_LINK.url]),
+          ("ARTICLE old", [OLD_LINK.url]),
+          ("missing", []),
+          ("", []))
+    @unpack
+    def test_search(self, query, expected_urls):
+        self.store.add_articles([OLD_LINK, NEW_LINK])
+        self.assertEqual([article.url for article in self.store.search(query)], expected_urls)
+
+    def test_crawled_page_checkpoint(self):
+        archive = "http://www.upressonline.com/2016/05"
+        self.assertEqual(self.store.get_checkpoint(archive), (1, False))
+        self.store.add_crawled_page(archive, 2, [NEW_LINK])
+        self.assertEqual(self.store.get_checkpoint(archive), (2, False))
+        self.store.add_crawled_page(archive, 2, [], done=True)
+        self.assertEqual(self.store.get_checkpoint(archive), (2, True))
+        self.assertEqual(len(self.store.get_articles_by_date(2016)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+from config import bot_config
+from config.watcher import ConfigWatcher
+
+
+class BotConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original = bot_config.CONFIG
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "bot_config.yaml")
+        shutil.copy(bot_config.bot_config_path, self.path)
+
+    def tearDown(self):
+        bot_config.CONFIG = self.original
+        shutil.rmtree(self.directory)
+
+    def test_validate_config_accepts_shipped_config(self):
+        bot_config.validate_config(copy.deepcopy(self.original))
+
+    def test_validate_config_rejects_bad_interval(self):
+        config = copy.deepcopy(self.original)
+        config['intervals']['sleep_interval_seconds'] = "soon"
+        with self.assertRaises(bot_config.InvalidBotConfig):
+            bot_config.validate_config(config)
+
+    def test_validate_config_rejects_missing_subreddits(self):
+        config = copy.deepcopy(self.original)
+        del config['subreddits']
+        with self.assertRaises(bot_config.InvalidBotConfig):
+            bot_config.validate_config(config)
+
+    def test_validate_config_reports_every_error(self):
+        config = copy.deepcopy(self.original)
+        config['flags'] = {}
+        config['caches']['link_lists']['policy'] = "mru"
+        with self.assertRaises(bot_config.InvalidBotConfig) as context:
+            bot_config.validate_config(config)
+        self.assertIn("flags.run_bots_once is missing", str(context.exception))
+        self.assertIn("caches.link_lists.policy must be lru or fifo", str(context.exception))
+
+    def test_load_config_reuses_snapshot_until_file_changes(self):
+        first = bot_config.load_config(self.path)
+        self.assertIs(bot_config.load_config(self.path), first)
+        with open(self.path, "a") as ofile:
+            ofile.write("\nreloaded: true\n")
+        self.assertIsNot(bot_config.load_config(self.path), first)
+
+    def test_reload_config_swaps_config_and_notifies_listeners(self):
+        with open(self.path, "a") as ofile:
+            ofile.write("\nreloaded: true\n")
+        seen = []
+        bot_config.add_reload_listener(seen.append)
+        try:
+            config = bot_config.reload_config(self.path)
+        finally:
+            bot_config.remove_reload_listener(seen.append)
+        self.assertIs(bot_config.CONFIG, config)
+        self.assertTrue(config['reloaded'])
+        self.assertEqual(seen, [config])
+
+    def test_reload_config_keeps_config_when_invalid(self):
+        with open(self.path, "w") as ofile:
+            ofile.write("intervals: [\n")
+        with self.assertRaises(bot_config.InvalidBotConfig):
+            bot_config.reload_config(self.path)
+        self.assertIs(bot_config.CONFIG, self.original)
+
+
+class ConfigWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "watched.ini")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_poll_reports_created_changed_and_deleted_files(self):
+        watcher = ConfigWatcher(self.path)
+        self.assertEqual(watcher.poll(), [])
+        with open(self.path, "w") as ofile:
+            ofile.write("a")
+        self.assertEqual(watcher.poll(), [self.path])
+        self.assertEqual(watcher.poll(), [])
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+        self.assertEqual(watcher.poll(), [self.path])
+        os.remove(self.path)
+        self.assertEqual(watcher.poll(), [self.path])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import praw
+from ddt import ddt, data, unpack
+
+import bots
+import outbox
+import tracing
+
+
+class FakeBot(bots.Bot):
+    """
+    Raises the given errors in its first work cycles, and stops after its first cycle that succeeds.
+    """
+    def __init__(self, errors=(), **kwargs):
+        super(FakeBot, self).__init__(**kwargs)
+        self.errors = list(errors)
+        self.cycles = 0
+
+    def work(self):
+        self.cycles += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.stop_event.set()
+
+
+@ddt
+class BotTest(unittest.TestCase):
+
+    def setUp(self):
+        supervisor = {'backoff_base_seconds': 0, 'backoff_max_seconds': 0}
+        for patcher in (patch.object(bots, 'logger'),
+                        patch.object(bots, 'get_supervisor_config', return_value=supervisor),
+                        patch.object(tracing, 'get_tracing_config', return_value={'sample_rate': 0})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @data((ConnectionError(), True, True),
+          (praw.errors.OAuthInvalidToken(), True, True),
+          (praw.errors.OAuthInvalidGrant(), False, False),
+          (praw.errors.OAuthInsufficientScope(), False, False),
+          (bots.MissingRefreshTokenError(), False, False),
+          (KeyError(), False, True))
+    @unpack
+    def test_error_classes(self, error, transient, restartable):
+        self.assertEqual(bots.is_transient_error(error), transient)
+        self.assertEqual(bots.is_restartable_error(error), restartable)
+
+    def test_backoff_delay_doubles_up_to_max(self):
+        with patch.object(bots.random, 'uniform', side_effect=lambda low, high: high):
+            self.assertEqual([bots.get_backoff_delay(attempt, 5, 30) for attempt in range(1, 6)], [5, 10, 20, 30, 30])
+
+    def test_transient_errors_are_retried(self):
+        bot = FakeBot([ConnectionError(), praw.errors.HTTPException()])
+        bot.run()
+        self.assertEqual(bot.cycles, 3)
+        self.assertIsNone(bot.failure)
+        self.assertEqual(bot.consecutive_failures, 0)
+
+    def test_retry_waits_at_least_rate_limit(self):
+        bot = FakeBot()
+        self.assertEqual(bot._get_retry_delay(praw.errors.RateLimitExceeded(sleep_time=42)), 42)
+        self.assertEqual(bot.consecutive_failures, 1)
+
+    def test_fatal_error_stops_bot(self):
+        error = praw.errors.OAuthInvalidGrant()
+        bot = FakeBot([error, ConnectionError()])
+        bot.run()
+        self.assertEqual(bot.cycles, 1)
+        self.assertIs(bot.failure, error)
+
+    def test_run_once_bot_not_retried(self):
+        bot = FakeBot([ConnectionError()] * 3, run_once=True)
+        bot.run()
+        self.assertEqual(bot.cycles, 1)
+        self.assertIsNone(bot.failure)
+        self.assertTrue(bot.stop_event.is_set())
+
+
+    def send(self, kind, target, payload):
+        reddit = MagicMock(config={'edit': "api/editusertext/", 'user': "api/me.json"})
+        reddit.request_json.return_value = {'data': {'things': [None]}}
+        action = outbox.Action(1, "bot", kind, target, payload, outbox.PRIORITY_EDIT, 0)
+        bots.RedditBot._send_action(SimpleNamespace(r=reddit), action)
+        reddit.get_info.assert_not_called()
+        return reddit
+
+    def test_edit_sent_without_reading_target(self):
+        reddit = self.send(outbox.EDIT, "t3_a", {'text': "table"})
+        reddit.request_json.assert_called_once_with("api/editusertext/", data={'thing_id': "t3_a", 'text': "table"})
+        reddit.evict.assert_called_once_with("api/me.json")
+
+    def test_reply_sent_without_reading_target(self):
+        reddit = self.send(outbox.REPLY, "t1_a", {'text': "done"})
+        reddit._add_comment.assert_called_once_with("t1_a", "done")
+
+
+
+@ddt
+class RedditSessionTest(unittest.TestCase):
+
+    def test_sessions_share_handler_only(self):
+        first, second = bots.create_reddit("agent one"), bots.create_reddit("agent two")
+        self.assertIs(first.handler, bots.get_shared_handler())
+        self.assertIs(second.handler, first.handler)
+        self.assertIsNot(second.http, first.http)
+        self.assertIn("agent one", first.http.headers['User-Agent'])
+        self.assertIn("agent two", second.http.headers['User-Agent'])
+
+    @data(0, 256)
+    def test_thread_stack_size(self, size_kb):
+        self.addCleanup(threading.stack_size, threading.stack_size())
+        with patch.object(bots, 'logger'), \
+                patch.object(bots, 'get_reddit_config', return_value={'thread_stack_size_kb': size_kb}):
+            bots.set_thread_stack_size()
+        self.assertEqual(threading.stack_size(), size_kb * 1024)  # 0 is the platform's default
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import threading
+import unittest
+from unittest.mock import patch
+import cache
+
+
+class SharedCacheTest(unittest.TestCase):
+
+    def test_get_or_load_caches_value(self):
+        c = cache.SharedCache('test', maxsize=4, ttl=60)
+        calls = []
+        for _ in range(3):
+            result = c.get_or_load('key', lambda: calls.append(1) or 'value')
+            self.assertEqual(result, 'value')
+        self.assertEqual(len(calls), 1)
+        stats = c.stats()
+        self.assertEqual((stats.hits, stats.misses), (2, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        c = cache.SharedCache('test', maxsize=2, ttl=60)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get_or_load('a', lambda: None)  # 'a' is now the most recently used
+        c.set('c', 3)
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.stats().evictions, 1)
+
+    def test_expired_entry_is_reloaded(self):
+        c = cache.SharedCache('test', maxsize=2, ttl=10)
+        with patch.object(cache, 'monotonic', return_value=100):
+            c.set('a', 1)
+        with patch.object(cache, 'monotonic', return_value=111):
+            self.assertEqual(c.get_or_load('a', lambda: 2), 2)
+
+    def test_concurrent_callers_share_one_load(self):
+        c = cache.SharedCache('test', maxsize=2, ttl=60)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def slow_loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'value'
+
+        leader = threading.Thread(target=lambda: results.append(c.get_or_load('key', slow_loader)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(c.get_or_load('key', slow_loader)))
+                     for _ in range(3)]
+        for follower in followers:
+            follower.start()
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 4)
+
+    def test_loader_error_is_not_cached(self):
+        c = cache.SharedCache('test', maxsize=2, ttl=60)
+
+        def failing_loader():
+            raise ValueError("Error talking to UPress")
+
+        with self.assertRaises(ValueError):
+            c.get_or_load('key', failing_loader)
+        self.assertEqual(c.get_or_load('key', lambda: 'value'), 'value')
+
+    def test_fifo_policy_ignores_hits(self):
+        c = cache.SharedCache('test', maxsize=2, ttl=60, policy='fifo')
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get_or_load('a', lambda: None)
+        c.set('c', 3)
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.get('b'), 2)
+
+    def test_configure_shrinks_cache(self):
+        c = cache.SharedCache('test', maxsize=3, ttl=60)
+        for key in 'abc':
+            c.set(key, key)
+        c.configure(maxsize=1, ttl=60, policy='lru')
+        self.assertEqual(len(c), 1)
+        self.assertEqual(c.get('c'), 'c')
+
+    def test_unknown_policy_raises(self):
+        with self.assertRaises(cache.InvalidCachePolicy):
+            cache.SharedCache('test', policy='random')
+
+
+class CacheRegistryTest(unittest.TestCase):
+
+    def test_get_cache_returns_same_instance(self):
+        self.assertIs(cache.get_cache('ut_registry'), cache.get_cache('ut_registry'))
+
+    def test_get_cache_uses_config(self):
+        settings = {'ttl_seconds': 5, 'maxsize': 7, 'policy': 'fifo'}
+        with patch.object(cache, 'get_cache_config', return_value=settings):
+            c = cache.get_cache('ut_configured')
+        self.assertEqual((c.ttl, c.maxsize, c.policy), (5, 7, 'fifo'))
+
+    def test_shared_cache_ignores_self(self):
+
+        class Scraper(object):
+            calls = 0
+
+            @cache.shared_cache('ut_scraper', key=lambda self, url: url)
+            def get(self, url):
+                Scraper.calls += 1
+                return url.upper()
+
+        self.assertEqual(Scraper().get('a'), 'A')
+        self.assertEqual(Scraper().get('a'), 'A')
+        self.assertEqual(Scraper.calls, 1)
+        Scraper.get.invalidate(Scraper(), 'a')
+        Scraper().get('a')
+        self.assertEqual(Scraper.calls, 2)
+        Scraper.get.prime('B', Scraper(), 'b')
+        self.assertEqual(Scraper().get('b'), 'B')
+        self.assertEqual(Scraper.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
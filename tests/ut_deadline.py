@@ -0,0 +1,41 @@
+import threading
+import unittest
+from unittest.mock import patch
+import deadline
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def test_timeout_is_limited_by_deadline(self):
+        with patch.object(deadline, 'monotonic', return_value=100):
+            d = deadline.Deadline(10)
+        with patch.object(deadline, 'monotonic', return_value=105):
+            self.assertEqual(d.timeout(30), 5)
+            self.assertEqual(d.timeout(2), 2)
+
+    def test_expired_deadline_raises(self):
+        d = deadline.Deadline(60)
+        d.expire()
+        self.assertTrue(d.expired)
+        with self.assertRaises(deadline.DeadlineExceeded):
+            d.timeout(30)
+
+    def test_get_timeout_uses_current_thread_deadline(self):
+        self.assertEqual(deadline.get_timeout(30), 30)
+        d = deadline.Deadline(60)
+        d.expire()
+        deadline.set_deadline(d)
+        try:
+            with self.assertRaises(deadline.DeadlineExceeded):
+                deadline.get_timeout(30)
+            other_thread_timeouts = []
+            thread = threading.Thread(target=lambda: other_thread_timeouts.append(deadline.get_timeout(30)))
+            thread.start()
+            thread.join()
+            self.assertEqual(other_thread_timeouts, [30])
+        finally:
+            deadline.set_deadline(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
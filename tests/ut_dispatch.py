@@ -0,0 +1,183 @@
+import importlib.util
+import os
+import threading
+import unittest
+from time import monotonic, sleep
+from unittest.mock import patch
+
+import praw
+
+from config import root
+
+# the Dispatch lives in __main__.py, so it is loaded under another name
+_spec = importlib.util.spec_from_file_location('dispatch', os.path.join(root, '__main__.py'))
+dispatch = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(dispatch)
+
+WATCHDOG = {'check_interval_seconds': 0.01, 'grace_seconds': 60, 'action': 'restart'}
+SUPERVISOR = {'backoff_base_seconds': 5, 'backoff_max_seconds': 900, 'max_restarts': 2, 'healthy_seconds': 100}
+
+
+class StubBot(object):
+    """
+    Stands in for a bot thread whose state the tests set directly.
+    """
+    def __init__(self, name, alive=True, failure=None):
+        self.name = self.USER_NAME = name
+        self.alive = alive
+        self.failure = failure
+        self.consecutive_failures = 0
+        self.stop_event = threading.Event()
+        self.r = None
+        self.clones = []
+
+    def is_alive(self):
+        return self.alive
+
+    def clone(self, reuse_session=False):
+        self.clones.append(StubBot(self.name))
+        return self.clones[-1]
+
+    def start(self):
+        pass
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        for patcher in (patch.object(dispatch, 'logger'), patch.object(dispatch, 'ConfigWatcher'),
+                        patch.object(dispatch, 'CommentStream'), patch.object(dispatch, 'MemoryMonitor'),
+                        patch.object(dispatch, 'monotonic', side_effect=lambda: self.now),
+                        patch.object(dispatch, 'get_backoff_delay', return_value=10),
+                        patch.object(dispatch, 'get_supervisor_config', return_value=SUPERVISOR)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.dispatch = dispatch.Dispatch([])
+
+    def supervise(self, bot, *times):
+        self.dispatch.bots = {bot.USER_NAME: [bot]}
+        for self.now in times:
+            self.dispatch.supervise_bots()
+        return self.dispatch.bots[bot.USER_NAME][0]
+
+    def test_failed_bot_restarted_after_backoff(self):
+        bot = StubBot("a", alive=False, failure=ConnectionError())
+        self.assertIs(self.supervise(bot, 0, 9), bot)
+        new_bot = self.supervise(bot, 10)
+        self.assertIsNot(new_bot, bot)
+        self.assertTrue(bot.stop_event.is_set())
+        self.assertEqual(self.dispatch.restarts["a"], 1)
+
+    def test_fatal_failure_not_restarted(self):
+        bot = StubBot("a", alive=False, failure=praw.errors.OAuthInvalidGrant())
+        self.assertIs(self.supervise(bot, 0, 10, 1000), bot)
+        self.assertEqual(self.dispatch.restarts["a"], 0)
+
+    def test_bot_given_up_after_max_restarts(self):
+        bot = StubBot("a", alive=False, failure=ConnectionError())
+        for _ in range(SUPERVISOR['max_restarts']):
+            bot = self.supervise(bot, self.now, self.now + 10)
+            bot.alive, bot.failure = False, ConnectionError()
+        self.assertIs(self.supervise(bot, self.now, self.now + 10, self.now + 1000), bot)
+        self.assertEqual(self.dispatch.restarts["a"], SUPERVISOR['max_restarts'])
+
+    def test_restarts_forgotten_after_healthy_period(self):
+        bot = self.supervise(StubBot("a", alive=False, failure=ConnectionError()), 0, 10)
+        bot.consecutive_failures = 1
+        self.supervise(bot, 60)
+        bot.consecutive_failures = 0
+        self.supervise(bot, 150)
+        self.assertEqual(self.dispatch.restarts["a"], 1)  # the failure at 60 restarted the healthy period
+        self.supervise(bot, 160)
+        self.assertEqual(self.dispatch.restarts["a"], 0)
+
+    def test_replaced_bot_kept_until_joined(self):
+        bot = StubBot("a")
+        new_bot = self.dispatch.replace_bot(bot)
+        self.assertTrue(bot.stop_event.is_set())
+        self.assertEqual(bot.clones, [new_bot])
+        self.assertEqual(self.dispatch.retired, [bot])
+
+
+class ShutdownBot(threading.Thread):
+    """
+    A bot thread that stops when it is drained, unless it is stubborn, in which case it runs until released.
+    """
+    def __init__(self, name, stubborn=False):
+        super(ShutdownBot, self).__init__(daemon=True, name=name)
+        self.USER_NAME = name
+        self.stubborn = stubborn
+        self.stop_event = threading.Event()
+        self.release = threading.Event()
+        self.stop_by = None
+        self.deadline = None
+        self.failure = None
+        self.consecutive_failures = 0
+
+    def is_overrun(self, grace_seconds=0):
+        return False
+
+    def drain(self, end=None):
+        self.stop_by = end
+        self.stop_event.set()
+
+    def run(self):
+        self.stop_event.wait()
+        if self.stubborn:
+            self.release.wait()
+
+
+class ShutdownTest(unittest.TestCase):
+
+    def setUp(self):
+        for patcher in (patch.object(dispatch, 'logger'), patch.object(dispatch, 'ConfigWatcher'),
+                        patch.object(dispatch, 'CommentStream'), patch.object(dispatch, 'MemoryMonitor'),
+                        patch.object(dispatch, 'get_watchdog_config', return_value=WATCHDOG)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.dispatch = dispatch.Dispatch([])
+
+    def add_bots(self, *bots):
+        for bot in bots:
+            self.dispatch.bots[bot.USER_NAME] = [bot]
+            self.addCleanup(bot.release.set)
+
+    def test_bots_stopped_against_one_deadline(self):
+        quick, stubborn, also_stubborn = ShutdownBot("quick"), ShutdownBot("stubborn", True), \
+            ShutdownBot("also_stubborn", True)
+        self.add_bots(quick, stubborn, also_stubborn)
+        self.dispatch.start()
+        while not all(bot.is_alive() for bot in (quick, stubborn, also_stubborn)):
+            sleep(0.01)
+        started = monotonic()
+        self.dispatch.join(timeout=0.3)
+        elapsed = monotonic() - started
+        self.assertLess(elapsed, 0.5)  # joining each stubborn bot for the whole timeout would take 0.6s
+        self.assertFalse(quick.is_alive())
+        self.assertEqual(sorted(self.dispatch.unfinished), ["also_stubborn", "stubborn"])
+        self.assertEqual(len({bot.stop_by for bot in (quick, stubborn, also_stubborn)}), 1)
+        self.assertAlmostEqual(quick.stop_by, started + 0.3, delta=0.05)
+
+    def test_join_waits_for_account_reload(self):
+        old = ShutdownBot("old")
+        self.add_bots(old)
+        reloading = threading.Event()
+        self.dispatch.signatures["old"] = dispatch.BotSignature("ShutdownBot", "old", "")
+        self.dispatch.create_bots = lambda signature: [ShutdownBot(signature.username)]
+
+        def watch_config():
+            reloading.set()
+            sleep(0.1)  # join() is called while the accounts are being reloaded
+            self.dispatch.update_bots([dispatch.BotSignature("ShutdownBot", "new", "")])
+        self.dispatch.watch_config = watch_config
+        self.dispatch.start()
+        self.assertTrue(reloading.wait(5))
+        self.dispatch.join(timeout=1)
+        self.assertFalse(self.dispatch.is_alive())
+        self.assertFalse([bot.name for bot in self.dispatch.get_all_bots() if bot.is_alive()])
+        self.assertEqual(self.dispatch.unfinished, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+import event_store
+
+
+def make_event(permalink, starts_at, title="Event"):
+    return {'permalink': permalink, 'title': title, 'date_display': "June 5 @ 8:00 am - 5:00 pm",
+            'description': "None provided", 'starts_at': starts_at}
+
+
+class EventStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = event_store.EventStore(':memory:')
+
+    def test_get_upcoming_events_sorted_by_start(self):
+        self.store.save_events([make_event('b', 300), make_event('a', 200), make_event('past', 50)], now=100)
+        events = self.store.get_upcoming_events(after=100)
+        self.assertEqual([event.permalink for event in events], ['a', 'b'])
+
+    def test_last_changed_only_updates_on_change(self):
+        self.store.save_events([make_event('a', 200), make_event('b', 200)], now=100)
+        self.store.save_events([make_event('a', 200), make_event('b', 200, title="Renamed")], now=150)
+        events = {event.permalink: event for event in self.store.get_upcoming_events(after=0)}
+        self.assertEqual((events['a'].first_seen, events['a'].last_changed), (100, 100))
+        self.assertEqual((events['b'].first_seen, events['b'].last_changed), (100, 150))
+        self.assertEqual(events['b'].title, "Renamed")
+
+    def test_expire_events(self):
+        self.store.save_events([make_event('a', 100), make_event('b', 200), make_event('c', 300)], now=0)
+        self.assertEqual(self.store.expire_events(before=250), 2)
+        self.assertEqual([event.permalink for event in self.store.get_upcoming_events(after=0)], ['c'])
+
+    def test_delete_events_except(self):
+        self.store.save_events([make_event('a', 100), make_event('b', 200), make_event('c', 300)], now=0)
+        self.assertEqual(self.store.delete_events_except(['a', 'c', 'unknown'], 0, 1000), 1)
+        self.assertEqual([event.permalink for event in self.store.get_upcoming_events(after=0)], ['a', 'c'])
+
+    def test_delete_events_except_keeps_events_outside_span(self):
+        self.store.save_events([make_event('a', 100), make_event('b', 200), make_event('c', 300)], now=0)
+        self.assertEqual(self.store.delete_events_except([], 150, 300), 1)
+        self.assertEqual([event.permalink for event in self.store.get_upcoming_events(after=0)], ['a', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import feed
+
+FEED_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+<channel>
+    <title>University Press</title>
+    <item>
+        <title>Newest article</title>
+        <link>http://www.upressonline.com/2016/05/newest/</link>
+        <guid isPermaLink="false">http://www.upressonline.com/?p=3</guid>
+        <pubDate>Thu, 12 May 2016 15:00:00 +0000</pubDate>
+    </item>
+    <item>
+        <title>Middle article</title>
+        <link>http://www.upressonline.com/2016/05/middle/</link>
+        <guid isPermaLink="false">http://www.upressonline.com/?p=2</guid>
+    </item>
+    <item>
+        <title>Oldest article</title>
+        <link>http://www.upressonline.com/2016/05/oldest/</link>
+    </item>
+</channel>
+</rss>"""
+
+ATOM_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+    <title>University Press</title>
+    <entry>
+        <title>Newest article</title>
+        <link rel="alternate" href="http://www.upressonline.com/2016/05/newest/"/>
+        <link rel="replies" href="http://www.upressonline.com/2016/05/newest/#comments"/>
+        <id>http://www.upressonline.com/?p=3</id>
+        <published>2016-05-12T15:00:00Z</published>
+    </entry>
+    <entry>
+        <title>Older article</title>
+        <link href="http://www.upressonline.com/2016/05/older/"/>
+        <id>http://www.upressonline.com/?p=2</id>
+        <updated>2016-05-11T15:00:00Z</updated>
+    </entry>
+</feed>"""
+
+
+class FeedTest(unittest.TestCase):
+
+    def test_feed_url_for(self):
+        self.assertEqual(feed.feed_url_for("http://www.upressonline.com/2016/05"),
+                         "http://www.upressonline.com/2016/05/feed/")
+        self.assertEqual(feed.feed_url_for("http://www.upressonline.com/category/news/"),
+                         "http://www.upressonline.com/category/news/feed/")
+
+    def test_parse_feed(self):
+        items = feed.parse_feed(FEED_XML)
+        self.assertEqual([item.title for item in items], ["Newest article", "Middle article", "Oldest article"])
+        self.assertEqual(items[0].guid, "http://www.upressonline.com/?p=3")
+        self.assertEqual(items[2].guid, items[2].url)
+
+    def test_parse_feed_stops_at_last_seen_guid(self):
+        items = feed.parse_feed(FEED_XML, stop_at_guid="http://www.upressonline.com/?p=2")
+        self.assertEqual([item.title for item in items], ["Newest article"])
+
+    def test_parse_atom_feed(self):
+        items = feed.parse_feed(ATOM_XML)
+        self.assertEqual([item.url for item in items], ["http://www.upressonline.com/2016/05/newest/",
+                                                        "http://www.upressonline.com/2016/05/older/"])
+        self.assertEqual(items[0].guid, "http://www.upressonline.com/?p=3")
+        self.assertEqual(items[1].published, "2016-05-11T15:00:00Z")
+        self.assertEqual(feed.parse_feed(ATOM_XML, stop_at_guid="http://www.upressonline.com/?p=2"), items[:1])
+
+    def test_parse_unknown_feed_raises(self):
+        with self.assertRaises(feed.ElementTree.ParseError):
+            feed.parse_feed(b"<html><body><item><link>http://example.com</link></item></body></html>")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+from unittest.mock import patch
+
+import http_cache
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers, content=b""):
+        self.status_code = status_code
+        self.headers = http_cache.requests.structures.CaseInsensitiveDict(headers)
+        self.content = content
+        self.encoding = 'utf-8'
+
+
+class HttpCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = http_cache.HttpCache(':memory:', 1024 * 1024, default_max_age=0)
+
+    def test_lowercase_validators_are_sent(self):
+        responses = [FakeResponse(200, {'etag': '"v1"', 'last-modified': "Thu, 12 May 2016 10:00:00 GMT",
+                                        'cache-control': "max-age=0"}, b"page"),
+                     FakeResponse(304, {})]
+        with patch.object(http_cache.requests, 'get', side_effect=responses) as get:
+            self.cache.get("http://example.com/", timeout=5)
+            response = self.cache.get("http://example.com/", timeout=5)
+        headers = get.call_args[1]['headers']
+        self.assertEqual(headers, {'If-None-Match': '"v1"', 'If-Modified-Since': "Thu, 12 May 2016 10:00:00 GMT"})
+        self.assertTrue(response.not_modified)
+        self.assertEqual(response.content, b"page")
+
+    def test_default_max_age_serves_pages_without_validators(self):
+        self.cache.default_max_age = 600
+        with patch.object(http_cache.requests, 'get', return_value=FakeResponse(200, {}, b"page")) as get:
+            self.cache.get("http://example.com/", timeout=5)
+            response = self.cache.get("http://example.com/", timeout=5)
+        self.assertEqual(get.call_count, 1)
+        self.assertTrue(response.from_cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
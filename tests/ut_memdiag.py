@@ -0,0 +1,81 @@
+import os
+import tracemalloc
+import unittest
+from collections import namedtuple
+from unittest.mock import patch
+
+import praw
+
+import cache
+import memdiag
+from config import root
+
+Frame = namedtuple('Frame', 'filename lineno')
+Submission = namedtuple('Submission', 'reddit_session fullname title')  # like a praw Submission, which keeps its session
+SITE_PACKAGES = os.path.join(os.sep, "usr", "lib", "python3", "site-packages")
+
+
+class MemdiagTest(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = {'enabled': False, 'interval_seconds': 0, 'frames': 5, 'top': 5}
+        patcher = patch.object(memdiag, 'get_memory_config', side_effect=lambda: self.settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.monitor = memdiag.MemoryMonitor()
+        self.addCleanup(self.monitor.stop_tracing)
+        self.addCleanup(self.monitor.stop)
+
+    def test_owner_is_nearest_local_module(self):
+        traceback = [Frame(os.path.join(root, "__main__.py"), 1), Frame(os.path.join(root, "newsbot.py"), 2),
+                     Frame(os.path.join(SITE_PACKAGES, "bs4", "element.py"), 3), Frame(os.__file__, 4)]
+        self.assertEqual(memdiag.get_owner(traceback), "newsbot")
+
+    def test_owner_falls_back_to_package(self):
+        traceback = [Frame(os.__file__, 1), Frame(os.path.join(SITE_PACKAGES, "praw", "internal.py"), 2)]
+        self.assertEqual(memdiag.get_owner(traceback), "praw")
+        self.assertEqual(memdiag.get_owner([Frame(os.__file__, 1)]), "<python>")
+
+    def test_cache_sizes(self):
+        small, big = cache.SharedCache("small"), cache.SharedCache("big")
+        small.set("a", "x")
+        big.set("a", [str(i) * 1000 for i in range(10)])
+        with patch.object(cache, 'get_caches', return_value=[small, big]):
+            sizes = memdiag.get_cache_sizes()
+        self.assertEqual([(name, entries) for name, entries, size in sizes], [("big", 1), ("small", 1)])
+        self.assertGreater(sizes[0][2], 10000)
+
+    def test_cache_not_charged_for_reddit_session(self):
+        reddit = praw.Reddit.__new__(praw.Reddit)
+        reddit.cached_listings = [str(i) * 1000 for i in range(100)]
+        submission = Submission(reddit, "t3_abc", "A title")
+        self.assertLess(memdiag.get_deep_size([submission]), 10000)
+        self.assertGreater(memdiag.get_deep_size(reddit.cached_listings), 100000)
+
+    def test_toggle_lasts_until_reload(self):
+        self.assertFalse(self.monitor.is_enabled())
+        self.monitor.toggle()
+        self.assertTrue(self.monitor.is_enabled())
+        self.monitor.on_config_reload({})
+        self.assertFalse(self.monitor.is_enabled())
+
+    def test_check_reports_while_enabled(self):
+        self.monitor.check()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.settings['enabled'] = True
+        with self.assertLogs() as root_logs, self.assertLogs('memdiag') as logs:
+            self.monitor.check()
+            kept = [bytearray(1000) for _ in range(100)]
+            self.monitor.check()
+            self.assertTrue(tracemalloc.is_tracing())
+            self.settings['enabled'] = False
+            self.monitor.check()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertTrue(any("Module memory: module=[" in line for line in logs.output))
+        self.assertTrue(any("Line growth: line=[" in line for line in logs.output))
+        self.assertTrue(any("Memory diagnostics stopped" in line for line in root_logs.output))
+        del kept
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import message_ledger
+
+
+class MessageLedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ledger = message_ledger.MessageLedger(':memory:')
+
+    def test_new_messages_are_seen(self):
+        states = self.ledger.get_states("bot", ["t4_a", "t4_b"])
+        self.assertEqual(states, {"t4_a": message_ledger.SEEN, "t4_b": message_ledger.SEEN})
+
+    def test_states_survive_between_batches(self):
+        self.ledger.get_states("bot", ["t4_a", "t4_b"])
+        self.ledger.set_state("bot", "t4_a", message_ledger.REPLYING)
+        self.ledger.set_state("bot", "t4_b", message_ledger.IGNORED)
+        states = self.ledger.get_states("bot", ["t4_a", "t4_b", "t4_c"])
+        self.assertEqual(states, {"t4_a": message_ledger.REPLYING, "t4_b": message_ledger.IGNORED,
+                                  "t4_c": message_ledger.SEEN})
+
+    def test_accounts_are_separate(self):
+        self.ledger.set_state("bot1", "t4_a", message_ledger.DONE)
+        self.assertEqual(self.ledger.get_state("bot1", "t4_a"), message_ledger.DONE)
+        self.assertIsNone(self.ledger.get_state("bot2", "t4_a"))
+
+    def test_unknown_state(self):
+        with self.assertRaises(ValueError):
+            self.ledger.set_state("bot", "t4_a", "lost")
+
+    def test_prune_only_forgets_finished_messages(self):
+        for fullname, state in (("t4_a", message_ledger.DONE), ("t4_b", message_ledger.IGNORED),
+                                ("t4_c", message_ledger.REPLYING), ("t4_d", message_ledger.FAILED)):
+            self.ledger.set_state("bot", fullname, state)
+        self.assertEqual(self.ledger.prune(before=float('inf')), 3)
+        self.assertEqual(self.ledger.get_state("bot", "t4_c"), message_ledger.REPLYING)
+        self.assertEqual(self.ledger.get_states("bot", []), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
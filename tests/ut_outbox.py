@@ -0,0 +1,52 @@
+import unittest
+import outbox
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outbox = outbox.Outbox(':memory:')
+
+    def test_pending_actions_sorted_by_priority(self):
+        self.outbox.add("bot", outbox.EDIT, "t3_a", {'text': "table"}, outbox.PRIORITY_EDIT)
+        self.outbox.add("bot", outbox.SUBMIT, "FAUbot", {'title': "t"}, outbox.PRIORITY_SUBMIT)
+        self.outbox.add("bot", outbox.SEND_MESSAGE, "user", {'subject': "s"}, outbox.PRIORITY_REPLY)
+        self.outbox.add("other", outbox.SEND_MESSAGE, "user", {'subject': "s"}, outbox.PRIORITY_REPLY)
+        kinds = [action.kind for action in self.outbox.get_pending("bot", limit=10)]
+        self.assertEqual(kinds, [outbox.SEND_MESSAGE, outbox.SUBMIT, outbox.EDIT])
+
+    def test_coalesced_edits_keep_last_write(self):
+        for text in ("first", "second", "third"):
+            self.outbox.add("bot", outbox.EDIT, "t3_a", {'text': text}, outbox.PRIORITY_EDIT, "edit:t3_a")
+        self.outbox.add("bot", outbox.EDIT, "t3_b", {'text': "other"}, outbox.PRIORITY_EDIT, "edit:t3_b")
+        actions = self.outbox.get_pending("bot", limit=10)
+        self.assertEqual([action.payload['text'] for action in actions], ["third", "other"])
+
+    def test_coalesce_keys_are_per_account(self):
+        self.outbox.add("bot1", outbox.EDIT, "t3_a", {'text': "a"}, outbox.PRIORITY_EDIT, "edit:t3_a")
+        self.outbox.add("bot2", outbox.EDIT, "t3_a", {'text': "b"}, outbox.PRIORITY_EDIT, "edit:t3_a")
+        self.assertEqual(self.outbox.count("bot1"), 1)
+        self.assertEqual(self.outbox.count("bot2"), 1)
+
+    def test_complete_keeps_action_coalesced_while_sending(self):
+        self.outbox.add("bot", outbox.EDIT, "t3_a", {'text': "old"}, outbox.PRIORITY_EDIT, "edit:t3_a")
+        sending = self.outbox.get_pending("bot", limit=1)[0]
+        self.outbox.add("bot", outbox.EDIT, "t3_a", {'text': "new"}, outbox.PRIORITY_EDIT, "edit:t3_a")
+        self.outbox.complete(sending)
+        self.assertEqual([action.payload['text'] for action in self.outbox.get_pending("bot", limit=10)], ["new"])
+        self.outbox.complete(self.outbox.get_pending("bot", limit=1)[0])
+        self.assertEqual(self.outbox.count("bot"), 0)
+
+    def test_retry_waits(self):
+        self.outbox.add("bot", outbox.SUBMIT, "FAUbot", {'title': "t"}, outbox.PRIORITY_SUBMIT)
+        action = self.outbox.get_pending("bot", limit=1, now=100)[0]
+        self.outbox.retry(action, not_before=200, count_attempt=False)
+        self.assertEqual(self.outbox.get_pending("bot", limit=1, now=150), [])
+        retried = self.outbox.get_pending("bot", limit=1, now=200)[0]
+        self.assertEqual(retried.attempts, 0)
+        self.outbox.retry(retried, not_before=0)
+        self.assertEqual(self.outbox.get_pending("bot", limit=1, now=200)[0].attempts, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
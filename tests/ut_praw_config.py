@@ -1,4 +1,5 @@
 import os
+import tempfile
 import unittest
 from unittest.mock import patch
 from ddt import ddt, unpack, data
@@ -47,3 +48,18 @@ class PrawConfigTest(unittest.TestCase):
             praw_config.set_value(site_name, key, value, current_parser)
             result = praw_config.get_value(site_name, key, current_parser)
             self.assertEqual(result, expected_output)
+
+    def test_set_refresh_tokens_in_one_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "praw.ini")
+            with open(path, "w") as c_file:
+                c_file.write("[bot1]\noauth_refresh_token = \n[bot2]\noauth_refresh_token = \n")
+            with patch.object(praw_config, 'PRAW_FILE_PATH', path), \
+                    patch.object(praw_config, '_write_config', wraps=praw_config._write_config) as write:
+                praw_config.set_reddit_oauth_refresh_tokens({'bot1': "token1", 'bot2': "token2"})
+                self.assertEqual(write.call_count, 1)
+                self.assertEqual(praw_config.get_value('bot2', 'oauth_refresh_token'), "token2")
+                with self.assertRaises(praw_config.InvalidSiteName):
+                    praw_config.set_reddit_oauth_refresh_tokens({'bot1': "token3", 'badsite': "token4"})
+                self.assertEqual(praw_config.get_value('bot1', 'oauth_refresh_token'), "token1")
+            self.assertEqual(os.listdir(directory), ["praw.ini"])
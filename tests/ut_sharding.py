@@ -0,0 +1,85 @@
+import unittest
+from unittest.mock import patch
+import sharding
+
+
+ACCOUNTS = ["account{}".format(i) for i in range(200)]
+
+
+class HashRingTest(unittest.TestCase):
+
+    def test_every_account_has_one_owner(self):
+        ring = sharding.HashRing(["a", "b", "c"])
+        owners = {account: ring.get_owner(account) for account in ACCOUNTS}
+        self.assertEqual(set(owners.values()), {"a", "b", "c"})
+
+    def test_adding_a_worker_only_moves_its_accounts(self):
+        before = sharding.HashRing(["a", "b", "c"])
+        after = sharding.HashRing(["a", "b", "c", "d"])
+        for account in ACCOUNTS:
+            if after.get_owner(account) != "d":
+                self.assertEqual(after.get_owner(account), before.get_owner(account))
+
+    def test_empty_ring(self):
+        self.assertIsNone(sharding.HashRing([]).get_owner("account0"))
+
+
+class ShardCoordinatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = sharding.LeaseStore(':memory:')
+        self.now = 1000.0
+        patcher = patch.object(sharding, 'time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_coordinator(self, worker_id):
+        return sharding.ShardCoordinator(self.store, worker_id, lease_seconds=60)
+
+    def test_accounts_are_split_without_overlap(self):
+        a, b = self.make_coordinator("a"), self.make_coordinator("b")
+        a.update(ACCOUNTS)
+        b.update(ACCOUNTS)
+        owned_a, owned_b = a.update(ACCOUNTS), b.update(ACCOUNTS)
+        self.assertFalse(owned_a & owned_b)
+        self.assertEqual(owned_a | owned_b, set(ACCOUNTS))
+
+    def test_running_account_is_not_handed_over_until_stopped(self):
+        a, b = self.make_coordinator("a"), self.make_coordinator("b")
+        owned_a = a.update(ACCOUNTS)
+        self.assertEqual(owned_a, set(ACCOUNTS))
+        b.update(ACCOUNTS)
+        owned_a = a.update(ACCOUNTS, running=ACCOUNTS)
+        moved = set(ACCOUNTS) - owned_a
+        self.assertTrue(moved)
+        self.assertFalse(b.update(ACCOUNTS) & moved)  # a's bots for those accounts are still stopping
+        a.update(ACCOUNTS, running=owned_a)
+        self.assertEqual(b.update(ACCOUNTS), moved)
+
+    def test_dead_worker_accounts_are_taken_over_after_lease_expires(self):
+        a, b = self.make_coordinator("a"), self.make_coordinator("b")
+        a.update(ACCOUNTS)
+        b.update(ACCOUNTS)
+        owned_a = a.update(ACCOUNTS)
+        self.assertNotEqual(b.update(ACCOUNTS), set(ACCOUNTS))
+        self.now += 61  # a stops renewing
+        self.assertEqual(b.update(ACCOUNTS), set(ACCOUNTS))
+        self.assertTrue(owned_a)
+
+    def test_stream_leases_kept_on_update(self):
+        a = self.make_coordinator("a")
+        lease = sharding.STREAM_LEASE_PREFIX + "faubot"
+        self.assertTrue(self.store.acquire(lease, "a", self.now + 60, self.now))
+        a.update(ACCOUNTS)
+        self.assertIn(lease, self.store.get_leases("a"))
+
+    def test_leave_releases_leases(self):
+        a, b = self.make_coordinator("a"), self.make_coordinator("b")
+        a.update(ACCOUNTS)
+        a.leave(keep=["account0"])
+        self.assertEqual(self.store.get_leases("a"), {"account0"})
+        self.assertEqual(b.update(ACCOUNTS), set(ACCOUNTS) - {"account0"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import re
+import unittest
+from collections import namedtuple
+from unittest.mock import patch
+
+import sharding
+import stream
+
+FakeComment = namedtuple('FakeComment', 'fullname author body')
+
+
+class FakeReddit:
+    def __init__(self):
+        self.comments = {}  # subreddit -> list of FakeComments, newest first
+        self.calls = []
+
+    def get_comments(self, subreddit, limit, place_holder=None):
+        self.calls.append(subreddit)
+        return iter(self.comments.get(subreddit, [])[:limit])
+
+    def post(self, subreddit, *comments):
+        self.comments[subreddit] = list(reversed(comments)) + self.comments.get(subreddit, [])
+
+
+class CommentStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(stream, 'get_subreddits', return_value=["FAUbot"])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reddit = FakeReddit()
+        self.store = stream.StreamStore(':memory:')
+        self.stream = self.create_stream()
+        self.pattern = re.compile(r"!FAUbot (buy|sell) (\d{1,2})")
+
+    def create_stream(self, leases=None, worker_id=None):
+        return stream.CommentStream(self.store, self.reddit, leases, worker_id)
+
+    def read(self, comments):
+        routed = comments.get()
+        comments.remove([comment.fullname for comment in routed])
+        return routed
+
+    def test_first_poll_only_saves_position(self):
+        comments = self.stream.subscribe("TicketBot-a", self.pattern, "a")
+        self.reddit.post("FAUbot", FakeComment("t1_1", "user", "!FAUbot buy 2"))
+        self.stream.poll()
+        self.assertEqual(self.read(comments), [])
+        self.assertEqual(self.store.get_position("FAUbot"), "t1_1")
+
+    def test_new_matching_comments_routed_oldest_first(self):
+        comments = self.stream.subscribe("TicketBot-a", self.pattern, "a")
+        self.reddit.post("FAUbot", FakeComment("t1_1", "user", "hello"))
+        self.stream.poll()
+        self.reddit.post("FAUbot", FakeComment("t1_2", "user", "!FAUbot buy 2"), FakeComment("t1_3", "user", "hi"),
+                         FakeComment("t1_a", "user", "!FAUbot sell 1"))
+        self.stream.poll()
+        routed = self.read(comments)
+        self.assertEqual([comment.fullname for comment in routed], ["t1_2", "t1_a"])
+        self.assertEqual(routed[1].match.groups(), ("sell", "1"))
+        self.stream.poll()
+        self.assertEqual(self.read(comments), [])
+
+    def test_own_comments_not_routed(self):
+        comments = self.stream.subscribe("TicketBot-a", self.pattern, "a")
+        self.store.set_position("FAUbot", "t1_0")
+        self.reddit.post("FAUbot", FakeComment("t1_1", "A", "!FAUbot buy 2"))
+        self.stream.poll()
+        self.assertEqual(self.read(comments), [])
+
+    def test_one_read_per_subreddit(self):
+        for account in ("a", "b", "c"):
+            self.stream.subscribe("TicketBot-" + account, self.pattern, account)
+        self.store.set_position("FAUbot", "t1_0")
+        self.reddit.post("FAUbot", FakeComment("t1_1", "user", "!FAUbot buy 2"))
+        self.stream.poll()
+        self.assertEqual(self.reddit.calls, ["FAUbot"])
+        self.assertEqual(self.stream.reads, 1)
+
+    def test_comment_routed_to_one_subscriber_of_a_pattern(self):
+        subscribers = [self.stream.subscribe("TicketBot-" + account, self.pattern, account)
+                       for account in ("a", "b", "c")]
+        other = self.stream.subscribe("OtherBot", re.compile(r"!FAUbot buy"), "d")
+        self.store.set_position("FAUbot", "t1_0")
+        self.reddit.post("FAUbot", *[FakeComment("t1_" + str(i), "user", "!FAUbot buy 2") for i in range(1, 10)])
+        self.stream.poll()
+        routed = [[comment.fullname for comment in self.read(comments)] for comments in subscribers]
+        self.assertEqual(sorted(sum(routed, [])), ["t1_" + str(i) for i in range(1, 10)])
+        self.assertEqual(len(self.read(other)), 9)
+
+    def test_routed_comments_kept_until_handled(self):
+        comments = self.stream.subscribe("TicketBot-a", self.pattern, "a")
+        self.store.set_position("FAUbot", "t1_0")
+        self.reddit.post("FAUbot", FakeComment("t1_1", "user", "!FAUbot buy 2"))
+        self.stream.poll()
+        self.stream.unsubscribe("TicketBot-a")  # e.g. the process stopped before the bot handled the comment
+        restarted = self.create_stream().subscribe("TicketBot-a", self.pattern, "a")
+        self.assertIsNot(restarted, comments)
+        self.assertEqual([comment.fullname for comment in self.read(restarted)], ["t1_1"])
+        self.assertEqual(restarted.get(), [])
+
+    def test_comments_routed_to_subscribers_of_every_process(self):
+        other_process = self.create_stream()
+        comments = other_process.subscribe("TicketBot-b", self.pattern, "b")
+        self.stream.subscribe("OtherBot", re.compile(r"!FAUbot sell"), "a")
+        self.store.set_position("FAUbot", "t1_0")
+        self.reddit.post("FAUbot", FakeComment("t1_1", "user", "!FAUbot buy 2"))
+        self.stream.poll()
+        self.assertEqual([comment.fullname for comment in self.read(comments)], ["t1_1"])
+
+    def test_subreddit_read_only_by_lease_holder(self):
+        leases = sharding.LeaseStore(':memory:')
+        first, second = self.create_stream(leases, "first"), self.create_stream(leases, "second")
+        comments = first.subscribe("TicketBot-a", self.pattern, "a")
+        second.subscribe("TicketBot-b", self.pattern, "b")
+        self.store.set_position("FAUbot", "t1_0")
+        self.reddit.post("FAUbot", FakeComment("t1_1", "user", "!FAUbot buy 2"))
+        first.poll()
+        second.poll()
+        self.assertEqual(self.reddit.calls, ["FAUbot"])
+        self.assertEqual(leases.get_leases("first"), {sharding.STREAM_LEASE_PREFIX + "faubot"})
+        self.assertEqual(len(self.read(comments)) + len(second.subscribe("TicketBot-b", self.pattern, "b").get()), 1)
+
+    def test_position_not_moved_after_another_poll(self):
+        self.store.set_position("FAUbot", "t1_1")
+        comment = stream.StreamComment("t1_2", "FAUbot", "user", "!FAUbot buy 2", None)
+        self.assertFalse(self.store.advance("FAUbot", "t1_0", "t1_2", [("TicketBot-a", comment)]))
+        self.assertEqual(self.store.get_position("FAUbot"), "t1_1")
+        self.assertEqual(self.store.get_routed("TicketBot-a"), [])
+
+    def test_resubscribing_keeps_routed_comments(self):
+        comments = self.stream.subscribe("TicketBot-a", self.pattern, "a")
+        self.assertIs(self.stream.subscribe("TicketBot-a", self.pattern, "a"), comments)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+import tracing
+
+
+class TracingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = {'sample_rate': 1.0, 'file_name': 'traces.json', 'max_size_mb': 1, 'backup_count': 2}
+        for patcher in (patch.object(tracing, 'log_directory', self.directory),
+                        patch.object(tracing, 'get_tracing_config', lambda: self.settings)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        if tracing._writer is not None:
+            tracing._writer.close()
+            tracing._writer = None
+        shutil.rmtree(self.directory)
+
+    def read_events(self, file_name='traces.json'):
+        with open(os.path.join(self.directory, file_name)) as ifile:
+            text = ifile.read()
+        self.assertTrue(text.startswith("[\n"))
+        return json.loads(text.rstrip(",\n") + "]")
+
+    def test_trace_writes_root_and_child_spans(self):
+        with tracing.trace("work", bot="TestBot"):
+            with tracing.span("praw.submit", subreddit="FAUbot"):
+                pass
+        events = self.read_events()
+        self.assertEqual([event['name'] for event in events], ["praw.submit", "work"])
+        self.assertEqual(events[0]['cat'], "praw")
+        self.assertEqual(events[1]['args']['bot'], "TestBot")
+        self.assertEqual(len({event['args']['trace'] for event in events}), 1)
+        self.assertIsNone(tracing.get_context())
+
+    def test_unsampled_trace_writes_nothing(self):
+        self.settings['sample_rate'] = 0
+        with tracing.trace("work"):
+            with tracing.span("praw.submit"):
+                self.assertIsNone(tracing.get_context())
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'traces.json')))
+
+    def test_error_is_recorded(self):
+        with self.assertRaises(ValueError):
+            with tracing.trace("work"):
+                raise ValueError("boom")
+        self.assertIn("boom", self.read_events()[0]['args']['error'])
+
+    def test_worker_thread_joins_trace(self):
+        with tracing.trace("work"):
+            context = tracing.get_context()
+
+            def worker():
+                tracing.set_context(context)
+                with tracing.span("fetch.event_html"):
+                    pass
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+        events = self.read_events()
+        self.assertEqual([event['name'] for event in events], ["fetch.event_html", "work"])
+        self.assertNotEqual(events[0]['tid'], events[1]['tid'])
+
+    def test_traced_keeps_function_attributes(self):
+        def function():
+            return 1
+        function.invalidate = lambda: None
+        wrapped = tracing.traced("fetch.test")(function)
+        self.assertIs(wrapped.invalidate, function.invalidate)
+        self.assertEqual(wrapped(), 1)
+
+    def test_rotation_starts_new_file(self):
+        writer = tracing.TraceWriter(os.path.join(self.directory, 'rotated.json'), max_bytes=200, backup_count=1)
+        for i in range(10):
+            writer.write([{'name': "span{}".format(i), 'args': {'padding': "x" * 50}}])
+        writer.close()
+        current, backup = self.read_events('rotated.json'), self.read_events('rotated.json.1')
+        self.assertEqual(current[-1]['name'], "span9")
+        self.assertTrue(backup)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'rotated.json.2')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,36 +1,120 @@
 import re
+from time import time
 from config import getLogger
+from config.bot_config import get_ticketbot_config
 from bots import RedditBot
+from message_ledger import DONE, FAILED, IGNORED, REPLIED, REPLYING, SEEN, MessageLedger
+from outbox import REPLY, SEND_MESSAGE
+from tracing import span
 
 logger = getLogger()
 
 
 class TicketBot(RedditBot):
+    COMMENT_PATTERN = re.compile(r"!FAUbot (buy|sell) (\d{1,2})")
+
     def __init__(self, user_name, *args, **kwargs):
         super().__init__(user_name, *args, reset_sleep_interval=False, **kwargs)
-        self.COMMAND_PATTERN = "!FAUbot (buy|sell) (\d{1,2})"
+        self.COMMAND_PATTERN = self.COMMENT_PATTERN
         self.sleep_interval = 5
+        self.ledger = MessageLedger.shared(get_ticketbot_config()['ledger_file'])
 
     def work(self):
+        """
+        Answers the commands in the bot's unread messages, and in the subreddit comments routed to it.
+        Every message is looked up in the ledger first, so a message that comes back because the bot stopped
+        half way through it is picked up where it was left, and is never answered twice.
+        Messages without a command, and messages whose reply the outbox gave up on, are marked read, so they are
+        not fetched again.
+        """
         logger.info("Getting unread messages")
-        inbox = self.r.get_unread(unset_has_mail=True)
+        with span("praw.get_unread"):
+            inbox = list(self.r.get_unread(unset_has_mail=True))
+        states = self.ledger.get_states(self.USER_NAME, [message.fullname for message in inbox])
         for message in inbox:
-            command = re.search(self.COMMAND_PATTERN, message.body)
-            if command:
-                logger.info("Found message with a command")
-                operation = command.groups()[0]
-                number = command.groups()[1]
-                logger.info("Command: operation=[{}], number=[{}]".format(operation, number))
-                subject = "FAUbot received your command"
-                reply = """Hello! You have sent me a command. According to the message you sent me, you want to:
+            self.check_deadline()
+            state = states.get(message.fullname, SEEN)
+            if state == SEEN:
+                state = self.handle_message(message)
+            if state in (IGNORED, REPLIED, DONE, FAILED):
+                message.mark_as_read()
+                if state == REPLIED:
+                    self.ledger.set_state(self.USER_NAME, message.fullname, DONE)
+            # REPLYING messages stay unread until the outbox sends their reply
+        comments = self.get_routed_comments()
+        self.handle_comments(comments)
+        self.mark_comments_handled(comments)
+        self.ledger.prune(time() - get_ticketbot_config()['ledger_retention_days'] * 24 * 60 * 60)
+
+    def handle_comments(self, comments):
+        """
+        Queues a reply to each comment with a command, unless the ledger shows it was answered already,
+        e.g. because the bot stopped before marking it handled.
+        :param comments: A list of stream.StreamComments
+        """
+        states = self.ledger.get_states(self.USER_NAME, [comment.fullname for comment in comments])
+        for comment in comments:
+            if states.get(comment.fullname, SEEN) != SEEN:
+                continue
+            operation, number = comment.match.groups()
+            logger.info("Queueing reply to comment: fullname=[{}], author=[{}]".format(comment.fullname,
+                                                                                     comment.author))
+            self.queue_reply(comment.fullname, self.get_reply_text(operation, number),
+                             coalesce_key="reply:" + comment.fullname, context=comment.fullname)
+            self.ledger.set_state(self.USER_NAME, comment.fullname, REPLYING)
+
+    @staticmethod
+    def get_reply_text(operation, number):
+        return """Hello! You have sent me a command. According to the message you sent me, you want to:
 
 `{} {}` ticket{}.
 
 Right now I'm just a prototype, so I will not process your request.""".format(operation, number, ('s' if int(number) > 1 else ''))
-                logger.info("Sending reply to: recipient=[{}]".format(message.author))
-                self.r.send_message(message.author, subject, reply)
-                logger.info("Message sent.")
-                message.mark_as_read()
+
+    def handle_message(self, message):
+        """
+        Queues a reply to a message with a command, or ignores a message without one.
+        :return: The message's new state in the ledger
+        """
+        command = self.COMMAND_PATTERN.search(message.body)
+        if not command:
+            self.ledger.set_state(self.USER_NAME, message.fullname, IGNORED)
+            return IGNORED
+        logger.info("Found message with a command")
+        operation = command.groups()[0]
+        number = command.groups()[1]
+        logger.info("Command: operation=[{}], number=[{}]".format(operation, number))
+        subject = "FAUbot received your command"
+        reply = self.get_reply_text(operation, number)
+        logger.info("Queueing reply to: recipient=[{}]".format(message.author))
+        # if the bot stops before the ledger is updated, the message is handled again and its reply replaces
+        # the one waiting in the outbox, because they have the same coalesce key
+        self.queue_message(message.author, subject, reply, coalesce_key="reply:" + message.fullname,
+                           context=message.fullname)
+        self.ledger.set_state(self.USER_NAME, message.fullname, REPLYING)
+        return REPLYING
+
+    def on_action_sent(self, action):
+        """
+        An override of RedditBot.on_action_sent(). Records that a reply was sent, so its message can be marked read.
+        Comments are not marked read, so a comment reply is done as soon as it is sent.
+        """
+        if action.kind == SEND_MESSAGE and action.payload.get('context'):
+            self.ledger.set_state(self.USER_NAME, action.payload['context'], REPLIED)
+            logger.info("Reply sent: recipient=[{}]".format(action.target))
+        elif action.kind == REPLY and action.payload.get('context'):
+            self.ledger.set_state(self.USER_NAME, action.payload['context'], DONE)
+            logger.info("Comment reply sent: fullname=[{}]".format(action.target))
+
+    def on_action_dropped(self, action):
+        """
+        An override of RedditBot.on_action_dropped(). Records that a reply will never be sent, so its message is
+        marked read on the next work cycle instead of waiting in REPLYING forever.
+        """
+        if action.kind in (SEND_MESSAGE, REPLY) and action.payload.get('context'):
+            self.ledger.set_state(self.USER_NAME, action.payload['context'], FAILED)
+            logger.warning("Reply dropped, giving up on its message: fullname=[{}]".format(
+                action.payload['context']))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,177 @@
+import json
+import os
+import random
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from itertools import count
+from time import perf_counter, time
+
+from config import getLogger, log_directory
+from config.bot_config import get_tracing_config
+
+logger = getLogger()
+_local = threading.local()
+_trace_ids = count(1)
+_writer_lock = threading.Lock()
+_writer = None
+
+
+class TraceWriter(object):
+    """
+    Appends finished spans to a file in Chrome's trace event format, so a trace viewer (chrome://tracing or
+    Perfetto) can open it. Every file starts with '[' and every line is one event followed by a comma, which
+    the viewers accept without a closing ']', so events can be appended as they come.
+    When the file grows past max_bytes it is rotated like a logging.handlers.RotatingFileHandler.
+    """
+    def __init__(self, path, max_bytes, backup_count):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        if self._file.tell() == 0:
+            self._file.write("[\n")
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.path, i)):
+                os.replace("{}.{}".format(self.path, i), "{}.{}".format(self.path, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def write(self, events):
+        """
+        :param events: A list of trace event dicts
+        """
+        lines = "".join(json.dumps(event, separators=(',', ':'), default=str) + ",\n" for event in events)
+        with self._lock:
+            if self._file is None:
+                self._open()
+            elif self._file.tell() + len(lines) > self.max_bytes:
+                self._rotate()
+            self._file.write(lines)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _get_writer():
+    """
+    :return: The TraceWriter for the current tracing settings. A new one is made if the settings were reloaded.
+    """
+    global _writer
+    settings = get_tracing_config()
+    path = os.path.join(log_directory, settings['file_name'])
+    max_bytes = int(settings['max_size_mb'] * 1024 * 1024)
+    with _writer_lock:
+        if _writer is None or (_writer.path, _writer.max_bytes, _writer.backup_count) != \
+                (path, max_bytes, settings['backup_count']):
+            if _writer is not None:
+                _writer.close()
+            _writer = TraceWriter(path, max_bytes, settings['backup_count'])
+        return _writer
+
+
+class Trace(object):
+    """
+    The spans of one sampled work cycle. They are kept in memory and written together when the cycle ends.
+    """
+    def __init__(self):
+        self.trace_id = next(_trace_ids)
+        self.events = []
+
+
+def get_context():
+    """
+    :return: The Trace being recorded in the current thread, or None. Pass it to set_context() in a worker thread
+             so the worker's spans are part of the same trace.
+    """
+    return getattr(_local, 'trace', None)
+
+
+def set_context(trace):
+    _local.trace = trace
+
+
+@contextmanager
+def span(name, **args):
+    """
+    Records how long a block takes as a child of the current trace.
+    Outside a sampled trace this does nothing, so it is cheap to leave in hot code.
+    The category shown by the trace viewer is the part of the name before the first '.', e.g. "praw".
+    :param name: Name of the step, e.g. "praw.submit"
+    :param args: Details shown with the span, e.g. the URL. More can be added to the yielded dict.
+    :return: A context manager that yields the span's args dict
+    """
+    trace = get_context()
+    if trace is None:
+        yield args
+        return
+    started = time()
+    start = perf_counter()
+    try:
+        yield args
+    except BaseException as e:
+        args['error'] = repr(e)
+        raise
+    finally:
+        args['trace'] = trace.trace_id
+        trace.events.append({'name': name, 'cat': name.partition('.')[0], 'ph': 'X', 'ts': int(started * 1e6),
+                             'dur': int((perf_counter() - start) * 1e6), 'pid': os.getpid(),
+                             'tid': threading.get_ident(), 'args': args})
+
+
+@contextmanager
+def trace(name, **args):
+    """
+    Starts a trace for one unit of work, e.g. one work cycle, with a root span.
+    Only a sample of traces are recorded (see sample_rate in bot_config.yaml). Spans inside a trace that was not
+    sampled do nothing. If a trace is already running in the thread, this is just a span.
+    """
+    if get_context() is not None:
+        with span(name, **args) as span_args:
+            yield span_args
+        return
+    sample_rate = get_tracing_config()['sample_rate']
+    if not sample_rate or random.random() >= sample_rate:
+        yield args
+        return
+    current = Trace()
+    set_context(current)
+    try:
+        with span(name, **args) as span_args:
+            yield span_args
+    finally:
+        set_context(None)
+        try:
+            _get_writer().write(current.events)
+        except OSError:
+            logger.exception("Could not write trace: trace=[{}]".format(current.trace_id))
+
+
+def traced(name):
+    """
+    A decorator that records every call of a function as a span.
+    Attributes of the function, e.g. the invalidate() of a shared_cache function, are kept.
+    :param name: Name of the span
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator